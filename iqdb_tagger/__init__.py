@@ -1,4 +1,4 @@
 # -*- coding: utf-8 -*-
 """Init file."""
 __version__ = "0.3.2"
-db_version = 1
+db_version = 5
@@ -7,11 +7,14 @@ import pathlib
 import platform
 import pprint
 import shutil
-import traceback
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from logging.handlers import TimedRotatingFileHandler
 from tempfile import NamedTemporaryFile
-from typing import Any, Dict, Iterator, List, Optional, Tuple
-from urllib.parse import urlparse
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple
+from urllib.parse import urljoin, urlparse
 
 import cfscrape
 import click
@@ -23,23 +26,45 @@ from bs4 import BeautifulSoup
 from flask import Flask
 from flask import __version__ as flask_version  # type: ignore
 from flask import cli as flask_cli
-from flask import send_from_directory
+from flask import abort, current_app, request, send_from_directory
 from flask_admin import Admin
 from flask_restful import Api
-from hydrus import Client
+from hydrus import APIError, Client
 from hydrus.utils import yield_chunks
+from PIL import Image
 
-from . import models, parse, views
+from . import (
+    archive,
+    export,
+    http_cache,
+    hydrus_writer,
+    jobs,
+    journal,
+    lru,
+    models,
+    parse,
+    pipeline,
+    ratelimit,
+    snapshot,
+    tag_prefetch,
+    thumbnail,
+    views,
+    workqueue,
+)
 from .__init__ import __version__, db_version
 from .models import iqdb_url_dict
-from .utils import default_db_path, thumb_folder, user_data_dir
+from .singleflight import SingleFlight
+from .utils import default_db_path, resize_cache_folder, thumb_folder, user_data_dir
 
 db = "~/images/! tagged"
 DEFAULT_PLACE = "iqdb"
+HYDRUS_THUMBNAIL_MIN_SIZE = 100
 minsim = 75
 services = ["1", "2", "3", "4", "5", "6", "10", "11"]
 forcegray = False
 log = structlog.getLogger()
+# concurrent search of the same posted image and iqdb place
+image_search_flight = SingleFlight()
 
 
 def get_iqdb_result(image: str, iqdb_url: str = "http://iqdb.org/") -> Any:
@@ -50,12 +75,53 @@ def get_iqdb_result(image: str, iqdb_url: str = "http://iqdb.org/") -> Any:
     return parse.parse_result(html_text)
 
 
-def init_program(db_path: str = default_db_path) -> None:
-    """Init program."""
+def init_program(db_path: str = default_db_path, db_url: Optional[str] = None, pool: bool = False) -> None:
+    """Init program.
+
+    Args:
+        db_path: sqlite database path
+        db_url: database url, used instead of the path
+        pool: use connection pool for sqlite database
+    """
     # create user data dir
     pathlib.Path(user_data_dir).mkdir(parents=True, exist_ok=True)
     pathlib.Path(thumb_folder).mkdir(parents=True, exist_ok=True)
-    models.init_db(db_path, db_version)
+    models.init_db(db_path, db_version, db_url=db_url, pool=pool)
+
+
+def log_to_stderr() -> None:
+    """Print log to stderr, so stdout only contain command output."""
+    structlog.configure(logger_factory=structlog.PrintLoggerFactory(sys.stderr))
+
+
+def init_browser_and_scraper(
+    response_cache: Optional[http_cache.ResponseCache] = None,
+    response_archive: Optional[archive.ResponseArchive] = None,
+    rate_limiter: Optional[ratelimit.RateLimiter] = None,
+) -> Tuple[mechanicalsoup.StatefulBrowser, cfscrape.CloudflareScraper]:
+    """Init browser and scraper used to fetch tag page.
+
+    Args:
+        response_cache: cache responses on disk, shared by browsers of all threads
+        response_archive: archive fetched tag page
+        rate_limiter: limit request rate per host, cached response is not limited
+
+    Returns:
+        browser and scraper instance
+    """
+    br = mechanicalsoup.StatefulBrowser(soup_config={"features": "lxml"})
+    br.raise_on_404 = True
+    scraper = cfscrape.CloudflareScraper()
+    if rate_limiter is not None:
+        rate_limiter.mount(br.session)
+        rate_limiter.mount(scraper)
+    if response_archive is not None:
+        response_archive.mount(br.session)
+        response_archive.mount(scraper)
+    if response_cache is not None:
+        response_cache.mount(br.session)
+        response_cache.mount(scraper)
+    return br, scraper
 
 
 def write_url_from_match_result(match_result: models.ImageMatch, folder: str = None) -> None:
@@ -69,12 +135,121 @@ def write_url_from_match_result(match_result: models.ImageMatch, folder: str = N
         f.write("\n")
 
 
+def search_posted_image(
+    post_img: models.ImageModel,
+    post_img_path: str,
+    place: str,
+    browser: Optional[mechanicalsoup.StatefulBrowser] = None,
+    img_alt_tags: bool = False,
+    use_negative_cache: bool = True,
+    response_archive: Optional[archive.ResponseArchive] = None,
+    rate_limiter: Optional[ratelimit.RateLimiter] = None,
+) -> List[models.ImageMatch]:
+    """Search posted image on iqdb, use the result from db when available.
+
+    Args:
+        post_img: posted image
+        post_img_path: path of the posted image file
+        place: iqdb place, see `iqdb_url_dict`
+        browser: browser instance
+        img_alt_tags: create tags from match image alt text
+        use_negative_cache: skip image which recently have no match or failed to be searched
+        response_archive: archive iqdb result page
+        rate_limiter: limit iqdb request rate per host
+
+    Returns:
+        matching items
+    """
+    url, im_place = iqdb_url_dict[place]
+    result = models.get_image_matches(post_img, im_place)
+    if result:
+        return result
+
+    negative_key = models.NegativeResult.get_key(post_img.checksum, im_place)
+    if use_negative_cache and models.NegativeResult.get_unexpired(negative_key) is not None:
+        log.debug("negative result cached, image not searched", checksum=post_img.checksum, place=place)
+        return []
+    # identical images searched concurrently share one upload
+    return image_search_flight.do(
+        negative_key, upload_posted_image, post_img, post_img_path, place, browser, img_alt_tags, response_archive, rate_limiter
+    )
+
+
+def upload_posted_image(
+    post_img: models.ImageModel,
+    post_img_path: str,
+    place: str,
+    browser: Optional[mechanicalsoup.StatefulBrowser] = None,
+    img_alt_tags: bool = False,
+    response_archive: Optional[archive.ResponseArchive] = None,
+    rate_limiter: Optional[ratelimit.RateLimiter] = None,
+) -> List[models.ImageMatch]:
+    """Upload posted image to iqdb and save the matches.
+
+    Args:
+        post_img: posted image
+        post_img_path: path of the posted image file
+        place: iqdb place, see `iqdb_url_dict`
+        browser: browser instance
+        img_alt_tags: create tags from match image alt text
+        response_archive: archive iqdb result page
+        rate_limiter: limit iqdb request rate per host
+
+    Returns:
+        matching items
+    """
+    url, im_place = iqdb_url_dict[place]
+    result = models.get_image_matches(post_img, im_place)
+    if result:
+        # searched by previous call with the same key
+        return result
+    negative_key = models.NegativeResult.get_key(post_img.checksum, im_place)
+    use_requests = place != "e621"
+    try:
+        page = models.get_page_result(image=post_img_path, url=url, browser=browser, use_requests=use_requests, rate_limiter=rate_limiter)
+    except requests.exceptions.RequestException:
+        # connection error, timeout and error status
+        models.NegativeResult.add(negative_key, models.NegativeResult.CATEGORY_CONNECTION_ERROR)
+        raise
+    page_soup = BeautifulSoup(page, "lxml")
+    result = list(parse.get_or_create_image_match_from_page(page=page_soup, image=post_img, place=im_place, img_alt_tags=img_alt_tags))
+    result = [x[0] for x in result]
+    update_negative_result(negative_key, page_soup, bool(result))
+    if response_archive is not None:
+        response_archive.add_result_page(post_img.checksum, im_place, page)
+    return result
+
+
+def update_negative_result(negative_key: str, page: BeautifulSoup, has_match: bool) -> None:
+    """Update negative result of searched image from iqdb result page.
+
+    No match is only recorded when iqdb tell so, any other page without match, e.g. error or rate limit page,
+    is recorded as search error with short time to live and raised.
+
+    Args:
+        negative_key: negative result key of searched image
+        page: iqdb result page
+        has_match: the page have match
+    """
+    if has_match:
+        models.NegativeResult.remove(negative_key)
+    elif parse.is_no_match_page(page):
+        models.NegativeResult.add(negative_key, models.NegativeResult.CATEGORY_NO_MATCH)
+    else:
+        models.NegativeResult.add(negative_key, models.NegativeResult.CATEGORY_SEARCH_ERROR)
+        raise ValueError("Unexpected iqdb result page without match: {}".format(page.text.strip()[:200]))
+
+
 def get_result_on_windows(
     image: str,
     place: str,
     resize: Optional[bool] = False,
     size: Optional[Tuple[int, int]] = None,
     browser: Optional[mechanicalsoup.StatefulBrowser] = None,
+    img_alt_tags: bool = False,
+    use_negative_cache: bool = True,
+    response_archive: Optional[archive.ResponseArchive] = None,
+    rate_limiter: Optional[ratelimit.RateLimiter] = None,
 ) -> List[models.ImageMatch]:
     """Get result on Windows.
 
@@ -84,6 +259,10 @@ def get_result_on_windows(
         resize: resize the image
         size: resized image size
         browser: browser instance
+        img_alt_tags: create tags from match image alt text
+        use_negative_cache: skip image which recently have no match or failed to be searched
+        response_archive: archive iqdb result page
+        rate_limiter: limit iqdb request rate per host
 
     Returns:
         matching items
@@ -101,21 +280,11 @@ def get_result_on_windows(
             post_img = models.get_posted_image(img_path=temp_f.name, resize=resize, size=size, thumb_path=thumb_temp_f.name)
         except OSError as e:
             raise OSError(str(e) + " when processing {}".format(image)) from e
-        # append data to result
-        for img_m_rel_set in post_img.imagematchrelationship_set:
-            for item_set in img_m_rel_set.imagematch_set:
-                if item_set.search_place_verbose == place:
-                    result.append(item_set)
-
-        if not result:
-            url, im_place = iqdb_url_dict[place]
-            use_requests = place != "e621"
-            post_img_path = temp_f.name if not resize else thumb_temp_f.name
-            page = models.get_page_result(image=post_img_path, url=url, browser=browser, use_requests=use_requests)
-            # if ok, will output: <Response [200]>
-            page_soup = BeautifulSoup(page, "lxml")
-            result = list(parse.get_or_create_image_match_from_page(page=page_soup, image=post_img, place=im_place))
-            result = [x[0] for x in result]
+        post_img_path = temp_f.name if not resize else thumb_temp_f.name
+        result = search_posted_image(
+            post_img, post_img_path, place, browser, img_alt_tags, use_negative_cache, response_archive, rate_limiter
+        )
+    models.clear_temp_paths([temp_file_name, thumb_temp_file_name])
     for item in [temp_file_name, thumb_temp_file_name]:
         try:
             os.remove(item)
@@ -124,6 +293,250 @@ def get_result_on_windows(
     return result
 
 
+def search_image(
+    image: str,
+    resize: bool = False,
+    size: Optional[Tuple[int, int]] = None,
+    place: str = DEFAULT_PLACE,
+    browser: Optional[mechanicalsoup.StatefulBrowser] = None,
+    img_alt_tags: bool = False,
+    use_negative_cache: bool = True,
+    response_archive: Optional[archive.ResponseArchive] = None,
+    rate_limiter: Optional[ratelimit.RateLimiter] = None,
+    posted_checksum: Optional[str] = None,
+) -> Tuple[List[models.ImageMatch], Optional[str]]:
+    """Search image on iqdb.
+
+    Args:
+        image: image path or url
+        resize: resize the image
+        size: resized image size
+        place: iqdb place, see `iqdb_url_dict`
+        browser: mechanicalsoup browser instance
+        img_alt_tags: create tags from match image alt text
+        use_negative_cache: skip image which recently have no match or failed to be searched
+        response_archive: archive iqdb result page
+        rate_limiter: limit iqdb request rate per host
+        posted_checksum: checksum of posted image from previous run, used to skip copying and hashing the image
+
+    Returns:
+        matching items and posted image checksum
+    """
+    posted_img = models.ImageModel.get_or_none(models.ImageModel.checksum == posted_checksum) if posted_checksum else None
+    if posted_img is not None:
+        im_place = iqdb_url_dict[place][1]
+        result = models.get_image_matches(posted_img, im_place)
+        if result:
+            log.debug("use result from posted image", checksum=posted_img.checksum)
+            return result, posted_img.checksum
+        negative_key = models.NegativeResult.get_key(posted_img.checksum, im_place)
+        if use_negative_cache and models.NegativeResult.get_unexpired(negative_key) is not None:
+            log.debug("negative result cached, posted image not searched", checksum=posted_img.checksum, place=place)
+            return [], posted_img.checksum
+    if is_url(image):
+        return search_image_url(
+            image,
+            resize=resize,
+            size=size,
+            place=place,
+            browser=browser,
+            img_alt_tags=img_alt_tags,
+            use_negative_cache=use_negative_cache,
+            response_archive=response_archive,
+            rate_limiter=rate_limiter,
+        )
+    if platform.system() == "Windows":
+        result = get_result_on_windows(
+            image,
+            place,
+            resize=resize,
+            size=size,
+            browser=browser,
+            img_alt_tags=img_alt_tags,
+            use_negative_cache=use_negative_cache,
+            response_archive=response_archive,
+            rate_limiter=rate_limiter,
+        )
+        return result, result[0].match.image.checksum if result else None
+    with NamedTemporaryFile(delete=False) as temp, NamedTemporaryFile(delete=False) as thumb_temp:
+        pass
+    try:
+        shutil.copyfile(image, temp.name)
+        try:
+            post_img = models.get_posted_image(
+                img_path=temp.name,
+                resize=resize,
+                size=size,
+                thumb_path=thumb_temp.name,
+            )
+        except OSError as e:
+            raise OSError(str(e) + " when processing {}".format(image)) from e
+        post_img_path = temp.name if not resize else thumb_temp.name
+        result = search_posted_image(
+            post_img, post_img_path, place, browser, img_alt_tags, use_negative_cache, response_archive, rate_limiter
+        )
+    finally:
+        models.clear_temp_paths([temp.name, thumb_temp.name])
+        for item in [temp.name, thumb_temp.name]:
+            try:
+                os.remove(item)
+            except Exception:  # pylint: disable=broad-except
+                log.exception("error removing {}".format(item))
+    return result, post_img.checksum
+
+
+def is_url(image: str) -> bool:
+    """Check if image is given as http url instead of path."""
+    return urlparse(image).scheme in ("http", "https")
+
+
+def search_image_url(
+    image_url: str,
+    resize: bool = False,
+    size: Optional[Tuple[int, int]] = None,
+    place: str = DEFAULT_PLACE,
+    browser: Optional[mechanicalsoup.StatefulBrowser] = None,
+    img_alt_tags: bool = False,
+    use_negative_cache: bool = True,
+    response_archive: Optional[archive.ResponseArchive] = None,
+    rate_limiter: Optional[ratelimit.RateLimiter] = None,
+    check_url: Optional[Callable[[str], bool]] = None,
+) -> Tuple[List[models.ImageMatch], Optional[str]]:
+    """Search image url on iqdb, iqdb fetch the image itself.
+
+    Args:
+        image_url: image url
+        resize: resize the image when it have to be downloaded and uploaded
+        size: resized image size
+        place: iqdb place, see `iqdb_url_dict`
+        browser: browser instance
+        img_alt_tags: create tags from match image alt text
+        use_negative_cache: skip url which recently have no match or failed to be searched
+        response_archive: archive iqdb result page
+        rate_limiter: limit iqdb request rate per host
+        check_url: check image url and its redirects before it is downloaded, see `models.download_url`
+
+    Returns:
+        matching items and posted image checksum
+    """
+    im_place = iqdb_url_dict[place][1]
+    for posted_img in models.ImageModel.select().where(models.ImageModel.path == image_url):
+        result = models.get_image_matches(posted_img, im_place)
+        if result:
+            return result, posted_img.checksum
+    negative_key = models.NegativeResult.get_key(image_url, im_place)
+    if use_negative_cache and models.NegativeResult.get_unexpired(negative_key) is not None:
+        log.debug("negative result cached, url not searched", url=image_url, place=place)
+        return [], None
+    return image_search_flight.do(
+        negative_key,
+        submit_image_url,
+        image_url,
+        resize,
+        size,
+        place,
+        browser,
+        img_alt_tags,
+        use_negative_cache,
+        response_archive,
+        rate_limiter,
+        check_url,
+    )
+
+
+def submit_image_url(  # pylint: disable=too-many-arguments
+    image_url: str,
+    resize: bool = False,
+    size: Optional[Tuple[int, int]] = None,
+    place: str = DEFAULT_PLACE,
+    browser: Optional[mechanicalsoup.StatefulBrowser] = None,
+    img_alt_tags: bool = False,
+    use_negative_cache: bool = True,
+    response_archive: Optional[archive.ResponseArchive] = None,
+    rate_limiter: Optional[ratelimit.RateLimiter] = None,
+    check_url: Optional[Callable[[str], bool]] = None,
+) -> Tuple[List[models.ImageMatch], Optional[str]]:
+    """Submit image url to iqdb and save the matches.
+
+    The thumbnail returned by iqdb is used as posted image.
+    When iqdb can't fetch the url, the image is downloaded and uploaded instead.
+
+    Returns:
+        matching items and posted image checksum
+    """
+    url, im_place = iqdb_url_dict[place]
+    negative_key = models.NegativeResult.get_key(image_url, im_place)
+    try:
+        page = models.get_page_result(
+            image=None, url=url, browser=browser, use_requests=place != "e621", image_url=image_url, rate_limiter=rate_limiter
+        )
+    except requests.exceptions.RequestException:
+        # connection error, timeout and error status
+        models.NegativeResult.add(negative_key, models.NegativeResult.CATEGORY_CONNECTION_ERROR)
+        raise
+    page_soup = BeautifulSoup(page, "lxml")
+    thumb_src = parse.get_posted_image_thumb(page_soup)
+    if thumb_src is None:
+        log.debug("iqdb can't fetch the url, upload the image", url=image_url)
+        return download_and_search_image(
+            image_url, resize, size, place, browser, img_alt_tags, use_negative_cache, response_archive, rate_limiter, check_url
+        )
+    post_img = models.get_posted_image_from_thumb_url(urljoin(url, thumb_src), image_url)
+    result = list(parse.get_or_create_image_match_from_page(page=page_soup, image=post_img, place=im_place, img_alt_tags=img_alt_tags))
+    result = [x[0] for x in result]
+    update_negative_result(negative_key, page_soup, bool(result))
+    if response_archive is not None:
+        response_archive.add_result_page(post_img.checksum, im_place, page)
+    return result, post_img.checksum
+
+
+def download_and_search_image(  # pylint: disable=too-many-arguments
+    image_url: str,
+    resize: bool = False,
+    size: Optional[Tuple[int, int]] = None,
+    place: str = DEFAULT_PLACE,
+    browser: Optional[mechanicalsoup.StatefulBrowser] = None,
+    img_alt_tags: bool = False,
+    use_negative_cache: bool = True,
+    response_archive: Optional[archive.ResponseArchive] = None,
+    rate_limiter: Optional[ratelimit.RateLimiter] = None,
+    check_url: Optional[Callable[[str], bool]] = None,
+) -> Tuple[List[models.ImageMatch], Optional[str]]:
+    """Download image from url and upload it to iqdb.
+
+    The url is linked to the posted image and its negative result, so `search_image_url` find it in database next time.
+
+    Returns:
+        matching items and posted image checksum
+    """
+    if rate_limiter is not None:
+        rate_limiter.wait(urlparse(image_url).netloc)
+    with NamedTemporaryFile(delete=False) as f:
+        try:
+            models.download_url(image_url, f, check_url=check_url)
+        except Exception:
+            os.remove(f.name)
+            raise
+    try:
+        result, posted_checksum = search_image(
+            f.name, resize, size, place, browser, img_alt_tags, use_negative_cache, response_archive, rate_limiter=rate_limiter
+        )
+    finally:
+        os.remove(f.name)
+    if posted_checksum is None:
+        return result, posted_checksum
+    # path of posted image from temporary file is cleared, keep the image url instead
+    models.ImageModel.update(path=image_url).where(
+        models.ImageModel.checksum == posted_checksum, models.ImageModel.path.is_null()
+    ).execute()
+    if not result:
+        im_place = iqdb_url_dict[place][1]
+        negative = models.NegativeResult.get_unexpired(models.NegativeResult.get_key(posted_checksum, im_place))
+        if negative is not None:
+            models.NegativeResult.add(models.NegativeResult.get_key(image_url, im_place), negative.category)
+    return result, posted_checksum
+
+
 def run_program_for_single_img(  # pylint: disable=too-many-branches, too-many-statements
     image: str,
     resize: bool = False,
@@ -136,11 +549,17 @@ def run_program_for_single_img(  # pylint: disable=too-many-branches, too-many-s
     write_tags: Optional[bool] = False,
     write_url: Optional[bool] = False,
     minimum_similarity: Optional[int] = None,
+    img_alt_tags: bool = False,
+    use_negative_cache: bool = True,
+    response_archive: Optional[archive.ResponseArchive] = None,
+    rate_limiter: Optional[ratelimit.RateLimiter] = None,
+    posted_checksum: Optional[str] = None,
+    on_searched: Optional[Callable[[str], None]] = None,
 ) -> Dict[str, Any]:
     """Run program for single image.
 
     Args:
-        image: image path
+        image: image path or url
         resize: resize the image
         size: resized image size
         place: iqdb place, see `iqdb_url_dict`
@@ -151,47 +570,41 @@ def run_program_for_single_img(  # pylint: disable=too-many-branches, too-many-s
         write_tags: write tags as hydrus tag file
         write_url: write matching items' url to file
         minimum_similarity: filter result items with minimum similarity
+        img_alt_tags: use tags from match image alt text and only fetch tag page when there is none
+        use_negative_cache: skip image and tag page which recently have no result or failed
+        response_archive: archive iqdb result page
+        rate_limiter: limit iqdb request rate per host
+        posted_checksum: checksum of posted image from previous run, used to skip copying and hashing the image
+        on_searched: called with posted image checksum after the image is searched
 
     Returns:
-        iqdb result and collected errors
+        iqdb result, posted image checksum and collected errors
     """
     # compatibility
     br = browser  # type: ignore
 
     error_set = []  # List[Exception]
-    tag_textfile = image + ".txt"
-    folder = os.path.dirname(image)
-    result = []  # type: List[models.ImageMatch]
-
-    if platform.system() == "Windows":
-        result = get_result_on_windows(image, place, resize=resize, size=size, browser=br)
+    if is_url(image):
+        # write text file in working directory
+        tag_textfile = (os.path.basename(urlparse(image).path) or urlparse(image).netloc) + ".txt"
+        folder = None
     else:
-        with NamedTemporaryFile(delete=False) as temp, NamedTemporaryFile(delete=False) as thumb_temp:
-            shutil.copyfile(image, temp.name)
-            try:
-                post_img = models.get_posted_image(
-                    img_path=temp.name,
-                    resize=resize,
-                    size=size,
-                    thumb_path=thumb_temp.name,
-                )
-            except OSError as e:
-                raise OSError(str(e) + " when processing {}".format(image)) from e
-
-            for img_m_rel_set in post_img.imagematchrelationship_set:
-                for item_set in img_m_rel_set.imagematch_set:
-                    if item_set.search_place_verbose == place:
-                        result.append(item_set)
-
-            if not result:
-                url, im_place = iqdb_url_dict[place]
-                use_requests = place != "e621"
-                post_img_path = temp.name if not resize else thumb_temp.name
-                page = models.get_page_result(image=post_img_path, url=url, browser=br, use_requests=use_requests)
-                # if ok, will output: <Response [200]>
-                page_soup = BeautifulSoup(page, "lxml")
-                result = list(parse.get_or_create_image_match_from_page(page=page_soup, image=post_img, place=im_place))
-                result = [x[0] for x in result]
+        tag_textfile = image + ".txt"
+        folder = os.path.dirname(image)
+    result, checksum = search_image(
+        image,
+        resize=resize,
+        size=size,
+        place=place,
+        browser=br,
+        img_alt_tags=img_alt_tags,
+        use_negative_cache=use_negative_cache,
+        response_archive=response_archive,
+        posted_checksum=posted_checksum,
+        rate_limiter=rate_limiter,
+    )
+    if on_searched is not None and checksum is not None:
+        on_searched(checksum)
 
     if match_filter == "best-match":
         result = [x for x in result if x.status == x.STATUS_BEST_MATCH]
@@ -207,7 +620,9 @@ def run_program_for_single_img(  # pylint: disable=too-many-branches, too-many-s
         log.debug("url", v=url)
 
         try:
-            tags = models.get_tags_from_match_result(match_result, browser, scraper)
+            tags = models.get_tags_from_match_result(
+                match_result, browser, scraper, use_img_alt=img_alt_tags, use_negative_cache=use_negative_cache
+            )
             tags_verbose = [x.full_name for x in tags]
             match_result_tag_pairs.append((match_result, tags))
             log.debug("{} tag(s) founds".format(len(tags_verbose)))
@@ -225,12 +640,36 @@ def run_program_for_single_img(  # pylint: disable=too-many-branches, too-many-s
             log.error("Error", e=str(e))
             error_set.append(e)
 
-    return {"error": error_set, "match result tag pairs": match_result_tag_pairs}
+    return {"error": error_set, "match result tag pairs": match_result_tag_pairs, "checksum": checksum}
+
+
+def send_thumbnail(folder: str, basename: str) -> Any:
+    """Send content-addressed thumbnail with long-lived cache headers.
+
+    The file name (checksum and size) is used as ETag, so conditional request get 304 response.
+    """
+    resp = send_from_directory(folder, basename)
+    resp.set_etag(os.path.splitext(os.path.basename(basename))[0])
+    resp.headers["Cache-Control"] = thumbnail.CACHE_CONTROL
+    return resp.make_conditional(request)
 
 
 def thumb(basename: str) -> Any:
     """Get thumbnail."""
-    return send_from_directory(thumb_folder, basename)
+    return send_thumbnail(thumb_folder, basename)
+
+
+def resized_thumb(checksum: str, width: int, height: int) -> Any:
+    """Get image resized to fit the size, resized on demand."""
+    if not (0 < width <= thumbnail.MAX_SIZE and 0 < height <= thumbnail.MAX_SIZE):
+        abort(404)
+    image = models.ImageModel.get_or_none(models.ImageModel.checksum == checksum)
+    if image is None:
+        abort(404)
+    path = current_app.extensions["iqdb_tagger_resize_cache"].get(image, (width, height))
+    if path is None:
+        abort(404)
+    return send_thumbnail(os.path.dirname(path), os.path.basename(path))
 
 
 def create_app(script_info: Optional[Any] = None) -> Any:
@@ -269,11 +708,21 @@ def create_app(script_info: Optional[Any] = None) -> Any:
         print("Log file: {}".format(default_log_file))
         print("script info:{}".format(script_info))
     db_path = os.getenv("IQDB_TAGGER_DB_PATH") or default_db_path
-    init_program()
-    models.init_db(db_path)
+    # sqlite connections are pooled, database url can use pool scheme, e.g. postgresql+pool://
+    init_program(db_path, db_url=os.getenv("IQDB_TAGGER_DB_URL"), pool=True)
     # app and db
     app.app_context().push()
 
+    @app.before_request
+    def db_connect() -> None:  # pylint: disable=unused-variable
+        models.db.connect(reuse_if_open=True)
+
+    @app.teardown_request
+    def db_close(_: Optional[BaseException]) -> None:  # pylint: disable=unused-variable
+        # return connection to the pool
+        if not models.db.is_closed():
+            models.db.close()
+
     @app.shell_context_processor
     def shell_context() -> Dict["str", Any]:  # pylint: disable=unused-variable
         return {"app": app}
@@ -281,6 +730,22 @@ def create_app(script_info: Optional[Any] = None) -> Any:
     # api
     api = Api(app)
     api.add_resource(views.MatchViewList, "/api/matchview")
+    api.add_resource(views.JobResource, "/api/job/<job_id>")
+    # background job for search
+    # job status is kept in database, so it can be polled from any worker process
+    app.extensions["iqdb_tagger_jobs"] = jobs.DatabaseJobQueue(int(os.getenv("IQDB_TAGGER_WORKERS") or jobs.DEFAULT_MAX_WORKERS))
+    # tags of new matches fetched in background
+    tag_workers = int(os.getenv("IQDB_TAGGER_TAG_WORKERS") or tag_prefetch.DEFAULT_MAX_WORKERS)
+    app.extensions["iqdb_tagger_tag_prefetcher"] = tag_prefetch.TagPrefetcher(tag_workers)
+    # resized image of uploaded file is kept as thumbnail
+    app.config["IQDB_TAGGER_THUMB_FOLDER"] = thumb_folder
+    # url search shared with command line, views can't import this module
+    app.extensions["iqdb_tagger_search_image_url"] = search_image_url
+    # image resized on demand
+    resize_cache_size = int(os.getenv("IQDB_TAGGER_RESIZE_CACHE_SIZE") or thumbnail.DEFAULT_MAX_FILES)
+    app.extensions["iqdb_tagger_resize_cache"] = thumbnail.ResizeCache(resize_cache_folder, resize_cache_size)
+    # rendered match page, disabled by default
+    app.extensions["iqdb_tagger_page_cache"] = lru.LRUCache(int(os.getenv("IQDB_TAGGER_PAGE_CACHE_SIZE") or 0))
     # flask-admin
     app_admin = Admin(
         app,
@@ -289,12 +754,14 @@ def create_app(script_info: Optional[Any] = None) -> Any:
         index_view=views.HomeView(name="Home", template="iqdb_tagger/index.html", url="/"),
     )
     app_admin.add_view(views.MatchView())
+    app_admin.add_view(views.JobView(endpoint="job", url="/job"))
     # app_admin.add_view(ModelView(ImageMatch, category='DB'))
     # app_admin.add_view(ModelView(ImageMatchRelationship, category='DB'))
     # app_admin.add_view(ModelView(ImageModel, category='DB'))
     # app_admin.add_view(ModelView(MatchTagRelationship, category='DB'))
     # routing
     app.add_url_rule("/thumb/<path:basename>", view_func=thumb)
+    app.add_url_rule("/resized/<checksum>/<int:width>x<int:height>.jpg", view_func=resized_thumb)
     return app
 
 
@@ -345,6 +812,7 @@ def cli() -> None:
 @click.option("--resize", is_flag=True, help="Use resized image.")
 @click.option("--size", help="Specify resized image, format: 'w,h'.")
 @click.option("--db-path", help="Specify Database path.")
+@click.option("--db-url", envvar="IQDB_TAGGER_DB_URL", help="Specify database url instead of path, e.g. postgresql://host/iqdb.")
 @click.option(
     "--match-filter",
     type=click.Choice(["default", "best-match"]),
@@ -353,12 +821,22 @@ def cli() -> None:
 )
 @click.option("--write-tags", is_flag=True, help="Write best match's tags to text.")
 @click.option("--write-url", is_flag=True, help="Write match url to text.")
+@click.option("--img-alt-tags", is_flag=True, help="Use tags from iqdb image alt text, fetch tag page only when there is none.")
 @click.option(
     "--input-mode",
-    type=click.Choice(["default", "folder"]),
+    type=click.Choice(["default", "folder", "url"]),
     default="default",
-    help="Set input mode.",
+    help="Set input mode, url mode accept image url or text file with one url per line.",
 )
+@click.option("--http-cache", "use_http_cache", is_flag=True, help="Cache tag page responses on disk.")
+@click.option("--http-cache-ttl", type=int, default=http_cache.DEFAULT_TTL, help="Seconds before cached response is revalidated.")
+@click.option("--http-cache-size", type=int, default=http_cache.DEFAULT_MAX_SIZE_MB, help="Maximum http cache size in MB.")
+@click.option("--no-negative-cache", is_flag=True, help="Retry image and tag page which recently have no result or failed.")
+@click.option("--archive", "use_archive", is_flag=True, help="Archive iqdb result page for reparse command.")
+@click.option("--archive-tag-pages", is_flag=True, help="Also archive tag page.")
+@click.option("--journal", "journal_path", help="Specify job journal path for folder and url input mode.")
+@click.option("--resume", is_flag=True, help="Resume folder or url input mode from the job journal.")
+@click.option("--jobs", "-j", type=click.IntRange(min=1), default=1, help="Number of images searched concurrently in batch input mode.")
 @click.option("--verbose", "-v", is_flag=True, help="Verbose output.")
 @click.option("--debug", "-d", is_flag=True, help="Print debug output.")
 @click.option("--abort-on-error", is_flag=True, help="Stop program when error occured")  # pylint: disable=too-many-branches
@@ -368,6 +846,7 @@ def cli_run(
     resize: bool = False,
     size: Optional[str] = None,
     db_path: str = default_db_path,
+    db_url: Optional[str] = None,
     place: str = DEFAULT_PLACE,
     match_filter: str = "default",
     input_mode: str = "default",
@@ -377,6 +856,16 @@ def cli_run(
     write_tags: bool = False,
     write_url: bool = False,
     minimum_similarity: bool = None,
+    img_alt_tags: bool = False,
+    use_http_cache: bool = False,
+    http_cache_ttl: int = http_cache.DEFAULT_TTL,
+    http_cache_size: int = http_cache.DEFAULT_MAX_SIZE_MB,
+    no_negative_cache: bool = False,
+    use_archive: bool = False,
+    archive_tag_pages: bool = False,
+    journal_path: Optional[str] = None,
+    resume: bool = False,
+    jobs: int = 1,
 ) -> None:
     """Get similar image from iqdb."""
     assert prog_input is not None, "Input is not a valid path"
@@ -394,26 +883,56 @@ def cli_run(
             level=log_level,
         )
 
-    init_program(db_path)
-    br = mechanicalsoup.StatefulBrowser(soup_config={"features": "lxml"})
-    br.raise_on_404 = True
-    scraper = cfscrape.CloudflareScraper()
+    init_program(db_path, db_url)
+    response_archive = archive.ResponseArchive() if use_archive or archive_tag_pages else None
+    response_cache = http_cache.ResponseCache(ttl=http_cache_ttl, max_size=http_cache_size * 1024 * 1024) if use_http_cache else None
+    br, scraper = init_browser_and_scraper(response_cache, response_archive if archive_tag_pages else None)
 
     # variable used in both input mode
     error_set = []
     size_tuple: Optional[Tuple[int, int]] = None
     if size is not None:
         size_tuple = tuple(map(int, size.split(",", 1)))  # type: ignore
-    if input_mode == "folder":
-        assert os.path.isdir(prog_input), "Input is not valid folder"
-        files = [os.path.join(prog_input, x) for x in os.listdir(prog_input)]
+    if input_mode == "url" and is_url(prog_input):
+        input_mode = "default"
+    if input_mode in ("folder", "url"):
+        if input_mode == "folder":
+            assert os.path.isdir(prog_input), "Input is not valid folder"
+            files = [os.path.join(prog_input, x) for x in os.listdir(prog_input)]
+            sorted_files = sorted(files, key=lambda x: os.path.splitext(x)[1])
+        else:
+            assert os.path.isfile(prog_input), "Input is not valid url or url list file"
+            with open(prog_input) as f:
+                files = list(dict.fromkeys(x.strip() for x in f if is_url(x.strip())))
+            sorted_files = files
         if not files:
             print("No files found.")
             return
-        sorted_files = sorted(files, key=lambda x: os.path.splitext(x)[1])
-        for idx, ff in enumerate(sorted_files):
+        if journal_path is None:
+            journal_path = journal.get_default_journal_path("cli-run {} {}".format(os.path.abspath(prog_input), place))
+        thread_data = threading.local()
+
+        def process_file(idx: int, ff: str) -> List[Tuple[str, Any]]:
+            if jobs == 1:
+                file_br, file_scraper = br, scraper
+            else:
+                if not hasattr(thread_data, "browser"):
+                    thread_data.browser, thread_data.scraper = init_browser_and_scraper(
+                        response_cache, response_archive if archive_tag_pages else None
+                    )
+                file_br, file_scraper = thread_data.browser, thread_data.scraper
+            file_state = {}  # type: Dict[str, Any]
+            if input_mode == "folder":
+                stat = os.stat(ff)
+                file_state = {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+            entry = job_journal.get(ff)
+            if entry is not None and any(entry.get(key) != value for key, value in file_state.items()):
+                # file changed after it was recorded
+                entry = None
+            if entry is not None and entry["stage"] == journal.STAGE_DONE:
+                log.debug("skip finished file", f=os.path.basename(ff), idx=idx, total=len(files))
+                return []
             log.debug("file", f=os.path.basename(ff), idx=idx, total=len(files))
-            result = {}
             try:
                 result = run_program_for_single_img(
                     ff,
@@ -421,19 +940,35 @@ def cli_run(
                     size_tuple,
                     place,
                     match_filter,
-                    browser=br,
-                    scraper=scraper,
+                    browser=file_br,
+                    scraper=file_scraper,
                     disable_tag_print=True,
                     write_tags=write_tags,
                     write_url=write_url,
                     minimum_similarity=minimum_similarity,
+                    img_alt_tags=img_alt_tags,
+                    use_negative_cache=not no_negative_cache,
+                    response_archive=response_archive,
+                    posted_checksum=entry.get("checksum") if entry is not None else None,
+                    on_searched=lambda checksum: job_journal.record(ff, journal.STAGE_SEARCHED, checksum=checksum, **file_state),
                 )
             except Exception as e:  # pylint:disable=broad-except
                 if abort_on_error:
                     raise e
-                error_set.append((ff, e))
+                return [(ff, e)]
             if result is not None and result.get("error"):
-                error_set.extend([(ff, x) for x in result["error"]])
+                return [(ff, x) for x in result["error"]]
+            job_journal.record(ff, journal.STAGE_DONE, checksum=result.get("checksum"), **file_state)
+            return []
+
+        with journal.Journal(journal_path, resume=resume) as job_journal:
+            if jobs == 1:
+                for idx, ff in enumerate(sorted_files):
+                    error_set.extend(process_file(idx, ff))
+            else:
+                with ThreadPoolExecutor(max_workers=jobs) as executor:
+                    for file_errors in executor.map(process_file, range(len(sorted_files)), sorted_files):
+                        error_set.extend(file_errors)
     else:
         image = prog_input
         result = run_program_for_single_img(
@@ -447,6 +982,9 @@ def cli_run(
             write_tags=write_tags,
             write_url=write_url,
             minimum_similarity=minimum_similarity,
+            img_alt_tags=img_alt_tags,
+            use_negative_cache=not no_negative_cache,
+            response_archive=response_archive,
         )
         if result is not None and result.get("error"):
             error_set.extend([(image, x) for x in result["error"]])
@@ -457,12 +995,176 @@ def cli_run(
             log.error("path: " + x[0] + "\nerror: " + str(x[1]))
 
 
-def get_hydrus_set(search_tags: List[str], client: Client, resize: bool = True) -> Iterator[Dict[str, Any]]:
+@cli.command()
+@click.option("--db-path", help="Specify Database path.")
+@click.option("--db-url", envvar="IQDB_TAGGER_DB_URL", help="Specify database url instead of path, e.g. postgresql://host/iqdb.")
+@click.option("--archive-folder", help="Specify archive folder.")
+@click.option("--no-tags", is_flag=True, help="Don't rebuild tags from archived tag page.")
+def reparse(
+    db_path: str = default_db_path, db_url: Optional[str] = None, archive_folder: Optional[str] = None, no_tags: bool = False
+) -> None:
+    """Rebuild matches and tags from archived page without network."""
+    init_program(db_path, db_url)
+    response_archive = archive.ResponseArchive(archive_folder)
+    n_page = n_match = 0
+    for checksum, place in response_archive.iter_result_pages():
+        n_page += 1
+        n_match += archive.reparse_result_page(response_archive, checksum, place)
+    print("{} match(es) from {} result page(s)".format(n_match, n_page))
+    if no_tags:
+        return
+    br = mechanicalsoup.StatefulBrowser(soup_config={"features": "lxml"})
+    br.raise_on_404 = True
+    scraper = cfscrape.CloudflareScraper()
+    response_archive.mount_offline(br.session)
+    response_archive.mount_offline(scraper)
+    match_ids = [x.id for x in models.Match.select(models.Match.id, models.Match.href).iterator() if response_archive.has_url_page(x.link)]
+    for match_id in match_ids:
+        match_result = models.Match.get_by_id(match_id)
+        n_tag = archive.reparse_tag_page(response_archive, match_result, br, scraper)
+        log.debug("tag page reparsed", url=match_result.link, n=n_tag)
+    print("{} tag page(s)".format(len(match_ids)))
+
+
+@cli.command()
+@click.option("--db-path", help="Specify Database path.")
+@click.option("--db-url", envvar="IQDB_TAGGER_DB_URL", help="Specify database url instead of path, e.g. postgresql://host/iqdb.")
+@click.option("--since", type=click.DateTime(), help="Only export results since this date, e.g. date of previous snapshot.")
+@click.argument("output", type=click.File("wb"))
+def export_snapshot(output: Any, db_path: str = default_db_path, db_url: Optional[str] = None, since: Optional[Any] = None) -> None:
+    """Export search results as compressed snapshot, use '-' as output for stdout."""
+    log_to_stderr()
+    init_program(db_path, db_url)
+    counts = snapshot.export_snapshot(output, since)
+    click.echo("{} image(s), {} match result(s) exported".format(counts["image"], counts["match"]), err=True)
+
+
+@cli.command()
+@click.option("--db-path", help="Specify Database path.")
+@click.option("--db-url", envvar="IQDB_TAGGER_DB_URL", help="Specify database url instead of path, e.g. postgresql://host/iqdb.")
+@click.argument("snapshot_input", metavar="INPUT", type=click.File("rb"))
+def import_snapshot(snapshot_input: Any, db_path: str = default_db_path, db_url: Optional[str] = None) -> None:
+    """Merge snapshot from other database, use '-' as input for stdin."""
+    init_program(db_path, db_url)
+    counts = snapshot.import_snapshot(snapshot_input)
+    print(
+        "{} image(s), {} match result(s) merged, {} image match(es) and {} tag(s) added".format(
+            counts["image"], counts["match"], counts["image_match"], counts["tag"]
+        )
+    )
+
+
+@cli.command("export")
+@click.option("--db-path", help="Specify Database path.")
+@click.option("--db-url", envvar="IQDB_TAGGER_DB_URL", help="Specify database url instead of path, e.g. postgresql://host/iqdb.")
+@click.option(
+    "--format", "output_format", type=click.Choice(export.FORMATS), default="jsonl", help="Output format, parquet requires pyarrow."
+)
+@click.option("--place", type=click.Choice(iqdb_url_dict.keys()), help="Only export result from this iqdb place.")
+@click.option("--minimum-similarity", type=float, help="Minimum similarity.")
+@click.option("--match-filter", type=click.Choice(["default", "best-match"]), default="default", help="Filter the result.")
+@click.option("--since", type=click.DateTime(), help="Only export result searched since this date.")
+@click.option("--until", type=click.DateTime(), help="Only export result searched before this date.")
+@click.argument("output", type=click.File("wb"))
+def export_results(
+    output: Any,
+    db_path: str = default_db_path,
+    db_url: Optional[str] = None,
+    output_format: str = "jsonl",
+    place: Optional[str] = None,
+    minimum_similarity: Optional[float] = None,
+    match_filter: str = "default",
+    since: Optional[Any] = None,
+    until: Optional[Any] = None,
+) -> None:
+    """Export image matches with their tags, one row per image match, use '-' as output for stdout."""
+    log_to_stderr()
+    init_program(db_path, db_url)
+    rows = export.iter_rows(
+        place=iqdb_url_dict[place][1] if place else None,
+        min_similarity=minimum_similarity,
+        best_match=match_filter == "best-match",
+        since=since,
+        until=until,
+    )
+    try:
+        n_row = export.export_rows(rows, output, output_format)
+    except ImportError as e:
+        raise click.UsageError(str(e)) from e
+    click.echo("{} row(s) exported".format(n_row), err=True)
+
+
+def download_hydrus_thumbnail(
+    client: Client, file_id: Optional[int] = None, min_size: int = HYDRUS_THUMBNAIL_MIN_SIZE, hash_: Optional[str] = None
+) -> Optional[str]:
+    """Download hydrus thumbnail to temporary file.
+
+    Args:
+        client: client instance
+        file_id: hydrus file id
+        min_size: minimum size of the thumbnail longest side
+        hash_: hydrus file hash, used when file id is not given
+
+    Returns:
+        thumbnail path, None if the thumbnail is not available or not suitable for upload
+    """
+    with NamedTemporaryFile(delete=False) as f:
+        try:
+            for chunk in client.get_thumbnail(hash_=hash_, file_id=file_id).iter_content(64 * 1024):
+                f.write(chunk)
+        except (APIError, requests.exceptions.RequestException) as err:
+            log.debug("error downloading hydrus thumbnail", file_id=file_id, hash=hash_, e=str(err))
+            is_suitable = False
+        else:
+            is_suitable = True
+    if is_suitable:
+        try:
+            with Image.open(f.name) as im:
+                is_suitable = max(im.size) >= min_size
+        except OSError:
+            is_suitable = False
+    if is_suitable:
+        return f.name
+    os.remove(f.name)
+    return None
+
+
+def get_hydrus_set(  # pylint: disable=too-many-statements
+    search_tags: List[str],
+    client: Client,
+    resize: bool = True,
+    img_alt_tags: bool = False,
+    init_browser: Optional[Callable[[], Tuple[mechanicalsoup.StatefulBrowser, cfscrape.CloudflareScraper]]] = None,
+    job_journal: Optional[journal.Journal] = None,
+    download_jobs: int = 2,
+    search_jobs: int = 1,
+    tag_jobs: int = 2,
+    queue_size: int = pipeline.DEFAULT_QUEUE_SIZE,
+    metadata_chunk_size: int = 100,
+    metadata_read_ahead: int = 2,
+    hydrus_thumbnail: bool = False,
+    full_metadata: bool = False,
+) -> Iterator[Dict[str, Any]]:
     """Get hydrus result.
 
+    Files are processed by pipeline with download, iqdb search and tag fetch stage,
+    each stage run by its own threads and connected by bounded queues.
+
     Args:
         search_tags: tags used to search hydrus
         client: client instance
+        resize: resize image before upload
+        img_alt_tags: use tags from match image alt text
+        init_browser: function to create browser and scraper for each thread
+        job_journal: skip finished file and record searched file
+        download_jobs: number of concurrent file download
+        search_jobs: number of concurrent iqdb search
+        tag_jobs: number of concurrent tag page fetch
+        queue_size: maximum number of files waiting for each stage
+        metadata_chunk_size: number of file ids for each metadata request
+        metadata_read_ahead: number of metadata chunks fetched ahead
+        hydrus_thumbnail: upload hydrus thumbnail when resizing, download the file only when it is not suitable
+        full_metadata: request full metadata including tags instead of identifiers only
 
     Returns:
         hydrus metadata and iqdb results
@@ -474,35 +1176,125 @@ def get_hydrus_set(search_tags: List[str], client: Client, resize: bool = True)
     if not file_ids:
         print("No File id found.")
         return
-    file_ids_chunks = yield_chunks(file_ids, 100)
-    metadata_sets = []  # type: List[Dict[str, Any]]
-    for file_ids in file_ids_chunks:
-        metadata_sets.extend(cl.file_metadata(file_ids=file_ids, only_identifiers=True))
-    for idx, metadata in enumerate(metadata_sets):
+    thread_data = threading.local()
+
+    def get_browser_and_scraper() -> Tuple[mechanicalsoup.StatefulBrowser, cfscrape.CloudflareScraper]:
+        if not hasattr(thread_data, "browser"):
+            thread_data.browser, thread_data.scraper = init_browser() if init_browser is not None else init_browser_and_scraper()
+        return thread_data.browser, thread_data.scraper
+
+    total = len(file_ids)
+
+    def iter_metadata() -> Iterator[Tuple[int, Dict[str, Any]]]:
+        # next chunk is fetched while the current one is processed
+        # image size is needed to check hydrus thumbnail
+        only_identifiers = not (full_metadata or hydrus_thumbnail and resize)
+        chunks = (cl.file_metadata(file_ids=x, only_identifiers=only_identifiers) for x in yield_chunks(file_ids, metadata_chunk_size))
+        idx = 0
+        for metadata_set in pipeline.read_ahead(chunks, metadata_read_ahead):
+            for metadata in metadata_set:
+                yield idx, metadata
+                idx += 1
+
+    def download(idx_metadata: Tuple[int, Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        idx, metadata = idx_metadata
         f_id, f_hash = metadata["file_id"], metadata["hash"]
-        log.info("Metadata", idx=idx, total=len(metadata_sets), id=f_id, hash=f_hash)
-        f_content = cl.get_file(file_id=f_id).content
-        init_program()
+        entry = job_journal.get(f_hash) if job_journal is not None else None
+        if entry is not None and entry["stage"] == journal.STAGE_DONE:
+            log.debug("skip finished file", idx=idx, total=total, hash=f_hash)
+            return None
+        item = {"metadata": metadata}  # type: Dict[str, Any]
+        log.info("Metadata", idx=idx, total=total, id=f_id, hash=f_hash)
+        # hydrus hash is the image checksum, previous result can be used without downloading the file
+        cached = models.get_cached_image_matches(f_hash, iqdb_url_dict["iqdb"][1], resize=resize)
+        if cached is not None:
+            log.debug("use cached result", hash=f_hash, n=len(cached[0]))
+            item["result"], item["checksum"] = cached
+            return item
+        if hydrus_thumbnail and resize:
+            # small image have small thumbnail
+            file_size = max(metadata.get("width") or 0, metadata.get("height") or 0) or HYDRUS_THUMBNAIL_MIN_SIZE
+            item["path"] = download_hydrus_thumbnail(cl, f_id, min(HYDRUS_THUMBNAIL_MIN_SIZE, file_size))
+            if item["path"] is not None:
+                item["is_hydrus_thumbnail"] = True
+                return item
+            log.debug("hydrus thumbnail is not suitable, download file", hash=f_hash)
         with NamedTemporaryFile(delete=False) as f:
             try:
-                f.write(f_content)
-            except TypeError:
-                f.write(f_content.content)
+                for chunk in cl.get_file(file_id=f_id).iter_content(64 * 1024):
+                    f.write(chunk)
+            except Exception:
+                os.remove(f.name)
+                raise
+        item["path"] = f.name
+        return item
+
+    def remove_temp_file(item: Dict[str, Any]) -> None:
+        # downloaded file which is not searched
+        if item.get("path") and os.path.isfile(item["path"]):
+            os.remove(item["path"])
+
+    failed = []  # type: List[str]
+
+    def report_error(item: Any, err: Exception) -> None:
+        metadata = item[1] if isinstance(item, tuple) else item["metadata"]
+        failed.append(metadata["hash"])
+        log.error("file failed", hash=metadata["hash"], e=str(err))
+
+    def search(item: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        f_hash = item["metadata"]["hash"]
+        if "result" in item:
+            result, checksum = item["result"], item["checksum"]
+        else:
             try:
-                res_set = run_program_for_single_img(
-                    f.name,
+                result, checksum = search_image(
+                    item["path"],
                     resize=resize,
                     place="iqdb",
-                    match_filter="best-match",
-                    disable_tag_print=True,
+                    browser=get_browser_and_scraper()[0],
+                    img_alt_tags=img_alt_tags,
                 )
             except OSError as err:
                 if "can't identify image file" in str(err):
-                    log.error("File is not identified as an image")
+                    log.error("File is not identified as an image", hash=f_hash)
                 else:
-                    log.error(str(err))
+                    log.error(str(err), hash=f_hash)
+                return None
+            finally:
+                remove_temp_file(item)
+            if item.get("is_hydrus_thumbnail") and checksum is not None:
+                metadata = item["metadata"]
+                models.add_posted_thumbnail(f_hash, metadata.get("width"), metadata.get("height"), checksum)
+        if job_journal is not None and checksum is not None:
+            job_journal.record(f_hash, journal.STAGE_SEARCHED, checksum=checksum)
+        return {"metadata": item["metadata"], "result": [x for x in result if x.status == x.STATUS_BEST_MATCH], "checksum": checksum}
+
+    def fetch_tags(item: Dict[str, Any]) -> Dict[str, Any]:
+        browser, scraper = get_browser_and_scraper()
+        error_set = []  # type: List[Exception]
+        match_result_tag_pairs = []  # type: List[Tuple[models.Match, List[models.Tag]]]
+        for image_match in item["result"]:
+            match_result = image_match.match.match_result  # type: models.Match
+            try:
+                tags = models.get_tags_from_match_result(match_result, browser, scraper, use_img_alt=img_alt_tags)
+            except Exception as e:  # pylint:disable=broad-except
+                log.error("Error", e=str(e))
+                error_set.append(e)
                 continue
-            yield {"metadata": metadata, "iqdb_result": res_set}
+            match_result_tag_pairs.append((match_result, tags))
+        iqdb_result = {"error": error_set, "match result tag pairs": match_result_tag_pairs, "checksum": item["checksum"]}
+        return {"metadata": item["metadata"], "iqdb_result": iqdb_result}
+
+    stages = [
+        pipeline.Stage("download", download, download_jobs, on_error=report_error, discard=remove_temp_file),
+        pipeline.Stage("search", search, search_jobs, on_error=report_error),
+        pipeline.Stage("tag", fetch_tags, tag_jobs, on_error=report_error),
+    ]
+    n_done = 0
+    for n_done, res_dict in enumerate(pipeline.Pipeline(stages, queue_size).run(iter_metadata()), 1):
+        log.info("progress", done=n_done, total=total, hash=res_dict["metadata"]["hash"])
+        yield res_dict
+    log.info("finished", done=n_done, failed=len(failed), total=total)
 
 
 @cli.command()
@@ -510,11 +1302,25 @@ def get_hydrus_set(search_tags: List[str], client: Client, resize: bool = True)
 @click.option("--access_key", help="Hydrus access key")
 @click.option("--hydrus_url", help="URL for hydrus client e.g. http://127.0.0.1:45869/")
 @click.option("--no-resize", help="Don't resize image when upload", is_flag=True)
+@click.option("--hydrus-thumbnail", is_flag=True, help="Upload hydrus thumbnail instead of resizing the file.")
+@click.option("--journal", "journal_path", help="Specify job journal path.")
+@click.option("--resume", is_flag=True, help="Resume from the job journal.")
+@click.option("--download-jobs", type=click.IntRange(min=1), default=2, help="Number of concurrent file download.")
+@click.option("--search-jobs", type=click.IntRange(min=1), default=1, help="Number of concurrent iqdb search.")
+@click.option("--db-url", envvar="IQDB_TAGGER_DB_URL", help="Specify database url instead of path, e.g. postgresql://host/iqdb.")
+@click.option("--tag-jobs", type=click.IntRange(min=1), default=2, help="Number of concurrent tag page fetch.")
 def search_hydrus_and_send_url(
     tag: List[str],
     access_key: Optional[str] = None,
     hydrus_url: Optional[str] = "http://127.0.0.1:45869/",
     no_resize: bool = False,
+    hydrus_thumbnail: bool = False,
+    journal_path: Optional[str] = None,
+    resume: bool = False,
+    download_jobs: int = 2,
+    search_jobs: int = 1,
+    db_url: Optional[str] = None,
+    tag_jobs: int = 2,
 ) -> None:
     """Search hydrus and send url."""
     # compatibility
@@ -527,11 +1333,28 @@ def search_hydrus_and_send_url(
     if hydrus_url:
         args.append(hydrus_url)
     cl = Client(*args)
-    for res_dict in get_hydrus_set(search_tags, cl, resize=not no_resize):
-        match_results = [x[0] for x in res_dict["iqdb_result"]["match result tag pairs"]]
-        if match_results:
+    init_program(db_url=db_url)
+    if journal_path is None:
+        journal_path = journal.get_default_journal_path("search-hydrus-and-send-url {}".format(" ".join(search_tags)))
+    with journal.Journal(journal_path, resume=resume) as job_journal:
+        hydrus_set = get_hydrus_set(
+            search_tags,
+            cl,
+            resize=not no_resize,
+            job_journal=job_journal,
+            download_jobs=download_jobs,
+            search_jobs=search_jobs,
+            tag_jobs=tag_jobs,
+            hydrus_thumbnail=hydrus_thumbnail,
+        )
+        writer = hydrus_writer.HydrusWriter(cl)
+        for res_dict in hydrus_set:
+            match_results = [x[0] for x in res_dict["iqdb_result"]["match result tag pairs"]]
             for item in match_results:
-                cl.add_url(item.link)
+                writer.add_url(item.link)
+            # file with tag fetch error is processed again on resume
+            if not res_dict["iqdb_result"]["error"]:
+                job_journal.record(res_dict["metadata"]["hash"], journal.STAGE_DONE)
 
 
 @cli.command()
@@ -540,12 +1363,50 @@ def search_hydrus_and_send_url(
 @click.option("--hydrus_url", help="URL for hydrus client e.g. http://127.0.0.1:45869/")
 @click.option("--tag_repo", help="tag repo name e.g. local tags", default="local tags")
 @click.option("--no-resize", help="Don't resize image when upload", is_flag=True)
+@click.option("--hydrus-thumbnail", is_flag=True, help="Upload hydrus thumbnail instead of resizing the file.")
+@click.option("--img-alt-tags", is_flag=True, help="Use tags from iqdb image alt text, fetch tag page only when there is none.")
+@click.option("--http-cache", "use_http_cache", is_flag=True, help="Cache tag page responses on disk.")
+@click.option("--http-cache-ttl", type=int, default=http_cache.DEFAULT_TTL, help="Seconds before cached response is revalidated.")
+@click.option("--http-cache-size", type=int, default=http_cache.DEFAULT_MAX_SIZE_MB, help="Maximum http cache size in MB.")
+@click.option("--journal", "journal_path", help="Specify job journal path.")
+@click.option("--resume", is_flag=True, help="Resume from the job journal.")
+@click.option("--download-jobs", type=click.IntRange(min=1), default=2, help="Number of concurrent file download.")
+@click.option("--search-jobs", type=click.IntRange(min=1), default=1, help="Number of concurrent iqdb search.")
+@click.option("--db-url", envvar="IQDB_TAGGER_DB_URL", help="Specify database url instead of path, e.g. postgresql://host/iqdb.")
+@click.option("--tag-jobs", type=click.IntRange(min=1), default=2, help="Number of concurrent tag page fetch.")
+@click.option(
+    "--write-batch-size",
+    type=click.IntRange(min=1),
+    default=hydrus_writer.DEFAULT_BATCH_SIZE,
+    help="Number of files which tags are sent together.",
+)
+@click.option(
+    "--write-interval",
+    type=float,
+    default=hydrus_writer.DEFAULT_FLUSH_INTERVAL,
+    help="Maximum seconds before buffered tags are sent.",
+)
+@click.option("--resend-tags", is_flag=True, help="Send all tags, including the ones already in hydrus.")
 def search_hydrus_and_send_tag(
     tag: List[str],
     access_key: Optional[str] = None,
     hydrus_url: Optional[str] = "http://127.0.0.1:45869/",
     tag_repo: Optional[str] = "local tags",
     no_resize: bool = False,
+    hydrus_thumbnail: bool = False,
+    img_alt_tags: bool = False,
+    use_http_cache: bool = False,
+    http_cache_ttl: int = http_cache.DEFAULT_TTL,
+    http_cache_size: int = http_cache.DEFAULT_MAX_SIZE_MB,
+    journal_path: Optional[str] = None,
+    resume: bool = False,
+    download_jobs: int = 2,
+    search_jobs: int = 1,
+    db_url: Optional[str] = None,
+    tag_jobs: int = 2,
+    write_batch_size: int = hydrus_writer.DEFAULT_BATCH_SIZE,
+    write_interval: float = hydrus_writer.DEFAULT_FLUSH_INTERVAL,
+    resend_tags: bool = False,
 ) -> None:
     """Search hydrus and send tag."""
     # compatibility
@@ -558,16 +1419,291 @@ def search_hydrus_and_send_tag(
     if hydrus_url:
         args.append(hydrus_url)
     cl = Client(*args)
-    for res_dict in get_hydrus_set(search_tags, cl, resize=not no_resize):
-        f_hash = res_dict["metadata"]["hash"]
-        tag_sets = [x[1] for x in res_dict["iqdb_result"]["match result tag pairs"]]
-        tags = list(set(sum(tag_sets, [])))
-        full_name_tags = [x.full_name for x in tags]
-        if full_name_tags:
+    init_program(db_url=db_url)
+    response_cache = http_cache.ResponseCache(ttl=http_cache_ttl, max_size=http_cache_size * 1024 * 1024) if use_http_cache else None
+    if journal_path is None:
+        journal_path = journal.get_default_journal_path("search-hydrus-and-send-tag {} {}".format(tag_repo, " ".join(search_tags)))
+    with journal.Journal(journal_path, resume=resume) as job_journal:
+        hydrus_set = get_hydrus_set(
+            search_tags,
+            cl,
+            resize=not no_resize,
+            img_alt_tags=img_alt_tags,
+            init_browser=lambda: init_browser_and_scraper(response_cache),
+            job_journal=job_journal,
+            download_jobs=download_jobs,
+            search_jobs=search_jobs,
+            tag_jobs=tag_jobs,
+            hydrus_thumbnail=hydrus_thumbnail,
+            full_metadata=not resend_tags,
+        )
+        finished_hashes: Set[str] = set()
+
+        def on_flush(hashes: List[str]) -> None:
+            for f_hash in hashes:
+                if f_hash in finished_hashes:
+                    job_journal.record(f_hash, journal.STAGE_DONE)
+
+        with hydrus_writer.HydrusWriter(cl, batch_size=write_batch_size, flush_interval=write_interval, on_flush=on_flush) as writer:
+            for res_dict in hydrus_set:
+                f_hash = res_dict["metadata"]["hash"]
+                tag_sets = [x[1] for x in res_dict["iqdb_result"]["match result tag pairs"]]
+                service_to_tags = {tag_repo: {x.full_name for x in sum(tag_sets, [])}}
+                if not resend_tags:
+                    service_to_tags = hydrus_writer.get_tag_delta(res_dict["metadata"], service_to_tags)
+                if not res_dict["iqdb_result"]["error"]:
+                    finished_hashes.add(f_hash)
+                if any(service_to_tags.values()):
+                    writer.add_tags(f_hash, service_to_tags)
+                elif f_hash in finished_hashes:
+                    job_journal.record(f_hash, journal.STAGE_DONE)
+
+
+def process_work_item(  # pylint: disable=too-many-arguments
+    item: models.WorkItem,
+    client: Optional[Client] = None,
+    tag_repo: str = "local tags",
+    writer: Optional[hydrus_writer.HydrusWriter] = None,
+    hydrus_thumbnail: bool = False,
+    **kwargs: Any,
+) -> Optional[str]:
+    """Search and tag work item.
+
+    Args:
+        item: work item
+        client: hydrus client, required for hydrus item
+        tag_repo: hydrus tag repo where found tags are sent
+        writer: send tags of hydrus item in batches, tags are sent right away when it is not given
+        hydrus_thumbnail: upload hydrus thumbnail when resizing, download the file only when it is not suitable
+        **kwargs: keyword arguments for `run_program_for_single_img`
+
+    Returns:
+        posted image checksum
+    """
+    if item.kind != models.WorkItem.KIND_HYDRUS:
+        result = run_program_for_single_img(item.value, **kwargs)
+    else:
+        assert client is not None, "Hydrus client is required for hydrus item"
+        kwargs.update(disable_tag_print=True, write_tags=False, write_url=False)
+        resize = kwargs.get("resize", False)
+        # hydrus hash is the image checksum, previous result can be used without downloading the file
+        cached = models.get_cached_image_matches(
+            item.value,
+            iqdb_url_dict[kwargs.get("place", DEFAULT_PLACE)][1],
+            resize=resize,
+            size=kwargs.get("size"),
+            use_negative_cache=kwargs.get("use_negative_cache", True),
+        )
+        if cached is not None:
+            log.debug("use cached result", hash=item.value, n=len(cached[0]))
+            result = run_program_for_single_img(item.value, posted_checksum=cached[1], **kwargs)
+        else:
+            result = search_hydrus_file(client, item.value, hydrus_thumbnail and resize, **kwargs)
+        tags = {x.full_name for _, tags in result["match result tag pairs"] for x in tags}
+        if tags:
+            if writer is not None:
+                writer.add_tags(item.value, {tag_repo: tags})
+            else:
+                client.add_tags([item.value], service_to_tags={tag_repo: sorted(tags)})
+    if result["error"]:
+        raise RuntimeError("; ".join(str(x) for x in result["error"]))
+    return result["checksum"]
+
+
+def search_hydrus_file(client: Client, f_hash: str, hydrus_thumbnail: bool = False, **kwargs: Any) -> Dict[str, Any]:
+    """Download hydrus thumbnail or file to temporary file and search it.
+
+    Args:
+        client: hydrus client
+        f_hash: hydrus file hash
+        hydrus_thumbnail: upload hydrus thumbnail, download the file only when it is not suitable
+        **kwargs: keyword arguments for `run_program_for_single_img`
+
+    Returns:
+        result of `run_program_for_single_img`
+    """
+    path = download_hydrus_thumbnail(client, hash_=f_hash) if hydrus_thumbnail else None
+    is_hydrus_thumbnail = path is not None
+    if path is None:
+        with NamedTemporaryFile(delete=False) as f:
             try:
-                cl.add_tags([f_hash], service_to_tags={tag_repo: full_name_tags})
-            except Exception:  # pylint: disable=broad-except
-                traceback.print_exc()
+                for chunk in client.get_file(hash_=f_hash).iter_content(64 * 1024):
+                    f.write(chunk)
+            except Exception:
+                f.close()
+                os.remove(f.name)
+                raise
+        path = f.name
+    try:
+        result = run_program_for_single_img(path, **kwargs)
+    finally:
+        os.remove(path)
+    if is_hydrus_thumbnail and result["checksum"] is not None:
+        models.add_posted_thumbnail(f_hash, None, None, result["checksum"])
+    return result
+
+
+@cli.command()
+@click.option("--db-path", help="Specify Database path.")
+@click.option("--db-url", envvar="IQDB_TAGGER_DB_URL", help="Specify database url instead of path, e.g. postgresql://host/iqdb.")
+@click.option("--queue", "queue_name", default=workqueue.DEFAULT_QUEUE, help="Specify queue name.")
+@click.option("--hydrus", "is_hydrus", is_flag=True, help="Inputs are hydrus file hashes.")
+@click.option("--retry", is_flag=True, help="Queue failed items again.")
+@click.argument("inputs", nargs=-1)
+def submit(
+    inputs: List[str],
+    db_path: str = default_db_path,
+    db_url: Optional[str] = None,
+    queue_name: str = workqueue.DEFAULT_QUEUE,
+    is_hydrus: bool = False,
+    retry: bool = False,
+) -> None:
+    """Add image path, folder, url or hydrus hash to the work queue."""
+    init_program(db_path, db_url)
+    queue = workqueue.WorkQueue(queue_name)
+    values: Dict[str, List[str]] = {}
+    for value in inputs:
+        if is_hydrus:
+            values.setdefault(models.WorkItem.KIND_HYDRUS, []).append(value.lower())
+        elif is_url(value):
+            values.setdefault(models.WorkItem.KIND_URL, []).append(value)
+        elif os.path.isdir(value):
+            folder = os.path.abspath(value)
+            files = sorted(os.path.join(folder, x) for x in os.listdir(folder))
+            values.setdefault(models.WorkItem.KIND_PATH, []).extend(x for x in files if os.path.isfile(x))
+        else:
+            assert os.path.isfile(value), "Input is not valid path, url or hash: {}".format(value)
+            values.setdefault(models.WorkItem.KIND_PATH, []).append(os.path.abspath(value))
+    n_queued = sum(queue.submit(kind, kind_values, retry=retry) for kind, kind_values in values.items())
+    print("{} item(s) queued".format(n_queued))
+    print(", ".join("{}: {}".format(key, value) for key, value in sorted(queue.counts().items())))
+
+
+@cli.command()
+@click.option("--db-path", help="Specify Database path.")
+@click.option("--db-url", envvar="IQDB_TAGGER_DB_URL", help="Specify database url instead of path, e.g. postgresql://host/iqdb.")
+@click.option("--queue", "queue_name", default=workqueue.DEFAULT_QUEUE, help="Specify queue name.")
+@click.option("--lease", type=float, default=workqueue.DEFAULT_LEASE, help="Seconds before unfinished item can be claimed by other worker.")
+@click.option("--max-attempts", type=click.IntRange(min=1), default=workqueue.DEFAULT_MAX_ATTEMPTS, help="Maximum attempts for each item.")
+@click.option("--rate-limit", type=float, default=ratelimit.DEFAULT_INTERVAL, help="Seconds between requests to one host by all workers.")
+@click.option("--resize", is_flag=True, help="Use resized image.")
+@click.option("--size", help="Specify resized image, format: 'w,h'.")
+@click.option(
+    "--place",
+    type=click.Choice(iqdb_url_dict.keys()),
+    default=DEFAULT_PLACE,
+    help="Specify iqdb place, default:{}".format(DEFAULT_PLACE),
+)
+@click.option(
+    "--match-filter",
+    type=click.Choice(["default", "best-match"]),
+    default="default",
+    help="Filter the result.",
+)
+@click.option("--minimum-similarity", type=float, help="Minimum similarity.")
+@click.option("--write-tags", is_flag=True, help="Write best match's tags to text.")
+@click.option("--write-url", is_flag=True, help="Write match url to text.")
+@click.option("--img-alt-tags", is_flag=True, help="Use tags from iqdb image alt text, fetch tag page only when there is none.")
+@click.option("--access_key", help="Hydrus access key")
+@click.option("--hydrus_url", help="URL for hydrus client e.g. http://127.0.0.1:45869/")
+@click.option("--tag_repo", help="tag repo name e.g. local tags", default="local tags")
+@click.option("--hydrus-thumbnail", is_flag=True, help="Upload hydrus thumbnail instead of resizing the file.")
+@click.option(
+    "--write-batch-size",
+    type=click.IntRange(min=1),
+    default=hydrus_writer.DEFAULT_BATCH_SIZE,
+    help="Number of files which tags are sent together.",
+)
+@click.option(
+    "--write-interval",
+    type=float,
+    default=hydrus_writer.DEFAULT_FLUSH_INTERVAL,
+    help="Maximum seconds before buffered tags are sent.",
+)
+@click.option("--poll-interval", type=float, default=5.0, help="Seconds to wait when the queue is empty.")
+@click.option("--exit-when-empty", is_flag=True, help="Stop worker when the queue is empty.")
+def worker(  # pylint: disable=too-many-arguments, too-many-locals
+    db_path: str = default_db_path,
+    db_url: Optional[str] = None,
+    queue_name: str = workqueue.DEFAULT_QUEUE,
+    lease: float = workqueue.DEFAULT_LEASE,
+    max_attempts: int = workqueue.DEFAULT_MAX_ATTEMPTS,
+    rate_limit: float = ratelimit.DEFAULT_INTERVAL,
+    resize: bool = False,
+    size: Optional[str] = None,
+    place: str = DEFAULT_PLACE,
+    match_filter: str = "default",
+    minimum_similarity: Optional[float] = None,
+    write_tags: bool = False,
+    write_url: bool = False,
+    img_alt_tags: bool = False,
+    access_key: Optional[str] = None,
+    hydrus_url: Optional[str] = None,
+    tag_repo: str = "local tags",
+    hydrus_thumbnail: bool = False,
+    write_batch_size: int = hydrus_writer.DEFAULT_BATCH_SIZE,
+    write_interval: float = hydrus_writer.DEFAULT_FLUSH_INTERVAL,
+    poll_interval: float = 5.0,
+    exit_when_empty: bool = False,
+) -> None:
+    """Process items from the work queue, run it on each host to share the work."""
+    init_program(db_path, db_url)
+    queue = workqueue.WorkQueue(queue_name, lease=lease, max_attempts=max_attempts)
+    limiter = ratelimit.RateLimiter(rate_limit)
+    br, scraper = init_browser_and_scraper(rate_limiter=limiter)
+    client = writer = None
+    if access_key:
+        client = Client(*([access_key, hydrus_url] if hydrus_url else [access_key]))
+        writer = hydrus_writer.HydrusWriter(client, batch_size=write_batch_size, flush_interval=write_interval)
+    size_tuple: Optional[Tuple[int, int]] = None
+    if size is not None:
+        size_tuple = tuple(map(int, size.split(",", 1)))  # type: ignore
+    owner = workqueue.get_worker_name()
+    n_done = n_failed = 0
+    try:
+        while True:
+            item = queue.claim(owner)
+            if item is None:
+                if writer is not None:
+                    # don't keep tags in buffer while waiting for new items
+                    writer.flush()
+                if exit_when_empty:
+                    break
+                time.sleep(poll_interval)
+                continue
+            log.info("work item", kind=item.kind, value=item.value, attempts=item.attempts)
+            try:
+                checksum = process_work_item(
+                    item,
+                    client,
+                    tag_repo,
+                    writer=writer,
+                    hydrus_thumbnail=hydrus_thumbnail,
+                    resize=resize,
+                    size=size_tuple,
+                    place=place,
+                    match_filter=match_filter,
+                    browser=br,
+                    scraper=scraper,
+                    disable_tag_print=True,
+                    write_tags=write_tags,
+                    write_url=write_url,
+                    minimum_similarity=minimum_similarity,
+                    img_alt_tags=img_alt_tags,
+                    rate_limiter=limiter,
+                )
+            except Exception as e:  # pylint:disable=broad-except
+                log.exception("work item failed", value=item.value)
+                queue.fail(item, str(e))
+                n_failed += 1
+                continue
+            if not queue.complete(item, checksum):
+                log.warning("work item lease lost", value=item.value)
+            n_done += 1
+    finally:
+        if writer is not None:
+            writer.close()
+    print("{} item(s) done, {} failed".format(n_done, n_failed))
 
 
 if __name__ == "__main__":
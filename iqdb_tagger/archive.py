@@ -0,0 +1,208 @@
+"""archive module."""
+import gzip
+import hashlib
+import os
+import pathlib
+from typing import Any, Iterator, Optional, Tuple
+
+import requests
+import structlog
+from bs4 import BeautifulSoup
+from peewee import JOIN
+from requests.adapters import BaseAdapter
+
+from . import models, parse
+from .utils import archive_folder as default_archive_folder
+
+log = structlog.getLogger()
+
+
+class ResponseArchive:
+    """Compressed archive of raw iqdb result page and tag page.
+
+    iqdb result page is stored by image checksum and iqdb place, tag page by the sha256 of its url.
+    """
+
+    def __init__(self, folder: Optional[str] = None) -> None:
+        """Init method."""
+        self.folder = folder if folder is not None else default_archive_folder
+
+    def get_result_page_path(self, checksum: str, place: int) -> str:
+        """Get path of archived iqdb result page."""
+        return os.path.join(self.folder, "result", str(place), checksum[:2], checksum + ".html.gz")
+
+    def get_url_page_path(self, url: str) -> str:
+        """Get path of archived page from url."""
+        key = hashlib.sha256(url.encode()).hexdigest()
+        return os.path.join(self.folder, "url", key[:2], key + ".html.gz")
+
+    @staticmethod
+    def write(path: str, content: bytes) -> None:
+        """Write compressed content."""
+        pathlib.Path(os.path.dirname(path)).mkdir(parents=True, exist_ok=True)
+        temp_path = path + ".tmp"
+        with gzip.open(temp_path, "wb") as f:
+            f.write(content)
+        os.replace(temp_path, path)
+
+    @staticmethod
+    def read(path: str) -> Optional[bytes]:
+        """Read compressed content."""
+        if not os.path.isfile(path):
+            return None
+        with gzip.open(path, "rb") as f:
+            return f.read()
+
+    def add_result_page(self, checksum: str, place: int, page: Any) -> None:
+        """Add iqdb result page."""
+        self.write(self.get_result_page_path(checksum, place), str(page).encode())
+
+    def get_result_page(self, checksum: str, place: int) -> Optional[bytes]:
+        """Get iqdb result page."""
+        return self.read(self.get_result_page_path(checksum, place))
+
+    def add_url_page(self, url: str, content: bytes) -> None:
+        """Add page from url."""
+        self.write(self.get_url_page_path(url), content)
+
+    def get_url_page(self, url: str) -> Optional[bytes]:
+        """Get page from url."""
+        return self.read(self.get_url_page_path(url))
+
+    def has_url_page(self, url: str) -> bool:
+        """Check if page from url is archived."""
+        return os.path.isfile(self.get_url_page_path(url))
+
+    def iter_result_pages(self) -> Iterator[Tuple[str, int]]:
+        """Iterate checksum and place of archived iqdb result page."""
+        result_folder = pathlib.Path(self.folder, "result")
+        if not result_folder.is_dir():
+            return
+        for path in sorted(result_folder.glob("*/*/*.html.gz")):
+            yield path.name.split(".", 1)[0], int(path.parts[-3])
+
+    def mount(self, session: requests.Session) -> None:
+        """Archive GET responses of the session."""
+        for prefix in ("http://", "https://"):
+            session.mount(prefix, ArchivingAdapter(self, session.get_adapter(prefix)))
+
+    def mount_offline(self, session: requests.Session) -> None:
+        """Serve GET requests of the session from the archive only."""
+        for prefix in ("http://", "https://"):
+            session.mount(prefix, OfflineAdapter(self))
+
+
+class ArchivingAdapter(BaseAdapter):
+    """Transport adapter which archive successful GET responses of the wrapped adapter."""
+
+    def __init__(self, archive: ResponseArchive, adapter: BaseAdapter) -> None:
+        """Init method."""
+        super().__init__()
+        self.archive = archive
+        self.adapter = adapter
+
+    def send(self, request: requests.PreparedRequest, **kwargs: Any) -> requests.Response:  # pylint: disable=arguments-differ
+        """Send request and archive the response."""
+        resp = self.adapter.send(request, **kwargs)
+        if request.method == "GET" and resp.status_code == 200:
+            self.archive.add_url_page(request.url, resp.content)
+        return resp
+
+    def close(self) -> None:
+        """Close wrapped adapter."""
+        self.adapter.close()
+
+
+class OfflineAdapter(BaseAdapter):
+    """Transport adapter which only use archived page."""
+
+    def __init__(self, archive: ResponseArchive) -> None:
+        """Init method."""
+        super().__init__()
+        self.archive = archive
+
+    def send(self, request: requests.PreparedRequest, **kwargs: Any) -> requests.Response:  # pylint: disable=arguments-differ
+        """Send request to the archive."""
+        content = self.archive.get_url_page(request.url) if request.method == "GET" else None
+        if content is None:
+            raise requests.exceptions.ConnectionError("Page is not archived: {}".format(request.url), request=request)
+        resp = requests.Response()
+        resp.status_code = 200
+        resp.reason = "OK"
+        resp.headers["Content-Type"] = "text/html"
+        resp._content = content  # pylint: disable=protected-access
+        resp.url = request.url
+        resp.request = request
+        resp.connection = self
+        return resp
+
+    def close(self) -> None:
+        """Close method."""
+
+
+def reparse_result_page(archive: ResponseArchive, checksum: str, place: int) -> int:
+    """Rebuild image match of image from archived iqdb result page.
+
+    Args:
+        archive: response archive
+        checksum: posted image checksum
+        place: iqdb place
+
+    Returns:
+        number of image match
+    """
+    image = models.ImageModel.get_or_none(models.ImageModel.checksum == checksum)
+    page = archive.get_result_page(checksum, place)
+    if image is None or page is None:
+        log.debug("image or archived page not found", checksum=checksum, place=place)
+        return 0
+    with models.db.atomic():
+        imr_ids = [x.id for x in image.imagematchrelationship_set]
+        had_match = bool(imr_ids)
+        # archived page doesn't tell if the image was searched with force gray, keep it from previous search
+        previous = (
+            models.ImageMatch.select(models.ImageMatch.force_gray)
+            .where(models.ImageMatch.match.in_(imr_ids), models.ImageMatch.search_place == place)
+            .order_by(models.ImageMatch.id.desc())
+            .first()
+        )
+        force_gray = previous.force_gray if previous is not None else False
+        models.ImageMatch.delete().where(models.ImageMatch.match.in_(imr_ids), models.ImageMatch.search_place == place).execute()
+        unused_imr = models.ImageMatchRelationship.select(models.ImageMatchRelationship.id).join(
+            models.ImageMatch, on=(models.ImageMatch.match == models.ImageMatchRelationship.id), join_type=JOIN.LEFT_OUTER
+        )
+        unused_imr = unused_imr.where(models.ImageMatchRelationship.image == image, models.ImageMatch.id.is_null())
+        models.ImageMatchRelationship.delete().where(models.ImageMatchRelationship.id.in_(unused_imr)).execute()
+        if had_match and not image.imagematchrelationship_set.exists():
+            models.Counter.add(models.Counter.IMAGES_WITH_MATCH, -1)
+        page_soup = BeautifulSoup(page, "lxml")
+        result = list(
+            parse.get_or_create_image_match_from_page(page=page_soup, image=image, place=place, force_gray=force_gray, update_match=True)
+        )
+    if result:
+        models.NegativeResult.remove(models.NegativeResult.get_key(checksum, place))
+    return len(result)
+
+
+def reparse_tag_page(archive: ResponseArchive, match_result: models.Match, browser: Any, scraper: Any) -> int:
+    """Rebuild tags of match result from archived tag page.
+
+    Args:
+        archive: response archive
+        match_result: match result
+        browser: browser instance, mounted with offline archive
+        scraper: scraper instance, mounted with offline archive
+
+    Returns:
+        number of tags
+    """
+    if not archive.has_url_page(match_result.link):
+        return 0
+    with models.db.atomic():
+        models.MatchTagRelationship.delete().where(
+            models.MatchTagRelationship.match == match_result,
+            models.MatchTagRelationship.from_img_alt == False,  # NOQA; pylint: disable=singleton-comparison
+        ).execute()
+        models.NegativeResult.remove(match_result.link)
+        tags = models.get_tags_from_match_result(match_result, browser, scraper, use_negative_cache=False)
+    return len(tags)
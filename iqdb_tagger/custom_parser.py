@@ -284,8 +284,9 @@ class E621Parser(CustomParser):
             "tag-type-species": "species",
             "tag-type-general": "",
         }
-        scraper = cfscrape.CloudflareScraper()
-        resp = scraper.get(self.url, timeout=10)
+        if self.scraper is None:
+            self.scraper = cfscrape.CloudflareScraper()
+        resp = self.scraper.get(self.url, timeout=10)
         page = bs4.BeautifulSoup(resp.text, "lxml")
 
         for key, namespace in classname_to_namespace_dict.items():
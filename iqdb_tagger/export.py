@@ -0,0 +1,214 @@
+"""export module."""
+import csv
+import datetime
+import io
+import json
+from typing import Any, BinaryIO, Dict, Iterable, Iterator, List, Optional
+
+from peewee import chunked
+
+from .models import ImageMatch, ImageMatchRelationship, ImageModel, Match, MatchTagRelationship, Tag
+
+FORMATS = ("jsonl", "csv", "parquet")
+COLUMNS = [
+    "checksum",
+    "width",
+    "height",
+    "path",
+    "place",
+    "similarity",
+    "status",
+    "force_gray",
+    "created_date",
+    "href",
+    "rating",
+    "match_width",
+    "match_height",
+    "tags",
+]
+# rows read by each query and written by each parquet row group
+PAGE_SIZE = 5000
+# match ids for each tag query, below sqlite variable limit
+TAG_QUERY_SIZE = 500
+
+
+def iter_rows(
+    place: Optional[int] = None,
+    min_similarity: Optional[float] = None,
+    best_match: bool = False,
+    since: Optional[datetime.datetime] = None,
+    until: Optional[datetime.datetime] = None,
+    page_size: int = PAGE_SIZE,
+) -> Iterator[Dict[str, Any]]:
+    """Iterate image matches with their image, match result and tags, one row per image match.
+
+    Rows are read in pages ordered by image match id, so memory use doesn't depend on the number of rows
+    and no cursor is kept open between pages.
+
+    Args:
+        place: only include image matches from this iqdb place
+        min_similarity: only include image matches with minimum similarity
+        best_match: only include best match
+        since: only include image matches created since this date
+        until: only include image matches created before this date
+        page_size: number of rows read by each query
+
+    Returns:
+        rows with `COLUMNS` keys
+    """
+    query = (
+        ImageMatch.select(
+            ImageMatch.id,
+            ImageModel.checksum,
+            ImageModel.width,
+            ImageModel.height,
+            ImageModel.path,
+            ImageMatch.search_place,
+            ImageMatch.similarity,
+            ImageMatch.status,
+            ImageMatch.force_gray,
+            ImageMatch.created_date,
+            Match.id,
+            Match.href,
+            Match.rating,
+            Match.width,
+            Match.height,
+        )
+        .join(ImageMatchRelationship)
+        .join(ImageModel)
+        .switch(ImageMatchRelationship)
+        .join(Match)
+    )
+    if place is not None:
+        query = query.where(ImageMatch.search_place == place)
+    if min_similarity is not None:
+        query = query.where(ImageMatch.similarity >= min_similarity)
+    if best_match:
+        query = query.where(ImageMatch.status == ImageMatch.STATUS_BEST_MATCH)
+    if since is not None:
+        query = query.where(ImageMatch.created_date >= since)
+    if until is not None:
+        query = query.where(ImageMatch.created_date < until)
+    places = dict(ImageMatch.SP_CHOICES)
+    statuses = dict(ImageMatch.STATUS_CHOICES)
+    last_id = 0
+    while True:
+        page = list(query.where(ImageMatch.id > last_id).order_by(ImageMatch.id).limit(page_size).tuples().iterator())
+        if not page:
+            return
+        last_id = page[-1][0]
+        # tags of the page match results only, so filtered out rows between the page rows are not read
+        tags: Dict[int, List[str]] = {}
+        for match_ids in chunked(sorted({x[10] for x in page}), TAG_QUERY_SIZE):
+            tag_query = (
+                MatchTagRelationship.select(MatchTagRelationship.match, Tag.namespace, Tag.name)
+                .join(Tag)
+                .where(MatchTagRelationship.match.in_(match_ids))
+                .order_by(MatchTagRelationship.id)
+            )
+            for match_id, namespace, name in tag_query.tuples().iterator():
+                tags.setdefault(match_id, []).append(namespace + ":" + name if namespace else name)
+        for row in page:
+            yield {
+                "checksum": row[1],
+                "width": row[2],
+                "height": row[3],
+                "path": row[4],
+                "place": places.get(row[5]),
+                "similarity": row[6],
+                "status": statuses.get(row[7]),
+                "force_gray": row[8],
+                "created_date": row[9],
+                "href": row[11],
+                "rating": row[12],
+                "match_width": row[13],
+                "match_height": row[14],
+                "tags": tags.get(row[10], []),
+            }
+
+
+def write_jsonl(rows: Iterable[Dict[str, Any]], f: BinaryIO) -> int:
+    """Write rows as json lines, return number of rows."""
+    n_row = 0
+    text_f = io.TextIOWrapper(f, encoding="utf-8", write_through=True)
+    for row in rows:
+        row["created_date"] = row["created_date"].isoformat() if row["created_date"] is not None else None
+        text_f.write(json.dumps(row) + "\n")
+        n_row += 1
+    text_f.detach()
+    return n_row
+
+
+def write_csv(rows: Iterable[Dict[str, Any]], f: BinaryIO) -> int:
+    """Write rows as csv with header, tags are written as json array, return number of rows."""
+    n_row = 0
+    text_f = io.TextIOWrapper(f, encoding="utf-8", newline="", write_through=True)
+    writer = csv.DictWriter(text_f, fieldnames=COLUMNS)
+    writer.writeheader()
+    for row in rows:
+        row["created_date"] = row["created_date"].isoformat() if row["created_date"] is not None else None
+        row["tags"] = json.dumps(row["tags"])
+        writer.writerow(row)
+        n_row += 1
+    text_f.detach()
+    return n_row
+
+
+def write_parquet(rows: Iterable[Dict[str, Any]], f: BinaryIO, row_group_size: int = PAGE_SIZE) -> int:
+    """Write rows as parquet file, one row group for every `row_group_size` rows, return number of rows.
+
+    Require pyarrow package.
+    """
+    try:
+        import pyarrow  # pylint: disable=import-outside-toplevel
+        import pyarrow.parquet  # pylint: disable=import-outside-toplevel
+    except ImportError as e:
+        raise ImportError("pyarrow package is required for parquet format") from e
+    schema = pyarrow.schema(
+        [
+            ("checksum", pyarrow.string()),
+            ("width", pyarrow.int32()),
+            ("height", pyarrow.int32()),
+            ("path", pyarrow.string()),
+            ("place", pyarrow.string()),
+            ("similarity", pyarrow.int32()),
+            ("status", pyarrow.string()),
+            ("force_gray", pyarrow.bool_()),
+            ("created_date", pyarrow.timestamp("us")),
+            ("href", pyarrow.string()),
+            ("rating", pyarrow.string()),
+            ("match_width", pyarrow.int32()),
+            ("match_height", pyarrow.int32()),
+            ("tags", pyarrow.list_(pyarrow.string())),
+        ]
+    )
+    n_row = 0
+    batch: List[Dict[str, Any]] = []
+    with pyarrow.parquet.ParquetWriter(f, schema) as writer:
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= row_group_size:
+                writer.write_table(pyarrow.Table.from_pylist(batch, schema=schema))
+                n_row += len(batch)
+                batch = []
+        if batch:
+            writer.write_table(pyarrow.Table.from_pylist(batch, schema=schema))
+            n_row += len(batch)
+    return n_row
+
+
+def export_rows(rows: Iterable[Dict[str, Any]], f: BinaryIO, output_format: str = "jsonl") -> int:
+    """Write rows in the output format, see `FORMATS`.
+
+    Args:
+        rows: rows from `iter_rows`
+        f: binary file object
+        output_format: output format
+
+    Returns:
+        number of written rows
+    """
+    writers = {"jsonl": write_jsonl, "csv": write_csv, "parquet": write_parquet}
+    if output_format not in writers:
+        raise ValueError("Unknown output format: {}".format(output_format))
+    return writers[output_format](rows, f)
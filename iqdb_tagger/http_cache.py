@@ -0,0 +1,175 @@
+"""http cache module."""
+import datetime
+import zlib
+from typing import Any, Optional
+
+import requests
+import structlog
+from peewee import BlobField, CharField, DateTimeField, IntegerField, Model, SqliteDatabase, fn
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+from .models import SQLITE_PRAGMAS
+from .utils import http_cache_path as default_http_cache_path
+
+DEFAULT_TTL = 24 * 60 * 60
+DEFAULT_MAX_SIZE_MB = 256
+DEFAULT_MAX_SIZE = DEFAULT_MAX_SIZE_MB * 1024 * 1024
+cache_db = SqliteDatabase(None)
+log = structlog.getLogger()
+
+
+class CachedResponse(Model):
+    """Cached response model."""
+
+    url = CharField(unique=True)
+    content = BlobField()
+    content_type = CharField(null=True)
+    etag = CharField(null=True)
+    last_modified = CharField(null=True)
+    size = IntegerField()
+    fetched_date = DateTimeField(default=datetime.datetime.now)
+    accessed_date = DateTimeField(default=datetime.datetime.now)
+
+    class Meta:
+        """meta."""
+
+        database = cache_db
+
+    @property
+    def body(self) -> bytes:
+        """Get decompressed content."""
+        return zlib.decompress(self.content)
+
+
+class ResponseCache:
+    """On-disk cache for GET responses.
+
+    Entries are keyed by url and stored compressed. Fresh entries (younger than ttl) are returned without any request,
+    stale ones are revalidated with ETag/Last-Modified. The least recently used entries are evicted
+    when the total size is bigger than max_size.
+
+    The cache database is shared by the whole process, create one cache per run and mount it on every session.
+    """
+
+    def __init__(self, db_path: Optional[str] = None, ttl: int = DEFAULT_TTL, max_size: int = DEFAULT_MAX_SIZE) -> None:
+        """Init method.
+
+        Args:
+            db_path: cache database path
+            ttl: time in seconds before cached response have to be revalidated
+            max_size: maximum total size in bytes of the compressed responses
+        """
+        # sessions of concurrent threads write to the same database
+        cache_db.init(db_path if db_path is not None else default_http_cache_path, pragmas=SQLITE_PRAGMAS)
+        cache_db.create_tables([CachedResponse])
+        self.ttl = datetime.timedelta(seconds=ttl)
+        self.max_size = max_size
+
+    def get(self, url: str) -> Optional[CachedResponse]:
+        """Get cached response for url."""
+        return CachedResponse.get_or_none(CachedResponse.url == url)
+
+    def is_fresh(self, entry: CachedResponse) -> bool:
+        """Check if cached response can be used without revalidation."""
+        return entry.fetched_date + self.ttl > datetime.datetime.now()
+
+    def touch(self, entry: CachedResponse, revalidated: bool = False) -> None:
+        """Update access date and optionally fetched date of cached response."""
+        now = datetime.datetime.now()
+        entry.accessed_date = now
+        if revalidated:
+            entry.fetched_date = now
+        entry.save()
+
+    def set(self, url: str, content: bytes, headers: Any) -> None:
+        """Set cached response for url."""
+        compressed = zlib.compress(content)
+        now = datetime.datetime.now()
+        data = {
+            "content": compressed,
+            "content_type": headers.get("Content-Type"),
+            "etag": headers.get("ETag"),
+            "last_modified": headers.get("Last-Modified"),
+            "size": len(compressed),
+            "fetched_date": now,
+            "accessed_date": now,
+        }
+        with cache_db.atomic():
+            entry, created = CachedResponse.get_or_create(url=url, defaults=data)
+            if not created:
+                CachedResponse.update(**data).where(CachedResponse.id == entry.id).execute()
+        self.evict()
+
+    def evict(self) -> None:
+        """Remove least recently used responses until total size is within max size."""
+        total = CachedResponse.select(fn.SUM(CachedResponse.size)).scalar() or 0
+        if total <= self.max_size:
+            return
+        removed_ids = []
+        query = CachedResponse.select(CachedResponse.id, CachedResponse.size).order_by(CachedResponse.accessed_date)
+        for entry in query.iterator():
+            if total <= self.max_size:
+                break
+            removed_ids.append(entry.id)
+            total -= entry.size
+        CachedResponse.delete().where(CachedResponse.id.in_(removed_ids)).execute()
+        log.debug("cached response evicted", n=len(removed_ids))
+
+    def mount(self, session: requests.Session) -> None:
+        """Cache GET responses of the session."""
+        for prefix in ("http://", "https://"):
+            session.mount(prefix, CachingAdapter(self, session.get_adapter(prefix)))
+
+
+class CachingAdapter(BaseAdapter):
+    """Transport adapter which use response cache before the wrapped adapter."""
+
+    def __init__(self, cache: ResponseCache, adapter: BaseAdapter) -> None:
+        """Init method."""
+        super().__init__()
+        self.cache = cache
+        self.adapter = adapter
+
+    def send(self, request: requests.PreparedRequest, **kwargs: Any) -> requests.Response:  # pylint: disable=arguments-differ
+        """Send request, use cached response when possible."""
+        if request.method != "GET":
+            return self.adapter.send(request, **kwargs)
+        entry = self.cache.get(request.url)
+        if entry is not None and self.cache.is_fresh(entry):
+            log.debug("cached response", url=request.url)
+            self.cache.touch(entry)
+            return self.build_response(request, entry)
+        if entry is not None:
+            if entry.etag:
+                request.headers["If-None-Match"] = entry.etag
+            if entry.last_modified:
+                request.headers["If-Modified-Since"] = entry.last_modified
+        resp = self.adapter.send(request, **kwargs)
+        if resp.status_code == 304 and entry is not None:
+            log.debug("cached response revalidated", url=request.url)
+            self.cache.touch(entry, revalidated=True)
+            return self.build_response(request, entry)
+        if resp.status_code == 200:
+            self.cache.set(request.url, resp.content, resp.headers)
+        return resp
+
+    def build_response(self, request: requests.PreparedRequest, entry: CachedResponse) -> requests.Response:
+        """Build response from cached response."""
+        resp = requests.Response()
+        resp.status_code = 200
+        resp.reason = "OK"
+        resp.headers = CaseInsensitiveDict()
+        if entry.content_type:
+            resp.headers["Content-Type"] = entry.content_type
+        resp.encoding = get_encoding_from_headers(resp.headers)
+        resp._content = entry.body  # pylint: disable=protected-access
+        resp.url = request.url
+        resp.request = request
+        resp.connection = self
+        return resp
+
+    def close(self) -> None:
+        """Close wrapped adapter."""
+        self.adapter.close()
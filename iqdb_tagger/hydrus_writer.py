@@ -0,0 +1,201 @@
+"""hydrus writer module."""
+import threading
+import time
+import traceback
+from typing import Any, Callable, Dict, FrozenSet, Iterable, List, Optional, Set, Tuple
+
+import structlog
+from hydrus import Client
+
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_FLUSH_INTERVAL = 10.0
+log = structlog.getLogger()
+
+
+def group_tags(hash_tags: Dict[str, Set[str]]) -> List[Tuple[List[str], List[str]]]:
+    """Group tag additions into as few add_tags request as possible.
+
+    Every request add the same tags to all its hashes, so additions are grouped either by files with identical tags
+    or by tags added to identical files, whichever need less request.
+
+    Args:
+        hash_tags: tags to be added for each file hash
+
+    Returns:
+        list of hashes and tags pair for each request
+    """
+    by_tags: Dict[FrozenSet[str], List[str]] = {}
+    for f_hash, tags in hash_tags.items():
+        if tags:
+            by_tags.setdefault(frozenset(tags), []).append(f_hash)
+    tag_hashes: Dict[str, Set[str]] = {}
+    for f_hash, tags in hash_tags.items():
+        for tag in tags:
+            tag_hashes.setdefault(tag, set()).add(f_hash)
+    by_hashes: Dict[FrozenSet[str], List[str]] = {}
+    for tag, hashes in tag_hashes.items():
+        by_hashes.setdefault(frozenset(hashes), []).append(tag)
+    if len(by_hashes) < len(by_tags):
+        return [(sorted(hashes), sorted(tags)) for hashes, tags in by_hashes.items()]
+    return [(sorted(hashes), sorted(tags)) for tags, hashes in by_tags.items()]
+
+
+def get_existing_tags(metadata: Dict[str, Any], service: str) -> Optional[Set[str]]:
+    """Get current and pending tags of file in tag service from hydrus metadata.
+
+    Args:
+        metadata: hydrus file metadata, requested with tags
+        service: tag service name
+
+    Returns:
+        existing tags, None if metadata have no tags
+    """
+    if "service_names_to_statuses_to_tags" in metadata:
+        statuses_to_tags = metadata["service_names_to_statuses_to_tags"].get(service, {})
+    elif "tags" in metadata:
+        # newer client api use service key
+        statuses_to_tags = {}
+        for service_tags in metadata["tags"].values():
+            if service_tags.get("name") == service:
+                statuses_to_tags = service_tags.get("storage_tags", {})
+    else:
+        return None
+    # 0: current, 1: pending
+    return {x.lower() for status in ("0", "1") for x in statuses_to_tags.get(status, [])}
+
+
+def get_tag_delta(metadata: Dict[str, Any], service_to_tags: Dict[str, Iterable[str]]) -> Dict[str, Set[str]]:
+    """Get tags which are not in hydrus yet.
+
+    Args:
+        metadata: hydrus file metadata, requested with tags
+        service_to_tags: tags to be added for each tag service
+
+    Returns:
+        new tags for each tag service, services without new tags are removed
+    """
+    delta: Dict[str, Set[str]] = {}
+    for service, tags in service_to_tags.items():
+        existing_tags = get_existing_tags(metadata, service)
+        new_tags = {x for x in tags if existing_tags is None or x.lower() not in existing_tags}
+        if new_tags:
+            delta[service] = new_tags
+    return delta
+
+
+class HydrusWriter:
+    """Buffered write-back of tags and urls to hydrus.
+
+    Tag additions are collected per tag service and sent in batches when the number of buffered files
+    reach batch size or when the oldest buffered addition is older than flush interval.
+    The interval is checked by a timer thread as well, so tags are sent even when no more file is added.
+    Urls are sent once per run.
+    """
+
+    def __init__(
+        self,
+        client: Client,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        flush_interval: float = DEFAULT_FLUSH_INTERVAL,
+        on_flush: Optional[Callable[[List[str]], None]] = None,
+    ) -> None:
+        """Init method.
+
+        Args:
+            client: hydrus client
+            batch_size: number of buffered files before the tags are sent
+            flush_interval: maximum time in seconds a tag addition stay in buffer
+            on_flush: called with hashes of files which tags are successfully sent, possibly from the timer thread
+        """
+        self.client = client
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.on_flush = on_flush
+        self.buffer: Dict[str, Dict[str, Set[str]]] = {}
+        self.buffer_start: Optional[float] = None
+        self.sent_urls: Set[str] = set()
+        self.cond = threading.Condition(threading.RLock())
+        self.timer: Optional[threading.Thread] = None
+        self.closed = False
+
+    @property
+    def n_buffered(self) -> int:
+        """Get number of files in buffer."""
+        with self.cond:
+            return len(set().union(*self.buffer.values())) if self.buffer else 0
+
+    def add_tags(self, f_hash: str, service_to_tags: Dict[str, Iterable[str]]) -> None:
+        """Add tags of file to the buffer and flush it when needed."""
+        with self.cond:
+            for service, tags in service_to_tags.items():
+                self.buffer.setdefault(service, {}).setdefault(f_hash, set()).update(tags)
+            if self.buffer_start is None:
+                self.buffer_start = time.monotonic()
+                self.cond.notify()
+            if self.n_buffered >= self.batch_size or time.monotonic() - self.buffer_start >= self.flush_interval:
+                self.flush()
+            if self.timer is None and not self.closed:
+                self.timer = threading.Thread(target=self.run_timer, name="hydrus-writer-timer", daemon=True)
+                self.timer.start()
+
+    def run_timer(self) -> None:
+        """Flush the buffer when its oldest addition is older than flush interval, until the writer is closed."""
+        with self.cond:
+            while not self.closed:
+                if self.buffer_start is None:
+                    self.cond.wait()
+                    continue
+                remaining = self.buffer_start + self.flush_interval - time.monotonic()
+                if remaining > 0:
+                    self.cond.wait(remaining)
+                    continue
+                log.debug("flush interval passed", interval=self.flush_interval)
+                self.flush()
+
+    def flush(self) -> None:
+        """Send buffered tags."""
+        with self.cond:
+            if not self.buffer:
+                return
+            hashes = set().union(*self.buffer.values())
+            failed_hashes: Set[str] = set()
+            n_request = 0
+            for service, hash_tags in self.buffer.items():
+                for group_hashes, tags in group_tags(hash_tags):
+                    n_request += 1
+                    try:
+                        self.client.add_tags(group_hashes, service_to_tags={service: tags})
+                    except Exception:  # pylint: disable=broad-except
+                        traceback.print_exc()
+                        failed_hashes.update(group_hashes)
+            log.debug("tags sent", n_file=len(hashes), n_request=n_request, n_failed=len(failed_hashes))
+            self.buffer = {}
+            self.buffer_start = None
+            if self.on_flush is not None:
+                self.on_flush(sorted(hashes - failed_hashes))
+
+    def add_url(self, url: str) -> bool:
+        """Send url if it is not sent yet, return True if it is sent."""
+        with self.cond:
+            if url in self.sent_urls:
+                return False
+            self.client.add_url(url)
+            self.sent_urls.add(url)
+            return True
+
+    def close(self) -> None:
+        """Stop the timer thread and flush the buffer."""
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        if self.timer is not None:
+            self.timer.join()
+        self.flush()
+
+    def __enter__(self) -> "HydrusWriter":
+        """Enter context."""
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        """Exit context."""
+        self.close()
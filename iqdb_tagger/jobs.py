@@ -0,0 +1,174 @@
+"""jobs module."""
+import json
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+import structlog
+
+from . import models
+
+DEFAULT_MAX_WORKERS = 4
+DEFAULT_MAX_FINISHED = 1000
+log = structlog.getLogger()
+
+
+class Job:
+    """Background job."""
+
+    STATUS_QUEUED = "queued"
+    STATUS_RUNNING = "running"
+    STATUS_DONE = "done"
+    STATUS_FAILED = "failed"
+
+    def __init__(self) -> None:
+        """Init method."""
+        self.id = uuid.uuid4().hex
+        self.status = self.STATUS_QUEUED
+        self.result: Any = None
+        self.error: Optional[str] = None
+        self.created = time.time()
+        self.finished: Optional[float] = None
+
+    @property
+    def is_finished(self) -> bool:
+        """Check if job is done or failed."""
+        return self.status in (self.STATUS_DONE, self.STATUS_FAILED)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Get job status as dict."""
+        return {"id": self.id, "status": self.status, "result": self.result, "error": self.error}
+
+
+class JobQueue:
+    """Run jobs in a thread pool and keep their status and result.
+
+    Finished jobs are kept in memory until there are more than `max_finished` of them, oldest are removed first.
+    """
+
+    def __init__(self, max_workers: int = DEFAULT_MAX_WORKERS, max_finished: int = DEFAULT_MAX_FINISHED) -> None:
+        """Init method.
+
+        Args:
+            max_workers: number of jobs running concurrently
+            max_finished: number of finished jobs kept for status request
+        """
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        self.max_finished = max_finished
+        self.jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    def submit(self, func: Callable[..., Any], *args: Any, **kwargs: Any) -> Job:
+        """Submit function to be run in background.
+
+        Args:
+            func: job function, its return value is the job result
+            *args: function positional arguments
+            **kwargs: function keyword arguments
+
+        Returns:
+            queued job
+        """
+        job = Job()
+        self.add(job)
+        self.executor.submit(self.run, job, func, *args, **kwargs)
+        return job
+
+    def submit_task(self, func: Callable[..., Any], *args: Any, **kwargs: Any) -> "Future[Any]":
+        """Submit function to the same workers as jobs without recording its status, e.g. batch item which result is streamed.
+
+        Args:
+            func: task function
+            *args: function positional arguments
+            **kwargs: function keyword arguments
+
+        Returns:
+            future of the function result
+        """
+        return self.executor.submit(func, *args, **kwargs)
+
+    def run(self, job: Job, func: Callable[..., Any], *args: Any, **kwargs: Any) -> None:
+        """Run job function and record the result."""
+        job.status = Job.STATUS_RUNNING
+        self.save(job)
+        try:
+            job.result = func(*args, **kwargs)
+            job.status = Job.STATUS_DONE
+        except Exception as err:  # pylint: disable=broad-except
+            log.exception("job failed", job_id=job.id)
+            job.error = str(err)
+            job.status = Job.STATUS_FAILED
+        job.finished = time.time()
+        self.save(job)
+
+    def add(self, job: Job) -> None:
+        """Add new job and remove oldest finished jobs over the limit."""
+        with self.lock:
+            self.jobs[job.id] = job
+            self.prune()
+
+    def save(self, job: Job) -> None:
+        """Record job status change, job kept in memory doesn't need it."""
+
+    def get(self, job_id: str) -> Optional[Job]:
+        """Get job by id."""
+        return self.jobs.get(job_id)
+
+    def prune(self) -> None:
+        """Remove oldest finished jobs over the limit."""
+        finished_ids = [x.id for x in self.jobs.values() if x.is_finished]
+        for job_id in finished_ids[: max(len(finished_ids) - self.max_finished, 0)]:
+            del self.jobs[job_id]
+
+    def shutdown(self, wait: bool = True) -> None:
+        """Stop the executor."""
+        self.executor.shutdown(wait=wait)
+
+
+class DatabaseJobQueue(JobQueue):
+    """Job queue which keep job status and result in database, see `models.BackgroundJob`.
+
+    Job runs in the process which submitted it, but its status can be read by every process sharing the database,
+    e.g. other gunicorn worker. Job result have to be json serializable.
+    """
+
+    @models.db_connection
+    def add(self, job: Job) -> None:
+        """Add new job and remove oldest finished jobs over the limit."""
+        models.BackgroundJob.create(job_id=job.id, status=job.status, created=job.created)
+        self.prune()
+
+    @models.db_connection
+    def save(self, job: Job) -> None:
+        """Record job status change."""
+        fields = {
+            "status": job.status,
+            "result": json.dumps(job.result) if job.result is not None else None,
+            "error": job.error,
+            "finished": job.finished,
+        }
+        models.BackgroundJob.update(**fields).where(models.BackgroundJob.job_id == job.id).execute()
+
+    @models.db_connection
+    def get(self, job_id: str) -> Optional[Job]:
+        """Get job by id."""
+        record = models.BackgroundJob.get_or_none(models.BackgroundJob.job_id == job_id)
+        if record is None:
+            return None
+        job = Job()
+        job.id, job.status, job.error = record.job_id, record.status, record.error
+        job.created, job.finished = record.created, record.finished
+        job.result = json.loads(record.result) if record.result is not None else None
+        return job
+
+    def prune(self) -> None:
+        """Remove oldest finished jobs over the limit."""
+        record = models.BackgroundJob
+        finished = record.select(record.id).where(record.finished.is_null(False)).order_by(record.id.desc())
+        newest_removed = finished.offset(self.max_finished).limit(1).scalar()
+        if newest_removed is not None:
+            record.delete().where(record.finished.is_null(False), record.id <= newest_removed).execute()
@@ -0,0 +1,109 @@
+"""journal module."""
+import hashlib
+import json
+import os
+import pathlib
+import threading
+import time
+from typing import Any, Dict, Optional
+
+import structlog
+
+from .utils import user_data_dir
+
+STAGE_SEARCHED = "searched"
+STAGE_DONE = "done"
+log = structlog.getLogger()
+
+
+def get_default_journal_path(name: str) -> str:
+    """Get default journal path for job name, e.g. folder path."""
+    key = hashlib.sha256(name.encode()).hexdigest()[:16]
+    return os.path.join(user_data_dir, "journal", key + ".jsonl")
+
+
+class Journal:
+    """Append-only journal of batch job progress.
+
+    Every record is written as single json line containing item key, stage reached and additional data.
+    The file is synced after `fsync_every` records or `fsync_interval` seconds, so a crash will only lose the last few records.
+    """
+
+    def __init__(self, path: str, resume: bool = False, fsync_every: int = 100, fsync_interval: float = 5.0) -> None:
+        """Init method.
+
+        Args:
+            path: journal path
+            resume: load existing journal instead of starting a new one
+            fsync_every: number of records before the file is synced
+            fsync_interval: maximum time in seconds before the file is synced
+        """
+        self.path = path
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.entries = {}  # type: Dict[str, Dict[str, Any]]
+        pathlib.Path(os.path.dirname(path) or ".").mkdir(parents=True, exist_ok=True)
+        is_line_cut = False
+        if resume and os.path.isfile(path) and os.path.getsize(path) > 0:
+            self.load()
+            with open(path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                is_line_cut = f.read(1) != b"\n"
+        self.f = open(path, "a" if resume else "w")
+        if is_line_cut:
+            # terminate the line which was cut by crash
+            self.f.write("\n")
+        self.pending = 0
+        self.last_sync = time.monotonic()
+        self.lock = threading.Lock()
+
+    def load(self) -> None:
+        """Load journal records."""
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    log.debug("invalid journal record", line=line)
+                    continue
+                self.entries.setdefault(record["key"], {}).update(record)
+        log.debug("journal loaded", path=self.path, n=len(self.entries))
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Get last state of item."""
+        return self.entries.get(key)
+
+    def get_stage(self, key: str) -> Optional[str]:
+        """Get last stage reached by item."""
+        return self.entries.get(key, {}).get("stage")
+
+    def record(self, key: str, stage: str, **data: Any) -> None:
+        """Record stage reached by item."""
+        record = dict(data, key=key, stage=stage)
+        with self.lock:
+            self.entries.setdefault(key, {}).update(record)
+            self.f.write(json.dumps(record) + "\n")
+            self.pending += 1
+            if self.pending >= self.fsync_every or time.monotonic() - self.last_sync >= self.fsync_interval:
+                self.sync()
+
+    def sync(self) -> None:
+        """Flush and sync the journal file."""
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.pending = 0
+        self.last_sync = time.monotonic()
+
+    def close(self) -> None:
+        """Sync and close the journal file."""
+        if not self.f.closed:
+            self.sync()
+            self.f.close()
+
+    def __enter__(self) -> "Journal":
+        """Enter context."""
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        """Exit context."""
+        self.close()
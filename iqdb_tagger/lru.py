@@ -0,0 +1,43 @@
+"""lru module."""
+import threading
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+
+class LRUCache:
+    """Thread-safe in-memory cache which drop the least recently used item when it is full.
+
+    Cache with zero max size is disabled, nothing is stored.
+    """
+
+    def __init__(self, max_size: int) -> None:
+        """Init method.
+
+        Args:
+            max_size: maximum number of items
+        """
+        self.max_size = max_size
+        self.items: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Get item, None if it is not cached."""
+        with self.lock:
+            if key not in self.items:
+                return None
+            self.items.move_to_end(key)
+            return self.items[key]
+
+    def set(self, key: Hashable, value: Any) -> None:
+        """Add item and drop the least recently used ones over max size."""
+        if self.max_size <= 0:
+            return
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+    def __len__(self) -> int:
+        """Get number of cached items."""
+        return len(self.items)
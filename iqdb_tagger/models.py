@@ -2,9 +2,14 @@
 # -*- coding: utf-8 -*-
 """model module."""
 import datetime
+import functools
+import ipaddress
 import logging
 import os
-from typing import Any, List, Optional, Tuple, TypeVar
+import shutil
+import socket
+from tempfile import NamedTemporaryFile
+from typing import Any, BinaryIO, Callable, Dict, List, Optional, Tuple, TypeVar
 from urllib.parse import urljoin, urlparse
 
 import cfscrape
@@ -14,23 +19,43 @@ import structlog
 from peewee import (
     BooleanField,
     CharField,
+    Database,
+    DatabaseProxy,
     DateTimeField,
+    DoubleField,
     ForeignKeyField,
     IntegerField,
     Model,
+    MySQLDatabase,
     SqliteDatabase,
     TextField,
+    fn,
+    prefetch,
 )
 from PIL import Image
+from playhouse.db_url import connect as connect_db_url
+from playhouse.migrate import SchemaMigrator, migrate
+from playhouse.pool import PooledSqliteDatabase
 
+from . import db_version as current_db_version
 from .custom_parser import get_tags as get_tags_from_parser
 from .sha256 import sha256_checksum
+from .singleflight import SingleFlight
 from .utils import default_db_path
 from .utils import thumb_folder as default_thumb_folder
 
 DEFAULT_SIZE = 150, 150
-db = SqliteDatabase(None)
+# milliseconds sqlite wait for other connection to release its lock
+SQLITE_BUSY_TIMEOUT = 10000
+URL_MAX_LENGTH = 700
+# bytes downloaded from image url
+MAX_DOWNLOAD_SIZE = 50 * 1024 * 1024
+MAX_DOWNLOAD_REDIRECTS = 5
+SQLITE_PRAGMAS = {"journal_mode": "wal", "busy_timeout": SQLITE_BUSY_TIMEOUT}
+db = DatabaseProxy()
 log = structlog.getLogger()
+# concurrent tag page fetch of the same match url
+tag_fetch_flight = SingleFlight()
 
 
 class BaseModel(Model):
@@ -54,6 +79,11 @@ class Tag(BaseModel):
     name = CharField()
     namespace = CharField(null=True)
 
+    class Meta:
+        """meta."""
+
+        indexes = ((("name", "namespace"), True),)
+
     @property
     def full_name(self) -> str:
         """Get full name."""
@@ -76,8 +106,9 @@ class Match(BaseModel):
         (RATING_ERO, "Ero"),
         (RATING_EXPLICIT, "Explicit"),
     )
-    href = CharField(unique=True)
-    thumb = CharField()
+    # url length limited by mysql utf8mb4 index size
+    href = CharField(unique=True, max_length=URL_MAX_LENGTH)
+    thumb = CharField(max_length=URL_MAX_LENGTH)
     rating = CharField()
     img_alt = TextField(null=True)
     width = IntegerField(null=True)
@@ -116,7 +147,7 @@ class Match(BaseModel):
     def tags_from_img_alt(self) -> List[Any]:
         """Get readable tag from image alt."""
         result = []
-        img_alt = self.img_alt[0]
+        img_alt = self.img_alt[0] if isinstance(self.img_alt, list) else self.img_alt
         non_tags_txt = img_alt.split("Tags:")[0]
         tags_txt = img_alt.split("Tags:")[1]
         result.extend(tags_txt.split(" "))
@@ -132,9 +163,17 @@ class MatchTagRelationship(BaseModel):
 
     match = ForeignKeyField(Match)
     tag = ForeignKeyField(Tag)
+    from_img_alt = BooleanField(default=False)
+    created_date = DateTimeField(default=datetime.datetime.now)
+
+    class Meta:
+        """meta."""
+
+        indexes = ((("match", "tag"), True),)
 
 
 IM = TypeVar("IM", bound="ImageModel")
+T = TypeVar("T")
 
 
 class ImageModel(BaseModel):
@@ -143,7 +182,7 @@ class ImageModel(BaseModel):
     checksum = CharField(unique=True)
     width = IntegerField()
     height = IntegerField()
-    path = CharField(null=True)
+    path = TextField(null=True)
 
     @property
     def size(self) -> str:
@@ -182,6 +221,11 @@ class ImageMatchRelationship(BaseModel):
     image = ForeignKeyField(ImageModel)
     match_result = ForeignKeyField(Match)  # NOQA
 
+    class Meta:
+        """meta."""
+
+        indexes = ((("image", "match_result"), True),)
+
 
 class ImageMatch(BaseModel):
     """Image match."""
@@ -227,6 +271,11 @@ class ImageMatch(BaseModel):
     created_date = DateTimeField(default=datetime.datetime.now)
     force_gray = BooleanField(default=False)
 
+    class Meta:
+        """meta."""
+
+        indexes = ((("match", "search_place", "force_gray"), True),)
+
     @property
     def status_verbose(self) -> str:
         """Get verbose status."""
@@ -262,6 +311,11 @@ class ThumbnailRelationship(BaseModel):
     original = ForeignKeyField(ImageModel, related_name="thumbnails")  # NOQA
     thumbnail = ForeignKeyField(ImageModel)
 
+    class Meta:
+        """meta."""
+
+        indexes = ((("original", "thumbnail"), True),)
+
     @staticmethod
     def get_or_create_from_image(
         image: ImageModel,
@@ -301,27 +355,269 @@ class ThumbnailRelationship(BaseModel):
         return ThumbnailRelationship.get_or_create(original=image, thumbnail=thumb)
 
 
-def init_db(db_path: Optional[str] = None, version: int = 1) -> None:
-    """Init db."""
+class NegativeResult(BaseModel):
+    """Negative result, e.g. image without match or failed tag page fetch."""
+
+    CATEGORY_NO_MATCH = "no-match"
+    CATEGORY_CONNECTION_ERROR = "connection-error"
+    CATEGORY_NOT_FOUND = "not-found"
+    CATEGORY_NO_TAGS = "no-tags"
+    CATEGORY_SEARCH_ERROR = "search-error"
+    # time to live in seconds for each category
+    TTL = {
+        CATEGORY_NO_MATCH: 7 * 24 * 60 * 60,
+        CATEGORY_CONNECTION_ERROR: 60 * 60,
+        CATEGORY_NOT_FOUND: 30 * 24 * 60 * 60,
+        CATEGORY_NO_TAGS: 7 * 24 * 60 * 60,
+        CATEGORY_SEARCH_ERROR: 60 * 60,
+    }
+
+    key = CharField(max_length=URL_MAX_LENGTH)
+    category = CharField(max_length=32)
+    created_date = DateTimeField(default=datetime.datetime.now)
+
+    class Meta:
+        """meta."""
+
+        indexes = ((("key", "category"), True),)
+
+    @staticmethod
+    def get_key(checksum: str, place: int) -> str:
+        """Get key for image checksum and iqdb place."""
+        return "{}-{}".format(checksum, place)
+
+    @staticmethod
+    def get_unexpired(key: str) -> Optional["NegativeResult"]:
+        """Get unexpired negative result for the key."""
+        now = datetime.datetime.now()
+        for item in NegativeResult.select().where(NegativeResult.key == key):
+            ttl = NegativeResult.TTL.get(item.category, 0)
+            if item.created_date + datetime.timedelta(seconds=ttl) > now:
+                return item
+        return None
+
+    @staticmethod
+    def add(key: str, category: str) -> None:
+        """Add or renew negative result."""
+        now = datetime.datetime.now()
+        item, created = NegativeResult.get_or_create(key=key, category=category, defaults={"created_date": now})
+        if not created:
+            item.created_date = now
+            item.save()
+
+    @staticmethod
+    def remove(key: str) -> None:
+        """Remove all negative result for the key."""
+        NegativeResult.delete().where(NegativeResult.key == key).execute()
+
+
+class Counter(BaseModel):
+    """Incrementally maintained count, to avoid counting large tables."""
+
+    IMAGES_WITH_MATCH = "images-with-match"
+
+    name = CharField(unique=True)
+    value = IntegerField(default=0)
+
+    @staticmethod
+    def get_value(name: str, init_func: Callable[[], int]) -> int:
+        """Get counter value, counted by `init_func` when the counter doesn't exist yet."""
+        counter = Counter.get_or_none(Counter.name == name)
+        if counter is None:
+            counter = Counter.get_or_create(name=name, defaults={"value": init_func()})[0]
+        return counter.value
+
+    @staticmethod
+    def add(name: str, delta: int = 1) -> None:
+        """Add to counter value, nothing is done when the counter doesn't exist yet."""
+        Counter.update(value=Counter.value + delta).where(Counter.name == name).execute()
+
+
+def get_database(db_path: Optional[str] = None, db_url: Optional[str] = None, pool: bool = False) -> Database:
+    """Get database for sqlite path or database url.
+
+    Args:
+        db_path: sqlite database path
+        db_url: database url, e.g. postgresql://user@host/iqdb_tagger, used instead of the path
+        pool: use connection pool for sqlite database
+
+    Returns:
+        database, not connected yet
+    """
+    if db_url:
+        return connect_db_url(db_url)
     if db_path is None:
         db_path = default_db_path
-    db.init(db_path)
-    if not os.path.isfile(db_path):
-        model_list = [
-            ImageMatch,
-            ImageMatchRelationship,
-            ImageModel,
-            Match,
-            MatchTagRelationship,
-            Program,
-            Tag,
-            ThumbnailRelationship,
-        ]
-        db.create_tables(model_list)
-        version = Program(version=version)
-        version.save()
-    else:
-        logging.debug("db already existed.")
+    if pool:
+        return PooledSqliteDatabase(db_path, pragmas=SQLITE_PRAGMAS, max_connections=None, stale_timeout=300, check_same_thread=False)
+    return SqliteDatabase(db_path, pragmas=SQLITE_PRAGMAS)
+
+
+class WorkItem(BaseModel):
+    """Work queue item, e.g. image path, url or hydrus hash to be tagged.
+
+    Worker lease the item before processing it, item with expired lease can be claimed by other worker.
+    Version is increased on every change, so concurrent claim of the same item is detected.
+    """
+
+    STATUS_QUEUED = "queued"
+    STATUS_LEASED = "leased"
+    STATUS_DONE = "done"
+    STATUS_FAILED = "failed"
+    KIND_PATH = "path"
+    KIND_URL = "url"
+    KIND_HYDRUS = "hydrus"
+
+    queue = CharField(max_length=32)
+    kind = CharField(max_length=16)
+    value = CharField(max_length=URL_MAX_LENGTH)
+    status = CharField(max_length=16, default=STATUS_QUEUED, index=True)
+    attempts = IntegerField(default=0)
+    owner = CharField(null=True)
+    lease_expires = DateTimeField(null=True)
+    version = IntegerField(default=0)
+    checksum = CharField(null=True)
+    error = TextField(null=True)
+    created_date = DateTimeField(default=datetime.datetime.now)
+
+    class Meta:
+        """meta."""
+
+        indexes = ((("queue", "kind", "value"), True),)
+
+
+class BackgroundJob(BaseModel):
+    """Status and json result of web app background job, readable by every process sharing the database."""
+
+    job_id = CharField(max_length=32, unique=True)
+    status = CharField(max_length=16)
+    result = TextField(null=True)
+    error = TextField(null=True)
+    created = DoubleField()
+    finished = DoubleField(null=True)
+
+
+class RateLimit(BaseModel):
+    """Next allowed request time for a rate limited key, e.g. host, shared by all workers."""
+
+    key = CharField(unique=True)
+    next_time = DoubleField(default=0)
+
+
+def init_db(db_path: Optional[str] = None, version: int = current_db_version, db_url: Optional[str] = None, pool: bool = False) -> None:
+    """Init db.
+
+    Args:
+        db_path: sqlite database path
+        version: database version
+        db_url: database url, used instead of the path
+        pool: use connection pool for sqlite database
+    """
+    db.initialize(get_database(db_path, db_url, pool))
+    model_list = [
+        BackgroundJob,
+        Counter,
+        ImageMatch,
+        ImageMatchRelationship,
+        ImageModel,
+        Match,
+        MatchTagRelationship,
+        NegativeResult,
+        Program,
+        RateLimit,
+        Tag,
+        ThumbnailRelationship,
+        WorkItem,
+    ]
+    with db.connection_context():
+        if not Program.table_exists():
+            db.create_tables(model_list)
+            Program.create(version=version)
+        else:
+            logging.debug("db already existed.")
+            # duplicates have to be removed before unique indexes are created
+            migrate_db(version)
+            db.create_tables(model_list)
+        if not isinstance(db.obj, MySQLDatabase):
+            # unique index above doesn't cover tag without namespace, as null values are distinct
+            db.execute(Tag.index(Tag.name, unique=True, name="tag_name_null_namespace").where(Tag.namespace.is_null()).safe(True))
+
+
+def db_connection(func: Callable[..., T]) -> Callable[..., T]:
+    """Run function with database connection which is closed afterwards, e.g. function run by background thread.
+
+    Connection which is already open in the thread is used and left open.
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args: Any, **kwargs: Any) -> T:
+        if not db.is_closed():
+            return func(*args, **kwargs)
+        with db.connection_context():
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def migrate_db(version: int) -> None:
+    """Migrate existing db to the given version.
+
+    Args:
+        version: target db version
+    """
+    program = Program.select().order_by(Program.version.desc()).first()
+    if program is not None and program.version >= version:
+        return
+    migrator = SchemaMigrator.from_database(db.obj)
+    mtr_columns = [x.name for x in db.get_columns(MatchTagRelationship._meta.table_name)]
+    with db.atomic():
+        if "from_img_alt" not in mtr_columns:
+            log.debug("migrate db", column="from_img_alt")
+            migrate(migrator.add_column(MatchTagRelationship._meta.table_name, "from_img_alt", MatchTagRelationship.from_img_alt))
+        if "created_date" not in mtr_columns:
+            log.debug("migrate db", column="created_date")
+            migrate(migrator.add_column(MatchTagRelationship._meta.table_name, "created_date", MatchTagRelationship.created_date))
+        if program is None or program.version < 3:
+            log.debug("migrate db", unique_index="remove duplicates")
+            remove_duplicates(Tag, (Tag.name, Tag.namespace), [MatchTagRelationship.tag])
+            remove_duplicates(MatchTagRelationship, (MatchTagRelationship.match, MatchTagRelationship.tag))
+            imr_fields = (ImageMatchRelationship.image, ImageMatchRelationship.match_result)
+            remove_duplicates(ImageMatchRelationship, imr_fields, [ImageMatch.match])
+            remove_duplicates(ImageMatch, (ImageMatch.match, ImageMatch.search_place, ImageMatch.force_gray))
+            remove_duplicates(ThumbnailRelationship, (ThumbnailRelationship.original, ThumbnailRelationship.thumbnail))
+        if program is None or program.version < 5:
+            # next_time was single precision float on mysql and postgresql, the table only hold short-lived rate limit state
+            log.debug("migrate db", table="ratelimit")
+            db.drop_tables([RateLimit], safe=True)
+        Program.create(version=version)
+
+
+def remove_duplicates(model: Any, fields: Tuple[Any, ...], ref_fields: Optional[List[Any]] = None) -> int:
+    """Remove rows with the same field values, keep the first one and point references to it.
+
+    Args:
+        model: model
+        fields: fields which have to be unique together
+        ref_fields: foreign key fields referencing the model
+
+    Returns:
+        number of removed rows
+    """
+    first_ids: Dict[Tuple[Any, ...], int] = {}
+    duplicates: Dict[int, int] = {}
+    for row in model.select(model.id, *fields).order_by(model.id).tuples():
+        first_id = first_ids.setdefault(tuple(row[1:]), row[0])
+        if first_id != row[0]:
+            duplicates[row[0]] = first_id
+    for dup_id, first_id in duplicates.items():
+        for ref_field in ref_fields or []:
+            ref_field.model.update({ref_field: first_id}).where(ref_field == dup_id).execute()
+    dup_ids = list(duplicates)
+    for idx in range(0, len(dup_ids), 500):
+        model.delete().where(model.id.in_(dup_ids[idx : idx + 500])).execute()
+    if dup_ids:
+        log.debug("duplicates removed", table=model._meta.table_name, n_row=len(dup_ids))
+    return len(dup_ids)
 
 
 def get_posted_image(
@@ -356,11 +652,279 @@ def get_posted_image(
     return resized_thumb_rel.thumbnail if resized_thumb_rel is not None else img
 
 
+def clear_temp_paths(paths: List[str], output_thumb_folder: Optional[str] = None) -> None:
+    """Update images which path is temporary file, before the files are removed.
+
+    Args:
+        paths: temporary file paths
+        output_thumb_folder: thumbnail file is moved to this folder, otherwise its path is cleared as well
+    """
+    for image in ImageModel.select().where(ImageModel.path.in_(paths)):
+        is_thumbnail = ThumbnailRelationship.select().where(ThumbnailRelationship.thumbnail == image).exists()
+        if is_thumbnail and output_thumb_folder and os.path.isfile(image.path):
+            os.makedirs(output_thumb_folder, exist_ok=True)
+            thumb_path = os.path.join(output_thumb_folder, "{}-{}-{}.jpg".format(image.checksum, image.width, image.height))
+            shutil.move(image.path, thumb_path)
+            image.path = thumb_path
+        else:
+            image.path = None
+        image.save()
+
+
+def get_image_matches(image: ImageModel, place: int) -> List[ImageMatch]:
+    """Get image matches of the image from the iqdb place."""
+    query = (
+        ImageMatch.select()
+        .join(ImageMatchRelationship)
+        .where(ImageMatchRelationship.image == image, ImageMatch.search_place == place)
+        .order_by(ImageMatch.id)
+    )
+    return list(query)
+
+
+def get_images_with_match_query() -> Any:
+    """Get query of images with at least one match result."""
+    has_match = ImageMatchRelationship.select().where(ImageMatchRelationship.image == ImageModel.id)
+    return ImageModel.select().where(fn.EXISTS(has_match))
+
+
+def count_images_with_match() -> int:
+    """Get number of images with match result from maintained counter."""
+    return Counter.get_value(Counter.IMAGES_WITH_MATCH, lambda: get_images_with_match_query().count())
+
+
+def get_images_with_match_page(
+    before: Optional[int] = None, after: Optional[int] = None, limit: int = 10
+) -> Tuple[List[ImageModel], bool, bool]:
+    """Get page of images with match, newest first, using image id as cursor.
+
+    Match relationships, match results and image matches of the images are prefetched,
+    so every page need the same number of queries.
+
+    Args:
+        before: get images older than this image id
+        after: get images newer than this image id, used when paging back
+        limit: number of images per page
+
+    Returns:
+        images, whether there are newer images and whether there are older images
+    """
+    query = get_images_with_match_query()
+    if after is not None:
+        query = query.where(ImageModel.id > after).order_by(ImageModel.id.asc())
+    else:
+        if before is not None:
+            query = query.where(ImageModel.id < before)
+        query = query.order_by(ImageModel.id.desc())
+    query = query.limit(limit + 1)
+    imr_query = ImageMatchRelationship.select().order_by(ImageMatchRelationship.id)
+    images = prefetch(query, imr_query, Match, ImageMatch.select().order_by(ImageMatch.id))
+    has_more = len(images) > limit
+    images = images[:limit]
+    if after is not None:
+        return images[::-1], has_more, True
+    return images, before is not None, has_more
+
+
+def get_image_with_matches(checksum: str) -> Optional[ImageModel]:
+    """Get image with its match data loaded in fixed number of queries.
+
+    Match relationships, match results, image matches, match tags and tags are prefetched
+    and the original image of thumbnail is loaded with its thumbnail relationship.
+
+    Args:
+        checksum: image checksum
+
+    Returns:
+        image, None if not found
+    """
+    query = ImageModel.select().where(ImageModel.checksum == checksum)
+    images = prefetch(
+        query,
+        ImageMatchRelationship.select().order_by(ImageMatchRelationship.id),
+        Match,
+        ImageMatch.select().order_by(ImageMatch.id),
+        MatchTagRelationship,
+        Tag,
+    )
+    if not images:
+        return None
+    image = images[0]
+    original = ImageModel.alias()
+    thumb_rels = (
+        ThumbnailRelationship.select(ThumbnailRelationship, original)
+        .join(original, on=(ThumbnailRelationship.original == original.id))
+        .where(ThumbnailRelationship.thumbnail == image.id)
+    )
+    image.thumbnailrelationship_set = list(thumb_rels)
+    return image
+
+
+def get_image_match_version(checksum: str) -> Tuple[Optional[datetime.datetime], int]:
+    """Get last modified date and number of image matches of image, used as cache key of its match page."""
+    row = (
+        ImageMatch.select(fn.MAX(ImageMatch.created_date), fn.COUNT(ImageMatch.id))
+        .join(ImageMatchRelationship)
+        .join(ImageModel)
+        .where(ImageModel.checksum == checksum)
+        .tuples()
+        .get()
+    )
+    return row[0], row[1]
+
+
+def get_cached_image_matches(
+    checksum: str,
+    place: int,
+    resize: bool = False,
+    size: Optional[Tuple[int, int]] = None,
+    use_negative_cache: bool = True,
+) -> Optional[Tuple[List[ImageMatch], str]]:
+    """Get image matches from previous search of image, without the image file.
+
+    Args:
+        checksum: image checksum
+        place: iqdb place
+        resize: image was resized before upload, any thumbnail of the image can be the posted image
+        size: resized image size, thumbnail which fit the size is checked first
+        use_negative_cache: use recent no-match or failed search as empty result
+
+    Returns:
+        image matches and posted image checksum, None if the image have to be searched
+    """
+    image = ImageModel.get_or_none(ImageModel.checksum == checksum)
+    if image is None:
+        return None
+    if resize:
+        size = size or DEFAULT_SIZE
+        thumbnails = [x.thumbnail for x in image.thumbnails]
+        # bigger thumbnail is e.g. hydrus thumbnail uploaded as is
+        posted_images = [x for x in thumbnails if x.width <= size[0] and x.height <= size[1]]
+        posted_images += [x for x in thumbnails if x not in posted_images]
+    else:
+        posted_images = [image]
+    for posted_image in posted_images:
+        result = get_image_matches(posted_image, place)
+        if result:
+            return result, posted_image.checksum
+    if use_negative_cache:
+        for posted_image in posted_images:
+            if NegativeResult.get_unexpired(NegativeResult.get_key(posted_image.checksum, place)) is not None:
+                return [], posted_image.checksum
+    return None
+
+
+def get_posted_image_from_thumb_url(thumb_url: str, image_url: str) -> ImageModel:
+    """Get posted image from iqdb thumbnail of image searched by url.
+
+    Args:
+        thumb_url: iqdb thumbnail url of the searched image
+        image_url: searched image url, saved as image path
+
+    Returns:
+        posted image
+    """
+    with NamedTemporaryFile(delete=False) as f:
+        try:
+            download_url(thumb_url, f)
+        except Exception:
+            os.remove(f.name)
+            raise
+    try:
+        img, created = ImageModel.get_or_create_from_path(f.name)  # type: ImageModel, bool
+    finally:
+        os.remove(f.name)
+    # other url with the same thumbnail keep its path
+    if created or not img.path:
+        img.path = image_url
+        img.save()
+    return img
+
+
+def is_public_url(url: str) -> bool:
+    """Check if url is http or https url which host resolve to public addresses only."""
+    parsed = urlparse(url)
+    try:
+        if parsed.scheme not in ("http", "https") or not parsed.hostname:
+            return False
+        addresses = socket.getaddrinfo(parsed.hostname, parsed.port or None)
+    except (socket.gaierror, UnicodeError, ValueError):
+        return False
+    return all(ipaddress.ip_address(x[4][0].split("%")[0]).is_global for x in addresses)
+
+
+def download_url(
+    url: str, f: BinaryIO, max_size: int = MAX_DOWNLOAD_SIZE, timeout: int = 10, check_url: Optional[Callable[[str], bool]] = None
+) -> int:
+    """Download http or https url to file object, the response is streamed.
+
+    Redirects are followed one by one, so every redirected url is checked as well.
+
+    Args:
+        url: http or https url
+        f: binary file object
+        max_size: maximum number of downloaded bytes
+        timeout: request timeout in seconds
+        check_url: function which return False for url which shouldn't be downloaded, e.g. `is_public_url`
+
+    Returns:
+        number of downloaded bytes
+
+    Raises:
+        ValueError: url is not http or https url, it is rejected by `check_url` or its content is bigger than max size
+        requests.exceptions.TooManyRedirects: url is redirected more than `MAX_DOWNLOAD_REDIRECTS` times
+    """
+    for _ in range(MAX_DOWNLOAD_REDIRECTS + 1):
+        if urlparse(url).scheme not in ("http", "https"):
+            raise ValueError("Only http or https url can be downloaded: {}".format(url))
+        if check_url is not None and not check_url(url):
+            raise ValueError("Url is not allowed to be downloaded: {}".format(url))
+        resp = requests.get(url, timeout=timeout, stream=True, allow_redirects=False)
+        if not resp.is_redirect:
+            break
+        resp.close()
+        url = urljoin(url, resp.headers["Location"])
+    else:
+        raise requests.exceptions.TooManyRedirects("Exceeded {} redirects: {}".format(MAX_DOWNLOAD_REDIRECTS, url))
+    with resp:
+        resp.raise_for_status()
+        if int(resp.headers.get("Content-Length") or 0) > max_size:
+            raise ValueError("Download bigger than {} bytes: {}".format(max_size, url))
+        size = 0
+        for chunk in resp.iter_content(64 * 1024):
+            size += len(chunk)
+            if size > max_size:
+                raise ValueError("Download bigger than {} bytes: {}".format(max_size, url))
+            f.write(chunk)
+    return size
+
+
+def add_posted_thumbnail(checksum: str, width: Optional[int], height: Optional[int], posted_checksum: str) -> None:
+    """Add posted image as thumbnail of image which file is not available, e.g. hydrus file searched by its thumbnail.
+
+    Args:
+        checksum: image checksum
+        width: image width
+        height: image height
+        posted_checksum: posted image checksum
+    """
+    image, created = ImageModel.get_or_create(checksum=checksum, defaults={"width": width or 0, "height": height or 0})
+    if not created and width and height and (image.width, image.height) != (width, height):
+        # image added before its size was known
+        image.width, image.height = width, height
+        image.save()
+    thumbnail = ImageModel.get(ImageModel.checksum == posted_checksum)
+    if image != thumbnail:
+        ThumbnailRelationship.get_or_create(original=image, thumbnail=thumbnail)
+
+
 def get_page_result(
-    image: str,
+    image: Optional[str],
     url: str,
     browser: Optional[mechanicalsoup.StatefulBrowser] = None,
     use_requests: Optional[bool] = False,
+    image_url: Optional[str] = None,
+    rate_limiter: Optional[Any] = None,
 ) -> str:
     """Get iqdb page result.
 
@@ -369,58 +933,159 @@ def get_page_result(
         url: iqdb url
         browser: browser instance
         use_requests: use requests package instead from browser
+        image_url: image url fetched by iqdb, used instead of uploading the image
+        rate_limiter: object with wait(host) method called before the request, e.g. `ratelimit.RateLimiter`
 
     Returns:
         HTML page from the result.
     """
+    if rate_limiter is not None:
+        rate_limiter.wait(urlparse(url).netloc)
     if use_requests:
-        files = {"file": open(image, "rb")}
-        resp = requests.post(url, files=files, timeout=10)
+        if image_url is not None:
+            resp = requests.post(url, files={"url": (None, image_url)}, timeout=10)
+            resp.raise_for_status()
+            return resp.text
+        with open(image, "rb") as f:
+            resp = requests.post(url, files={"file": f}, timeout=10)
+        resp.raise_for_status()
         return resp.text
     browser = mechanicalsoup.StatefulBrowser(soup_config={"features": "lxml"})
     browser.raise_on_404 = True
     browser.open(url)
     html_form = browser.select_form("form")
-    html_form.input({"file": image})
-    browser.submit_selected()
-    # if ok, will output: <Response [200]>
+    html_form.input({"url": image_url} if image_url is not None else {"file": image})
+    browser.submit_selected().raise_for_status()
     return browser.get_current_page()
 
 
+def get_tags_from_img_alt(img_alt: Optional[str]) -> List[Tuple[str, str]]:
+    """Get tags from iqdb image alt text.
+
+    The alt text have following format, 'Rating: s Score: 5 Tags: tag1 tag2'.
+    iqdb don't give the namespace, so it is taken from existing namespaced tag with the same name,
+    if there is only one of them.
+
+    Args:
+        img_alt: image alt text
+
+    Returns:
+        list of namespace and tag name pair
+    """
+    if not img_alt or "Tags:" not in img_alt:
+        return []
+    tags_txt = img_alt.split("Tags:", 1)[1].strip()
+    if "," in tags_txt:
+        names = [x.strip() for x in tags_txt.split(",")]
+    else:
+        names = tags_txt.split(" ")
+    names = list(dict.fromkeys(x for x in names if x))
+    if not names:
+        return []
+    namespaces: Dict[str, List[str]] = {}
+    query = Tag.select(Tag.name, Tag.namespace).distinct().where(Tag.name.in_(names), Tag.namespace.is_null(False), Tag.namespace != "")
+    for tag in query:
+        namespaces.setdefault(tag.name, []).append(tag.namespace)
+    return [(namespaces[x][0] if len(namespaces.get(x, [])) == 1 else "", x) for x in names]
+
+
+def get_or_create_tags_from_img_alt(match_result: Match) -> List[Tag]:
+    """Get or create tags from match result image alt text."""
+    tags = []
+    for namespace, tag_name in get_tags_from_img_alt(match_result.img_alt):
+        tag_model = Tag.get_or_create(name=tag_name, namespace=namespace)[0]  # type: Tag
+        MatchTagRelationship.get_or_create(match=match_result, tag=tag_model, defaults={"from_img_alt": True})
+        tags.append(tag_model)
+    return tags
+
+
 def get_tags_from_match_result(
     match_result: Match,
     browser: Optional[mechanicalsoup.StatefulBrowser] = None,
     scraper: Optional[cfscrape.CloudflareScraper] = None,
+    use_img_alt: bool = False,
+    use_negative_cache: bool = True,
 ) -> List[Tag]:
-    """Get tags from match result."""
+    """Get tags from match result.
+
+    Args:
+        match_result: match result
+        browser: browser instance
+        scraper: scraper instance
+        use_img_alt: use tags from image alt text and only fetch the tag page when there is none
+        use_negative_cache: skip tag page which recently failed or have no tags
+
+    Returns:
+        tags of the match result
+    """
     filtered_hosts = ["anime-pictures.net", "www.theanimegallery.com"]
     res = MatchTagRelationship.select().where(MatchTagRelationship.match == match_result)
-    tags = [x.tag for x in res]
+    tags = [x.tag for x in res if not x.from_img_alt]
+    if use_img_alt and not tags:
+        tags = [x.tag for x in res if x.from_img_alt] or get_or_create_tags_from_img_alt(match_result)
+        if tags:
+            return tags
     is_url_in_filtered_hosts = urlparse(match_result.link).netloc in filtered_hosts
     if is_url_in_filtered_hosts:
         log.debug("URL in filtered hosts, no tag fetched", url=match_result.link)
+    elif not tags and use_negative_cache and NegativeResult.get_unexpired(match_result.link) is not None:
+        log.debug("negative result cached, no tag fetched", url=match_result.link)
     elif not tags:
-        try:
-            if browser is None:
-                browser = mechanicalsoup.StatefulBrowser(soup_config={"features": "lxml"})
-                browser.raise_on_404 = True
-            browser.open(match_result.link, timeout=10)
-            page = browser.get_current_page()
-            new_tags = get_tags_from_parser(page, match_result.link, scraper)
-            new_tag_models = []
-            if new_tags:
-                for tag in new_tags:
-                    namespace, tag_name = tag
-                    tag_model = Tag.get_or_create(name=tag_name, namespace=namespace)[0]  # type: Tag
-                    MatchTagRelationship.get_or_create(match=match_result, tag=tag_model)
-                    new_tag_models.append(tag_model)
-            else:
-                log.debug("No tags found.")
-
-            tags.extend(new_tag_models)
-        except (
-            requests.exceptions.ConnectionError,
-            mechanicalsoup.LinkNotFoundError,
-        ) as e:
-            log.error(str(e), url=match_result.link)
+        tags = tag_fetch_flight.do(match_result.link, fetch_tags_from_match_result, match_result, browser, scraper)
     return tags
+
+
+def fetch_tags_from_match_result(
+    match_result: Match,
+    browser: Optional[mechanicalsoup.StatefulBrowser] = None,
+    scraper: Optional[cfscrape.CloudflareScraper] = None,
+) -> List[Tag]:
+    """Fetch tags from match result tag page and save them.
+
+    Args:
+        match_result: match result
+        browser: browser instance
+        scraper: scraper instance
+
+    Returns:
+        tags from the tag page
+    """
+    try:
+        if browser is None:
+            browser = mechanicalsoup.StatefulBrowser(soup_config={"features": "lxml"})
+            browser.raise_on_404 = True
+        browser.open(match_result.link, timeout=10).raise_for_status()
+        page = browser.get_current_page()
+        new_tags = get_tags_from_parser(page, match_result.link, scraper)
+        new_tag_models = []
+        if new_tags:
+            NegativeResult.remove(match_result.link)
+            # tags from tag page replace the ones from image alt text
+            MatchTagRelationship.delete().where(
+                MatchTagRelationship.match == match_result,
+                MatchTagRelationship.from_img_alt == True,  # NOQA; pylint: disable=singleton-comparison
+            ).execute()
+            for tag in new_tags:
+                namespace, tag_name = tag
+                tag_model = Tag.get_or_create(name=tag_name, namespace=namespace)[0]  # type: Tag
+                MatchTagRelationship.get_or_create(match=match_result, tag=tag_model)
+                new_tag_models.append(tag_model)
+        else:
+            log.debug("No tags found.")
+            NegativeResult.add(match_result.link, NegativeResult.CATEGORY_NO_TAGS)
+
+        return new_tag_models
+    except requests.exceptions.HTTPError as e:
+        log.error(str(e), url=match_result.link)
+        if e.response is not None and e.response.status_code == 404:
+            NegativeResult.add(match_result.link, NegativeResult.CATEGORY_NOT_FOUND)
+        else:
+            NegativeResult.add(match_result.link, NegativeResult.CATEGORY_CONNECTION_ERROR)
+    except requests.exceptions.RequestException as e:
+        # connection error, timeout, too many redirects
+        log.error(str(e), url=match_result.link)
+        NegativeResult.add(match_result.link, NegativeResult.CATEGORY_CONNECTION_ERROR)
+    except mechanicalsoup.LinkNotFoundError as e:
+        log.error(str(e), url=match_result.link)
+        NegativeResult.add(match_result.link, NegativeResult.CATEGORY_NOT_FOUND)
+    return []
@@ -2,12 +2,12 @@
 # -*- coding: utf-8 -*-
 """Module for parser function."""
 from difflib import Differ
-from typing import Any, Dict, Iterator
+from typing import Any, Dict, Iterator, Optional
 
 import structlog
 from bs4 import BeautifulSoup, element
 
-from .models import ImageMatch, Match, ImageMatchRelationship
+from .models import Counter, ImageMatch, Match, ImageMatchRelationship, get_or_create_tags_from_img_alt
 
 log = structlog.getLogger()
 
@@ -25,6 +25,21 @@ def parse_result(page: BeautifulSoup) -> Iterator[Any]:
         yield res
 
 
+def get_posted_image_thumb(page: BeautifulSoup) -> Optional[str]:
+    """Get thumbnail url of the searched image from iqdb result page."""
+    for table in page.select(".pages table"):
+        header_tag = table.select_one("th")
+        img_tag = table.select_one("img")
+        if header_tag is not None and header_tag.text == "Your image" and img_tag is not None:
+            return img_tag.attrs.get("src")
+    return None
+
+
+def is_no_match_page(page: BeautifulSoup) -> bool:
+    """Check if iqdb result page tell there is no relevant match, instead of e.g. error page."""
+    return any(x.text == "No relevant matches" for x in page.select(".pages table th"))
+
+
 def parse_table(table: element.Tag) -> Dict[str, Any]:
     """Parse table."""
     header_tag = table.select_one("th")
@@ -94,24 +109,47 @@ def get_or_create_image_match_from_page(
     image: Any,
     place: int = ImageMatch.SP_IQDB,
     force_gray: bool = False,
+    img_alt_tags: bool = False,
+    update_match: bool = False,
 ) -> Iterator["ImageMatch"]:
-    """Get or create from page result."""
+    """Get or create from page result.
+
+    Args:
+        page: iqdb result page
+        image: posted image
+        place: iqdb place
+        force_gray: force gray flag
+        img_alt_tags: create tags from match image alt text
+        update_match: update existing match result from the page, e.g. when reparsing
+    """
     items = parse_result(page)
+    has_match = None
     for item in items:
-        match_result, _ = Match.get_or_create(
-            href=item["href"],
-            defaults={
-                "thumb": item["thumb"],
-                "rating": item["rating"],
-                "img_alt": item["img_alt"],
-                "width": item["size"][0],
-                "height": item["size"][1],
-            },
-        )
-        imr, _ = ImageMatchRelationship.get_or_create(
+        match_data = {
+            "thumb": item["thumb"],
+            "rating": item["rating"],
+            "img_alt": item["img_alt"],
+            "width": item["size"][0],
+            "height": item["size"][1],
+        }
+        match_result, created = Match.get_or_create(href=item["href"], defaults=match_data)
+        if update_match and not created:
+            changed = {key: value for key, value in match_data.items() if getattr(match_result, key) != value}
+            if changed:
+                Match.update(**changed).where(Match.id == match_result.id).execute()
+                for key, value in changed.items():
+                    setattr(match_result, key, value)
+        if img_alt_tags and (created or not match_result.matchtagrelationship_set.exists()):
+            get_or_create_tags_from_img_alt(match_result)
+        if has_match is None:
+            has_match = ImageMatchRelationship.select().where(ImageMatchRelationship.image == image).exists()
+        imr, created = ImageMatchRelationship.get_or_create(
             image=image,
             match_result=match_result,
         )
+        if created and not has_match:
+            Counter.add(Counter.IMAGES_WITH_MATCH)
+            has_match = True
         yield ImageMatch.get_or_create(
             match=imr,
             search_place=place,
@@ -0,0 +1,182 @@
+"""pipeline module."""
+import queue
+import threading
+from typing import Any, Callable, Iterable, Iterator, List, Optional
+
+import structlog
+
+DEFAULT_QUEUE_SIZE = 16
+log = structlog.getLogger()
+
+
+class Stage:
+    """Pipeline stage."""
+
+    def __init__(
+        self,
+        name: str,
+        func: Callable[[Any], Any],
+        workers: int = 1,
+        on_error: Optional[Callable[[Any, Exception], None]] = None,
+        discard: Optional[Callable[[Any], None]] = None,
+    ) -> None:
+        """Init method.
+
+        Args:
+            name: stage name
+            func: function called for every item, return None to drop the item
+            workers: number of threads running the function
+            on_error: function called with the item and the error raised by `func`, e.g. to report the failed item
+            discard: function called for result of this stage which is not processed by the next stage or consumer
+                because the pipeline is closed, e.g. to remove temporary file of the result
+        """
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.on_error = on_error
+        self.discard = discard
+
+    def discard_result(self, result: Any) -> None:
+        """Discard stage result which won't be processed."""
+        if self.discard is None:
+            return
+        try:
+            self.discard(result)
+        except Exception:  # pylint: disable=broad-except
+            log.exception("pipeline discard error", stage=self.name)
+
+
+class Pipeline:
+    """Run items through stages connected by bounded queues.
+
+    Every stage take items from its input queue and put the results to the next stage queue.
+    Queue size limit the number of items between stages, so a slow stage block the faster ones before it
+    and memory stay bounded. Error in stage function is logged and passed to the stage `on_error` function,
+    then the item is dropped. Results left in the queues when the pipeline is closed early are passed to the stage
+    `discard` function.
+    Error raised by the input iterator stop the pipeline and is raised by `run` after the items read before it.
+    """
+
+    STOP = object()
+
+    def __init__(self, stages: List[Stage], queue_size: int = DEFAULT_QUEUE_SIZE) -> None:
+        """Init method.
+
+        Args:
+            stages: pipeline stages
+            queue_size: maximum number of items waiting for each stage
+        """
+        self.stages = stages
+        self.queue_size = queue_size
+        self.closed = threading.Event()
+        self.input_error: Optional[BaseException] = None
+
+    def put(self, q: "queue.Queue[Any]", item: Any) -> bool:
+        """Put item to queue, return False if pipeline is closed."""
+        while not self.closed.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(self, q: "queue.Queue[Any]") -> Any:
+        """Get item from queue, return STOP if pipeline is closed."""
+        while not self.closed.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return self.STOP
+
+    def feed(self, items: Iterable[Any], q: "queue.Queue[Any]") -> None:
+        """Put items to the first queue, input error is kept for `run`."""
+        try:
+            for item in items:
+                if not self.put(q, item):
+                    return
+        except Exception as err:  # pylint: disable=broad-except
+            log.debug("pipeline input error", e=str(err))
+            self.input_error = err
+        self.put(q, self.STOP)
+
+    def work(self, stage: Stage, in_q: "queue.Queue[Any]", out_q: "queue.Queue[Any]", counter: List[int], lock: threading.Lock) -> None:
+        """Run stage function for items from the input queue."""
+        while True:
+            item = self.get(in_q)
+            if item is self.STOP:
+                # let other worker of the stage stop
+                self.put(in_q, self.STOP)
+                break
+            try:
+                res = stage.func(item)
+            except Exception as err:  # pylint: disable=broad-except
+                log.exception("pipeline stage error", stage=stage.name)
+                if stage.on_error is not None:
+                    try:
+                        stage.on_error(item, err)
+                    except Exception:  # pylint: disable=broad-except
+                        log.exception("pipeline stage on error failed", stage=stage.name)
+                continue
+            if res is not None and not self.put(out_q, res):
+                stage.discard_result(res)
+                break
+        with lock:
+            counter[0] -= 1
+            is_last = counter[0] == 0
+        if is_last:
+            self.put(out_q, self.STOP)
+
+    def run(self, items: Iterable[Any]) -> Iterator[Any]:
+        """Run items through the stages and yield the results of the last stage.
+
+        Args:
+            items: pipeline input, consumed lazily
+
+        Returns:
+            results of the last stage
+
+        Raises:
+            Exception: error raised by the input iterator, after the results of items read before it
+        """
+        queues = [queue.Queue(self.queue_size) for _ in range(len(self.stages) + 1)]  # type: List[queue.Queue[Any]]
+        threads = [threading.Thread(target=self.feed, args=(items, queues[0]), daemon=True)]
+        for idx, stage in enumerate(self.stages):
+            counter, lock = [stage.workers], threading.Lock()
+            for _ in range(stage.workers):
+                args = (stage, queues[idx], queues[idx + 1], counter, lock)
+                threads.append(threading.Thread(target=self.work, args=args, name=stage.name, daemon=True))
+        for thread in threads:
+            thread.start()
+        try:
+            while True:
+                item = self.get(queues[-1])
+                if item is self.STOP:
+                    break
+                yield item
+            if self.input_error is not None:
+                raise self.input_error
+        finally:
+            self.closed.set()
+            for thread in threads:
+                thread.join()
+            # results which the next stage or the consumer won't process
+            for stage, q in zip(self.stages, queues[1:]):
+                while not q.empty():
+                    res = q.get_nowait()
+                    if res is not self.STOP:
+                        stage.discard_result(res)
+
+
+def read_ahead(items: Iterable[Any], size: int = 1) -> Iterator[Any]:
+    """Iterate items while the next ones are read by another thread.
+
+    Args:
+        items: items to be read, e.g. generator which fetch data on each step
+        size: maximum number of items read ahead
+
+    Returns:
+        the items
+    """
+    yield from Pipeline([], queue_size=size).run(items)
@@ -0,0 +1,73 @@
+"""rate limit module."""
+import time
+from typing import Any
+from urllib.parse import urlparse
+
+import requests
+import structlog
+from requests.adapters import BaseAdapter
+
+from .models import RateLimit
+
+DEFAULT_INTERVAL = 1.0
+log = structlog.getLogger()
+
+
+class RateLimiter:
+    """Limit request rate per key, e.g. host, for all workers sharing the database.
+
+    Every request reserve the next time slot of its key with compare-and-swap update,
+    so requests to the same key are at least interval seconds apart across processes and hosts.
+    Hosts are expected to have synchronized clocks.
+    """
+
+    def __init__(self, interval: float = DEFAULT_INTERVAL) -> None:
+        """Init method.
+
+        Args:
+            interval: minimum seconds between requests with the same key
+        """
+        self.interval = interval
+
+    def reserve(self, key: str) -> float:
+        """Reserve time slot for the key, return seconds to wait until the slot."""
+        while True:
+            entry = RateLimit.get_or_create(key=key)[0]
+            now = time.time()
+            slot = max(now, entry.next_time)
+            query = RateLimit.update(next_time=slot + self.interval).where(RateLimit.key == key, RateLimit.next_time == entry.next_time)
+            if query.execute():
+                return slot - now
+
+    def wait(self, key: str) -> None:
+        """Wait until request with the key is allowed."""
+        if self.interval <= 0:
+            return
+        delay = self.reserve(key)
+        if delay > 0:
+            log.debug("rate limited", key=key, delay=round(delay, 3))
+            time.sleep(delay)
+
+    def mount(self, session: requests.Session) -> None:
+        """Limit request rate of the session per host."""
+        for prefix in ("http://", "https://"):
+            session.mount(prefix, RateLimitAdapter(self, session.get_adapter(prefix)))
+
+
+class RateLimitAdapter(BaseAdapter):
+    """Transport adapter which wait for the host rate limit before the wrapped adapter."""
+
+    def __init__(self, limiter: RateLimiter, adapter: BaseAdapter) -> None:
+        """Init method."""
+        super().__init__()
+        self.limiter = limiter
+        self.adapter = adapter
+
+    def send(self, request: requests.PreparedRequest, **kwargs: Any) -> requests.Response:  # pylint: disable=arguments-differ
+        """Send request when the host rate limit allow it."""
+        self.limiter.wait(urlparse(request.url).netloc)
+        return self.adapter.send(request, **kwargs)
+
+    def close(self) -> None:
+        """Close wrapped adapter."""
+        self.adapter.close()
@@ -3,6 +3,10 @@
 """sha256 module."""
 import hashlib
 import sys
+from tempfile import SpooledTemporaryFile
+from typing import IO, Tuple
+
+SPOOL_MAX_SIZE = 4 * 1024 * 1024
 
 
 def sha256_checksum(filename: str, block_size: int = 65536) -> str:
@@ -14,6 +18,26 @@ def sha256_checksum(filename: str, block_size: int = 65536) -> str:
     return sha256.hexdigest()
 
 
+def spool_stream(stream: IO[bytes], max_size: int = SPOOL_MAX_SIZE, block_size: int = 65536) -> Tuple[IO[bytes], str]:
+    """Copy stream to spooled temporary file while computing its sha256 checksum.
+
+    Args:
+        stream: input stream, e.g. uploaded file
+        max_size: file size kept in memory before it is written to disk
+        block_size: read size
+
+    Returns:
+        spooled file at position 0 and its checksum
+    """
+    sha256 = hashlib.sha256()
+    spooled = SpooledTemporaryFile(max_size=max_size)  # pylint: disable=consider-using-with
+    for block in iter(lambda: stream.read(block_size), b""):
+        sha256.update(block)
+        spooled.write(block)
+    spooled.seek(0)
+    return spooled, sha256.hexdigest()
+
+
 def main() -> None:
     """Run main func for module."""
     for f in sys.argv[1:]:
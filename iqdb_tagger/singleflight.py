@@ -0,0 +1,67 @@
+"""singleflight module."""
+import threading
+from typing import Any, Callable, Dict, Hashable, Optional
+
+import structlog
+
+log = structlog.getLogger()
+
+
+class Call:
+    """In-flight call."""
+
+    def __init__(self) -> None:
+        """Init method."""
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+        self.n_shared = 0
+
+
+class SingleFlight:
+    """Coalesce concurrent calls with the same key into one.
+
+    The first caller of a key run the function, other callers with the same key wait and get its result or exception.
+    The key is released when the call finished, so later caller will run the function again
+    (and usually find the result in the database).
+    """
+
+    def __init__(self) -> None:
+        """Init method."""
+        self.lock = threading.Lock()
+        self.calls: Dict[Hashable, Call] = {}
+
+    def do(self, key: Hashable, func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        """Run function once for all concurrent callers with the same key.
+
+        Args:
+            key: call key, e.g. image checksum and iqdb place
+            func: function to be called
+            *args: function positional arguments
+            **kwargs: function keyword arguments
+
+        Returns:
+            function result
+        """
+        with self.lock:
+            in_flight = self.calls.get(key)
+            if in_flight is None:
+                call = self.calls[key] = Call()
+            else:
+                in_flight.n_shared += 1
+        if in_flight is not None:
+            log.debug("wait in-flight call", key=key)
+            in_flight.done.wait()
+            if in_flight.error is not None:
+                raise in_flight.error
+            return in_flight.result
+        try:
+            call.result = func(*args, **kwargs)
+        except BaseException as err:
+            call.error = err
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+        return call.result
@@ -0,0 +1,363 @@
+"""snapshot module."""
+import datetime
+import gzip
+import io
+import json
+from typing import Any, BinaryIO, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+import structlog
+from peewee import chunked
+
+from . import models
+from .models import ImageMatch, ImageMatchRelationship, ImageModel, Match, MatchTagRelationship, Tag, ThumbnailRelationship
+
+FORMAT = "iqdb-tagger-snapshot"
+FORMAT_VERSION = 1
+BATCH_SIZE = 500
+# rows per insert statement, below sqlite variable limit
+INSERT_SIZE = 100
+log = structlog.getLogger()
+
+
+def iter_chunks(ids: Iterable[int], size: int = BATCH_SIZE) -> Iterator[List[int]]:
+    """Iterate ids in chunks without loading all of them."""
+    chunk: List[int] = []
+    for item_id in ids:
+        chunk.append(item_id)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def get_image_record(image: ImageModel, originals: List[str], image_matches: List[ImageMatch]) -> Dict[str, Any]:
+    """Get snapshot record of posted image."""
+    return {
+        "type": "image",
+        "checksum": image.checksum,
+        "width": image.width,
+        "height": image.height,
+        "thumbnail_of": originals,
+        "matches": [
+            {
+                "href": x.match.match_result.href,
+                "place": x.search_place,
+                "similarity": x.similarity,
+                "status": x.status,
+                "force_gray": x.force_gray,
+            }
+            for x in image_matches
+        ],
+    }
+
+
+def get_match_records(match_ids: List[int]) -> Iterator[Dict[str, Any]]:
+    """Get snapshot records of match results with their tags."""
+    tags: Dict[int, Dict[str, List[Tuple[Optional[str], str]]]] = {}
+    query = (
+        MatchTagRelationship.select(MatchTagRelationship.match, MatchTagRelationship.from_img_alt, Tag.namespace, Tag.name)
+        .join(Tag)
+        .where(MatchTagRelationship.match.in_(match_ids))
+        .order_by(MatchTagRelationship.id)
+        .tuples()
+    )
+    for match_id, from_img_alt, namespace, name in query:
+        tags.setdefault(match_id, {}).setdefault("img_alt_tags" if from_img_alt else "tags", []).append((namespace, name))
+    for match_result in Match.select().where(Match.id.in_(match_ids)).order_by(Match.id):
+        yield {
+            "type": "match",
+            "href": match_result.href,
+            "thumb": match_result.thumb,
+            "rating": match_result.rating,
+            "img_alt": match_result.img_alt,
+            "width": match_result.width,
+            "height": match_result.height,
+            "tags": tags.get(match_result.id, {}).get("tags", []),
+            "img_alt_tags": tags.get(match_result.id, {}).get("img_alt_tags", []),
+        }
+
+
+def iter_records(since: Optional[datetime.datetime] = None) -> Iterator[Dict[str, Any]]:
+    """Iterate snapshot records, each match result and original image come before the image referencing it.
+
+    Args:
+        since: only include image matches and match tags created since this date
+
+    Returns:
+        snapshot records
+    """
+    written_images: Set[int] = set()
+    written_matches: Set[int] = set()
+    image_ids = ImageMatchRelationship.select(ImageMatchRelationship.image).join(ImageMatch).distinct()
+    if since is not None:
+        image_ids = image_ids.where(ImageMatch.created_date >= since)
+    image_ids = image_ids.order_by(ImageMatchRelationship.image).tuples().iterator()
+    for chunk in iter_chunks(x[0] for x in image_ids):
+        query = (
+            ImageMatch.select(ImageMatch, ImageMatchRelationship, Match)
+            .join(ImageMatchRelationship)
+            .join(Match)
+            .where(ImageMatchRelationship.image.in_(chunk))
+            .order_by(ImageMatch.id)
+        )
+        if since is not None:
+            query = query.where(ImageMatch.created_date >= since)
+        image_matches: Dict[int, List[ImageMatch]] = {}
+        for item in query:
+            image_matches.setdefault(item.match.image_id, []).append(item)
+        original = ImageModel.alias()
+        thumb_rels = (
+            ThumbnailRelationship.select(ThumbnailRelationship, original)
+            .join(original, on=(ThumbnailRelationship.original == original.id))
+            .where(ThumbnailRelationship.thumbnail.in_(chunk))
+            .order_by(ThumbnailRelationship.id)
+        )
+        originals: Dict[int, List[ImageModel]] = {}
+        for rel in thumb_rels:
+            originals.setdefault(rel.thumbnail_id, []).append(rel.original)
+        for image in sum(originals.values(), []):
+            if image.id not in written_images:
+                written_images.add(image.id)
+                yield get_image_record(image, [], [])
+        match_ids = sorted({x.match.match_result_id for items in image_matches.values() for x in items} - written_matches)
+        written_matches.update(match_ids)
+        yield from get_match_records(match_ids)
+        for image in ImageModel.select().where(ImageModel.id.in_(chunk)).order_by(ImageModel.id):
+            written_images.add(image.id)
+            yield get_image_record(image, [x.checksum for x in originals.get(image.id, [])], image_matches.get(image.id, []))
+    if since is None:
+        return
+    # tags fetched after the image was searched
+    match_ids = MatchTagRelationship.select(MatchTagRelationship.match).where(MatchTagRelationship.created_date >= since).distinct()
+    for chunk in iter_chunks(x[0] for x in match_ids.order_by(MatchTagRelationship.match).tuples().iterator()):
+        yield from get_match_records(sorted(set(chunk) - written_matches))
+
+
+def export_snapshot(f: BinaryIO, since: Optional[datetime.datetime] = None) -> Dict[str, int]:
+    """Write compressed snapshot of search results, keyed by image checksum and match url.
+
+    Args:
+        f: binary file object
+        since: only export changes since this date, e.g. creation date of the previous snapshot
+
+    Returns:
+        number of exported records for each record type
+    """
+    counts = {"image": 0, "match": 0}
+    header = {
+        "type": FORMAT,
+        "version": FORMAT_VERSION,
+        "created_date": datetime.datetime.now().isoformat(),
+        "since": since.isoformat() if since is not None else None,
+    }
+    with gzip.GzipFile(fileobj=f, mode="wb") as gz, io.TextIOWrapper(gz, encoding="utf-8") as text_f:
+        text_f.write(json.dumps(header) + "\n")
+        with models.db.atomic():
+            # read in one transaction, so records added during export don't break the snapshot
+            for record in iter_records(since):
+                counts[record["type"]] += 1
+                text_f.write(json.dumps(record, separators=(",", ":")) + "\n")
+    return counts
+
+
+def read_snapshot(f: BinaryIO) -> Iterator[Dict[str, Any]]:
+    """Read snapshot records after checking snapshot header."""
+    with gzip.GzipFile(fileobj=f, mode="rb") as gz, io.TextIOWrapper(gz, encoding="utf-8") as text_f:
+        header = json.loads(text_f.readline() or "{}")
+        if header.get("type") != FORMAT or header.get("version", 0) > FORMAT_VERSION:
+            raise ValueError("Unsupported snapshot: {}".format(header))
+        for line in text_f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def get_or_insert_ids(model: Any, field: Any, rows: Dict[str, Dict[str, Any]]) -> Dict[str, int]:
+    """Get id of rows by unique field value, missing rows are inserted.
+
+    Args:
+        model: model
+        field: unique field
+        rows: row data by unique field value
+
+    Returns:
+        id by unique field value
+    """
+    keys = list(rows)
+    ids = {x[1]: x[0] for x in model.select(model.id, field).where(field.in_(keys)).tuples()}
+    missing = [rows[x] for x in keys if x not in ids]
+    if missing:
+        for batch in chunked(missing, INSERT_SIZE):
+            model.insert_many(batch).on_conflict_ignore().execute()
+        missing_keys = [x for x in keys if x not in ids]
+        ids.update({x[1]: x[0] for x in model.select(model.id, field).where(field.in_(missing_keys)).tuples()})
+    return ids
+
+
+class SnapshotImporter:
+    """Merge snapshot records into the database in batches.
+
+    Images are deduplicated by checksum, match results by url and tags by name and namespace.
+    Existing rows are kept, only missing image matches, tags and thumbnail relationships are added.
+    Imported rows get the import date as creation date, so they are part of the next delta snapshot.
+    """
+
+    def __init__(self, batch_size: int = BATCH_SIZE) -> None:
+        """Init method.
+
+        Args:
+            batch_size: number of records merged in one transaction
+        """
+        self.batch_size = batch_size
+        self.tag_ids: Dict[Tuple[Optional[str], str], int] = {}
+        self.images: List[Dict[str, Any]] = []
+        self.matches: List[Dict[str, Any]] = []
+        self.counts = {"image": 0, "match": 0, "image_match": 0, "tag": 0}
+
+    def add(self, record: Dict[str, Any]) -> None:
+        """Add record, records are merged when the batch is full."""
+        if record.get("type") == "match":
+            self.matches.append(record)
+        elif record.get("type") == "image":
+            self.images.append(record)
+        else:
+            log.debug("unknown snapshot record", type=record.get("type"))
+        if len(self.images) + len(self.matches) >= self.batch_size:
+            self.flush()
+
+    def get_tag_id(self, namespace: Optional[str], name: str) -> int:
+        """Get tag id, tag is created when it doesn't exist."""
+        key = (namespace, name)
+        if key not in self.tag_ids:
+            self.tag_ids[key] = Tag.get_or_create(name=name, namespace=namespace)[0].id
+        return self.tag_ids[key]
+
+    def flush(self) -> None:
+        """Merge added records."""
+        if not self.images and not self.matches:
+            return
+        with models.db.atomic():
+            self.merge_matches(self.matches)
+            self.merge_images(self.images)
+        self.images, self.matches = [], []
+
+    def merge_matches(self, records: List[Dict[str, Any]]) -> None:
+        """Merge match results and their tags."""
+        if not records:
+            return
+        rows = {}
+        for record in records:
+            rows[record["href"]] = {
+                "href": record["href"],
+                "thumb": record["thumb"],
+                "rating": record["rating"],
+                "img_alt": record.get("img_alt"),
+                "width": record.get("width"),
+                "height": record.get("height"),
+            }
+        match_ids = get_or_insert_ids(Match, Match.href, rows)
+        # whether existing tags of match result are only from image alt text
+        img_alt_only = {
+            x[0]: x[1]
+            for x in MatchTagRelationship.select(MatchTagRelationship.match, MatchTagRelationship.from_img_alt)
+            .where(MatchTagRelationship.match.in_(list(match_ids.values())))
+            .order_by(MatchTagRelationship.from_img_alt.desc())
+            .tuples()
+        }
+        mtr_rows = []
+        for record in records:
+            match_id = match_ids[record["href"]]
+            if record.get("tags"):
+                if img_alt_only.get(match_id):
+                    # tags from tag page replace the ones from image alt text
+                    MatchTagRelationship.delete().where(
+                        MatchTagRelationship.match == match_id,
+                        MatchTagRelationship.from_img_alt == True,  # NOQA; pylint: disable=singleton-comparison
+                    ).execute()
+                img_alt_only[match_id] = False
+                tags, from_img_alt = record["tags"], False
+            elif record.get("img_alt_tags") and match_id not in img_alt_only:
+                img_alt_only[match_id] = True
+                tags, from_img_alt = record["img_alt_tags"], True
+            else:
+                continue
+            for namespace, name in tags:
+                mtr_rows.append({"match": match_id, "tag": self.get_tag_id(namespace, name), "from_img_alt": from_img_alt})
+        for batch in chunked(mtr_rows, INSERT_SIZE):
+            self.counts["tag"] += MatchTagRelationship.insert_many(batch).on_conflict_ignore().as_rowcount().execute()
+        self.counts["match"] += len(records)
+
+    def merge_images(self, records: List[Dict[str, Any]]) -> None:
+        """Merge images, their thumbnail relationships and image matches."""
+        if not records:
+            return
+        rows = {x["checksum"]: {"checksum": x["checksum"], "width": x["width"], "height": x["height"]} for x in records}
+        originals = {y for x in records for y in x.get("thumbnail_of", [])}
+        image_ids = get_or_insert_ids(ImageModel, ImageModel.checksum, rows)
+        original_query = ImageModel.select(ImageModel.id, ImageModel.checksum).where(ImageModel.checksum.in_(list(originals)))
+        image_ids.update({x[1]: x[0] for x in original_query.tuples()})
+        thumb_rows = [
+            {"original": image_ids[y], "thumbnail": image_ids[x["checksum"]]}
+            for x in records
+            for y in x.get("thumbnail_of", [])
+            if y in image_ids
+        ]
+        for batch in chunked(thumb_rows, INSERT_SIZE):
+            ThumbnailRelationship.insert_many(batch).on_conflict_ignore().execute()
+        hrefs = list({y["href"] for x in records for y in x["matches"]})
+        match_ids = {x[1]: x[0] for x in Match.select(Match.id, Match.href).where(Match.href.in_(hrefs)).tuples()}
+        imr_rows = [
+            {"image": image_ids[x["checksum"]], "match_result": match_ids[y["href"]]}
+            for x in records
+            for y in x["matches"]
+            if y["href"] in match_ids
+        ]
+        new_images = set()
+        if imr_rows:
+            with_match = ImageMatchRelationship.select(ImageMatchRelationship.image).where(
+                ImageMatchRelationship.image.in_([x["image"] for x in imr_rows])
+            )
+            new_images = {x["image"] for x in imr_rows} - {x[0] for x in with_match.tuples()}
+        for batch in chunked(imr_rows, INSERT_SIZE):
+            ImageMatchRelationship.insert_many(batch).on_conflict_ignore().execute()
+        imr_query = ImageMatchRelationship.select(
+            ImageMatchRelationship.id, ImageMatchRelationship.image, ImageMatchRelationship.match_result
+        ).where(ImageMatchRelationship.image.in_(list(image_ids.values())))
+        imr_ids = {(x[1], x[2]): x[0] for x in imr_query.tuples()}
+        im_rows = []
+        for record in records:
+            for item in record["matches"]:
+                imr_id = imr_ids.get((image_ids[record["checksum"]], match_ids.get(item["href"])))
+                if imr_id is None:
+                    log.debug("match result not found in snapshot", href=item["href"])
+                    continue
+                im_rows.append(
+                    {
+                        "match": imr_id,
+                        "similarity": item["similarity"],
+                        "status": item["status"],
+                        "search_place": item["place"],
+                        "force_gray": item.get("force_gray", False),
+                    }
+                )
+        for batch in chunked(im_rows, INSERT_SIZE):
+            self.counts["image_match"] += ImageMatch.insert_many(batch).on_conflict_ignore().as_rowcount().execute()
+        models.Counter.add(models.Counter.IMAGES_WITH_MATCH, len(new_images))
+        self.counts["image"] += len(records)
+
+
+def import_snapshot(f: BinaryIO, batch_size: int = BATCH_SIZE) -> Dict[str, int]:
+    """Merge snapshot into the database.
+
+    Args:
+        f: binary file object
+        batch_size: number of records merged in one transaction
+
+    Returns:
+        number of imported images, match results, added image matches and added match tags
+    """
+    importer = SnapshotImporter(batch_size)
+    for record in read_snapshot(f):
+        importer.add(record)
+    importer.flush()
+    return importer.counts
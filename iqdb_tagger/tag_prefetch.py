@@ -0,0 +1,90 @@
+"""tag prefetch module."""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, List, Set
+from urllib.parse import urlparse
+
+import structlog
+
+from .models import Match, MatchTagRelationship, NegativeResult, db_connection, get_tags_from_match_result
+
+DEFAULT_MAX_WORKERS = 2
+# hosts which tags are not fetched
+FILTERED_HOSTS = ("anime-pictures.net", "www.theanimegallery.com")
+log = structlog.getLogger()
+
+
+class TagPrefetcher:
+    """Fetch tags of match results in background threads.
+
+    Queued and running match results are tracked, so views can show that their tags are pending.
+    """
+
+    def __init__(self, max_workers: int = DEFAULT_MAX_WORKERS) -> None:
+        """Init method.
+
+        Args:
+            max_workers: number of concurrent tag page fetches
+        """
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tag-prefetch")
+        self.pending: Set[int] = set()
+        self.lock = threading.Lock()
+
+    def submit(self, match_ids: Iterable[int]) -> List[int]:
+        """Queue tag fetch of match results without tags.
+
+        Match results with tags from tag page, with recent negative result, from `FILTERED_HOSTS`
+        or already pending are skipped.
+
+        Args:
+            match_ids: match result ids
+
+        Returns:
+            ids of queued match results
+        """
+        match_ids = set(match_ids)
+        if not match_ids:
+            return []
+        tagged_ids = {
+            x.match_id
+            for x in MatchTagRelationship.select(MatchTagRelationship.match).where(
+                MatchTagRelationship.match.in_(match_ids),
+                MatchTagRelationship.from_img_alt == False,  # NOQA; pylint: disable=singleton-comparison
+            )
+        }
+        match_results = Match.select().where(Match.id.in_(match_ids - tagged_ids)).order_by(Match.id)
+        queued = []
+        with self.lock:
+            for match_result in match_results:
+                if match_result.id in self.pending or NegativeResult.get_unexpired(match_result.link) is not None:
+                    continue
+                if urlparse(match_result.link).netloc in FILTERED_HOSTS:
+                    log.debug("URL in filtered hosts, no tag fetched", url=match_result.link)
+                    continue
+                self.pending.add(match_result.id)
+                queued.append(match_result.id)
+        for match_id in queued:
+            self.executor.submit(self.fetch, match_id)
+        return queued
+
+    @db_connection
+    def fetch(self, match_id: int) -> None:
+        """Fetch tags of match result."""
+        try:
+            match_result = Match.get_or_none(Match.id == match_id)
+            if match_result is not None:
+                get_tags_from_match_result(match_result)
+        except Exception:  # pylint: disable=broad-except
+            log.exception("tag prefetch failed", match_id=match_id)
+        finally:
+            with self.lock:
+                self.pending.discard(match_id)
+
+    def is_pending(self, match_id: int) -> bool:
+        """Check if tags of match result are queued or being fetched."""
+        return match_id in self.pending
+
+    def shutdown(self, wait: bool = True) -> None:
+        """Stop the executor."""
+        self.executor.shutdown(wait=wait)
@@ -0,0 +1,103 @@
+"""thumbnail module."""
+import os
+import pathlib
+import threading
+from tempfile import NamedTemporaryFile
+from typing import Optional, Tuple
+
+import structlog
+from PIL import Image
+
+from .models import ImageModel
+from .singleflight import SingleFlight
+
+DEFAULT_MAX_FILES = 1000
+MAX_SIZE = 2048
+# thumbnail file names are content-addressed, so they never change
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+log = structlog.getLogger()
+
+
+def get_source_path(image: ImageModel) -> Optional[str]:
+    """Get path of image file or of its biggest thumbnail when the image file doesn't exist anymore."""
+    if image.path and os.path.isfile(image.path):
+        return image.path
+    thumbnails = sorted((x.thumbnail for x in image.thumbnails), key=lambda x: x.width * x.height, reverse=True)
+    for thumb in thumbnails:
+        if thumb.path and os.path.isfile(thumb.path):
+            return thumb.path
+    return None
+
+
+class ResizeCache:
+    """Disk cache of images resized on demand.
+
+    The number of files is bounded, least recently used files are removed first.
+    Concurrent requests for the same file resize the image once.
+    """
+
+    def __init__(self, folder: str, max_files: int = DEFAULT_MAX_FILES) -> None:
+        """Init method.
+
+        Args:
+            folder: cache folder
+            max_files: maximum number of cached files
+        """
+        self.folder = folder
+        self.max_files = max_files
+        self.flight = SingleFlight()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_basename(checksum: str, size: Tuple[int, int]) -> str:
+        """Get file name of resized image."""
+        return "{}-{}-{}.jpg".format(checksum, size[0], size[1])
+
+    def get(self, image: ImageModel, size: Tuple[int, int]) -> Optional[str]:
+        """Get path of image resized to fit the size, resized when it is not cached.
+
+        Args:
+            image: image
+            size: maximum width and height
+
+        Returns:
+            path of resized image, None if there is no image file to resize
+        """
+        path = os.path.join(self.folder, self.get_basename(image.checksum, size))
+        if os.path.isfile(path):
+            # mark as recently used
+            os.utime(path)
+            return path
+        return self.flight.do(path, self.create, image, size, path)
+
+    def create(self, image: ImageModel, size: Tuple[int, int], path: str) -> Optional[str]:
+        """Resize image to the path."""
+        if os.path.isfile(path):
+            return path
+        source_path = get_source_path(image)
+        if source_path is None:
+            log.debug("no image file to resize", checksum=image.checksum)
+            return None
+        pathlib.Path(self.folder).mkdir(parents=True, exist_ok=True)
+        im = Image.open(source_path)
+        im.thumbnail(size, Image.ANTIALIAS)
+        if im.mode not in ("RGB", "L"):
+            im = im.convert("RGB")
+        with NamedTemporaryFile(dir=self.folder, suffix=".tmp", delete=False) as f:
+            im.save(f, "JPEG")
+        os.replace(f.name, path)
+        self.prune()
+        return path
+
+    def prune(self) -> None:
+        """Remove least recently used files over the limit."""
+        with self.lock:
+            paths = [os.path.join(self.folder, x) for x in os.listdir(self.folder) if x.endswith(".jpg")]
+            if len(paths) <= self.max_files:
+                return
+            paths.sort(key=os.path.getmtime)
+            for path in paths[: len(paths) - self.max_files]:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
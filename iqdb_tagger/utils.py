@@ -7,3 +7,6 @@ from appdirs import user_data_dir
 user_data_dir = user_data_dir("iqdb_tagger", "softashell")
 default_db_path = os.path.join(user_data_dir, "iqdb.db")
 thumb_folder = os.path.join(user_data_dir, "thumbs")
+http_cache_path = os.path.join(user_data_dir, "http_cache.db")
+archive_folder = os.path.join(user_data_dir, "archive")
+resize_cache_folder = os.path.join(user_data_dir, "resized")
@@ -1,24 +1,200 @@
 """views module."""
+import json
+import os
+import shutil
+from concurrent.futures import as_completed, wait
 from tempfile import NamedTemporaryFile
-from typing import Any
-from urllib.parse import urlparse
+from typing import IO, Any, Callable, Dict, Iterator, List, Optional, Tuple
 
-import requests
-from flask import abort, current_app, flash, redirect, request, url_for
+from bs4 import BeautifulSoup
+from flask import Response, abort, current_app, redirect, request, stream_with_context, url_for
 from flask_admin import AdminIndexView, BaseView, expose
-from flask_paginate import Pagination, get_page_parameter
 from flask_restful import Resource
 
-from . import forms, models, parse
+from . import forms, jobs, models, parse
 from .models import (
-    ImageMatch,
     ImageMatchRelationship,
     ImageModel,
+    db_connection,
     get_page_result,
     get_posted_image,
     get_tags_from_match_result,
     iqdb_url_dict,
+    is_public_url,
 )
+from .sha256 import spool_stream
+from .tag_prefetch import TagPrefetcher
+
+
+def get_job_queue() -> jobs.JobQueue:
+    """Get job queue of current app."""
+    return current_app.extensions["iqdb_tagger_jobs"]
+
+
+def get_tag_prefetcher() -> TagPrefetcher:
+    """Get tag prefetcher of current app."""
+    return current_app.extensions["iqdb_tagger_tag_prefetcher"]
+
+
+def get_thumb_folder() -> str:
+    """Get thumbnail folder of current app."""
+    return current_app.config["IQDB_TAGGER_THUMB_FOLDER"]
+
+
+def get_match_dict(match: models.ImageMatch, with_tags: bool = False) -> Dict[str, Any]:
+    """Get json serializable image match."""
+    match_result = match.match.match_result
+    res = {"href": match_result.link, "similarity": match.similarity, "status": match.status_verbose, "place": match.search_place_verbose}
+    if with_tags:
+        res["tags"] = [x.full_name for x in get_tags_from_match_result(match_result)]
+    return res
+
+
+def get_match_result(posted_img: ImageModel, place: int, with_tags: bool = False) -> Dict[str, Any]:
+    """Get json serializable matches of posted image."""
+    matches = models.get_image_matches(posted_img, place)
+    return {"checksum": posted_img.checksum, "matches": [get_match_dict(x, with_tags) for x in matches]}
+
+
+@db_connection
+def search_checksum(checksum: str, resize: bool, place: str, with_tags: bool = False) -> Optional[Dict[str, Any]]:
+    """Get matches of previously searched image by its checksum.
+
+    Args:
+        checksum: image sha256 checksum
+        resize: image was resized before upload
+        place: iqdb place, see `iqdb_url_dict`
+        with_tags: include tags of every match
+
+    Returns:
+        posted image checksum and matches, None if the image is not searched yet
+    """
+    cached = models.get_cached_image_matches(checksum, iqdb_url_dict[place][1], resize=resize)
+    if cached is None:
+        return None
+    matches, posted_checksum = cached
+    return {"checksum": posted_checksum, "matches": [get_match_dict(x, with_tags) for x in matches]}
+
+
+def write_temp_files(spooled: IO[bytes]) -> Tuple[str, str]:
+    """Write spooled upload to temporary file for search.
+
+    Args:
+        spooled: spooled upload, closed afterwards
+
+    Returns:
+        image path and path for resized image, both removed by `search_file`
+    """
+    with spooled, NamedTemporaryFile(delete=False) as temp, NamedTemporaryFile(delete=False) as thumb_temp:
+        shutil.copyfileobj(spooled, temp)
+    return temp.name, thumb_temp.name
+
+
+@db_connection
+def search_file(  # pylint: disable=too-many-arguments
+    image_path: str,
+    thumb_path: str,
+    resize: bool,
+    place: str,
+    with_tags: bool = False,
+    output_thumb_folder: Optional[str] = None,
+    tag_prefetcher: Optional[TagPrefetcher] = None,
+) -> Dict[str, Any]:
+    """Search image file and remove it, run as background job.
+
+    Args:
+        image_path: image path
+        thumb_path: path for resized image
+        resize: resize image before upload
+        place: iqdb place, see `iqdb_url_dict`
+        with_tags: include tags of every match
+        output_thumb_folder: folder which keep the resized image, see `models.clear_temp_paths`
+        tag_prefetcher: fetch tags of new matches in background
+
+    Returns:
+        posted image checksum and matches
+    """
+    url, im_place = iqdb_url_dict[place]
+    try:
+        posted_img = get_posted_image(img_path=image_path, resize=resize, thumb_path=thumb_path)
+        if not models.get_image_matches(posted_img, im_place):
+            posted_img_path = image_path if not resize else thumb_path
+            result_page = get_page_result(image=posted_img_path, url=url, use_requests=place != "e621")
+            result = parse.get_or_create_image_match_from_page(page=BeautifulSoup(result_page, "lxml"), image=posted_img, place=im_place)
+            match_ids = [x[0].match.match_result_id for x in result]
+            if tag_prefetcher is not None:
+                # have the tags ready when the match detail is opened
+                tag_prefetcher.submit(match_ids)
+    finally:
+        models.clear_temp_paths([image_path, thumb_path], output_thumb_folder)
+        for item in (image_path, thumb_path):
+            if os.path.isfile(item):
+                os.remove(item)
+    return get_match_result(posted_img, im_place, with_tags)
+
+
+@db_connection
+def search_url(
+    search_image_url: Callable[..., Tuple[Any, Optional[str]]], image_url: str, resize: bool, place: str, with_tags: bool = False
+) -> Dict[str, Any]:
+    """Search image url, run as background job.
+
+    Args:
+        search_image_url: search function shared with command line, see `iqdb_tagger.__main__.search_image_url`
+        image_url: image url
+        resize: resize image before upload when it have to be downloaded
+        place: iqdb place, see `iqdb_url_dict`
+        with_tags: include tags of every match
+
+    Returns:
+        posted image checksum and matches, checksum is None when the url recently have no match
+    """
+    checksum = search_image_url(image_url, resize=resize, place=place, check_url=is_public_url)[1]
+    if checksum is None:
+        return {"checksum": None, "matches": []}
+    posted_img = ImageModel.get(ImageModel.checksum == checksum)
+    return get_match_result(posted_img, iqdb_url_dict[place][1], with_tags)
+
+
+def iter_batch_results(
+    items: List[Tuple[Dict[str, Any], Callable[..., Optional[Dict[str, Any]]], Tuple[Any, ...]]],
+    job_queue: jobs.JobQueue,
+    temp_paths: List[str],
+) -> Iterator[str]:
+    """Search items concurrently and yield every result as json line when it is completed.
+
+    Args:
+        items: item key, search function and its arguments
+        job_queue: job queue which workers search the items, shared with background jobs
+        temp_paths: uploaded files, removed when the batch is finished or cancelled
+
+    Returns:
+        json line for every item with the item key, status and the search result
+    """
+    futures: Dict[Any, Dict[str, Any]] = {}
+    try:
+        futures = {job_queue.submit_task(func, *args): key for key, func, args in items}
+        for future in as_completed(futures):
+            line = dict(futures[future])
+            try:
+                res = future.result()
+                if res is None:
+                    line["status"] = "not_found"
+                else:
+                    line.update(res, status=jobs.Job.STATUS_DONE)
+            except Exception as err:  # pylint: disable=broad-except
+                current_app.logger.exception("batch search failed")
+                line.update(status=jobs.Job.STATUS_FAILED, error=str(err))
+            yield json.dumps(line) + "\n"
+    finally:
+        # client may disconnect before all items are searched
+        for future in futures:
+            future.cancel()
+        # running search may still read the files
+        wait(futures)
+        for item in temp_paths:
+            if os.path.isfile(item):
+                os.remove(item)
 
 
 class HomeView(AdminIndexView):
@@ -30,41 +206,28 @@ class HomeView(AdminIndexView):
         form = forms.ImageUploadForm()
         if form.file.data:
             print("resize:{}".format(form.resize.data))
-            with NamedTemporaryFile(delete=False) as temp, NamedTemporaryFile(delete=False) as thumb_temp:
-                form.file.data.save(temp.name)
-                posted_img = get_posted_image(
-                    img_path=temp.name,
-                    resize=form.resize.data,
-                    thumb_path=thumb_temp.name,
-                )
-                place = [x[1] for x in form.place.choices if x[0] == int(form.place.data)][0]
-                url, im_place = iqdb_url_dict[place]
-                query = posted_img.imagematchrelationship_set.select().join(ImageMatch).where(ImageMatch.search_place == im_place)
-                if not query.exists():
-                    try:
-                        posted_img_path = temp.name if not form.resize.data else thumb_temp.name
-                        result_page = get_page_result(image=posted_img_path, url=url)
-                    except requests.exceptions.ConnectionError as e:
-                        current_app.logger.error(str(e))
-                        flash("Connection error.")
-                        return redirect(request.url)
-                    list(parse.get_or_create_image_match_from_page(page=result_page, image=posted_img, place=im_place))
-            return redirect(url_for("matchview.match_sha256", checksum=posted_img.checksum))
-
-        page = request.args.get(get_page_parameter(), type=int, default=1)
-        item_per_page = 10
-        entries = (
-            ImageModel.select().distinct().join(ImageMatchRelationship).where(ImageMatchRelationship.image).order_by(ImageModel.id.desc())
-        )
-        pagination = Pagination(page=page, total=entries.count(), per_page=item_per_page, bs_version=3)
-        paginated_entries = entries.paginate(page, item_per_page)
-        if not entries.exists() and page != 1:
+            place = [x[1] for x in form.place.choices if x[0] == int(form.place.data)][0]
+            spooled, checksum = spool_stream(form.file.data.stream)
+            cached = search_checksum(checksum, form.resize.data, place)
+            if cached is not None:
+                spooled.close()
+                return redirect(url_for("matchview.match_sha256", checksum=cached["checksum"]))
+            job = get_job_queue().submit(
+                search_file, *write_temp_files(spooled), form.resize.data, place, False, get_thumb_folder(), get_tag_prefetcher()
+            )
+            return redirect(url_for("job.job_status", job_id=job.id))
+
+        before = request.args.get("before", type=int)
+        after = request.args.get("after", type=int)
+        entries, has_newer, has_older = models.get_images_with_match_page(before=before, after=after, limit=10)
+        if not entries and (before is not None or after is not None):
             abort(404)
-        # pagination = Pagination(page, item_per_page, entries.count())
         return self.render(
             "iqdb_tagger/index.html",
-            entries=paginated_entries,
-            pagination=pagination,
+            entries=entries,
+            total=models.count_images_with_match(),
+            newer_url=url_for("admin.index", after=entries[0].id) if has_newer else None,
+            older_url=url_for("admin.index", before=entries[-1].id) if has_older else None,
             form=form,
         )
 
@@ -81,51 +244,127 @@ class MatchView(BaseView):
     def match_sha256(self, checksum: str) -> Any:
         """Get image match the checksum."""
         current_app.logger.debug("match sha256: {}".format(request.url))
-        entry = models.ImageModel.get(models.ImageModel.checksum == checksum)
-        return self.render("iqdb_tagger/match_checksum.html", entry=entry)
+        page_cache = current_app.extensions["iqdb_tagger_page_cache"]
+        key = (checksum,) + models.get_image_match_version(checksum)
+        page = page_cache.get(key)
+        if page is None:
+            entry = models.get_image_with_matches(checksum)
+            if entry is None:
+                abort(404)
+            page = self.render("iqdb_tagger/match_checksum.html", entry=entry)
+            page_cache.set(key, page)
+        return page
 
     @expose("/d/<pair_id>")
     def match_detail(self, pair_id: str) -> Any:
-        """Show single match pair."""
-        nocache = False
-        entry = ImageMatchRelationship.get(ImageMatchRelationship.id == pair_id)
-
+        """Show single match pair, tags not fetched yet are fetched in background."""
+        entry = ImageMatchRelationship.get_or_none(ImageMatchRelationship.id == pair_id)
+        if entry is None:
+            abort(404)
         match_result = entry.match_result
-        mt_rel = models.MatchTagRelationship.select().where(models.MatchTagRelationship.match == match_result)
-        tags = [x.tag.full_name for x in mt_rel]
-        filtered_hosts = ["anime-pictures.net", "www.theanimegallery.com"]
+        tag_prefetcher = get_tag_prefetcher()
+        tag_prefetcher.submit([match_result.id])
+        tags_pending = tag_prefetcher.is_pending(match_result.id)
+        return self.render("iqdb_tagger/match_single.html", entry=entry, tags_pending=tags_pending)
 
-        if urlparse(match_result.link).netloc in filtered_hosts:
-            current_app.logger.debug("URL in filtered hosts, no tag fetched, url:{}".format(match_result.link))
-        elif not tags or nocache:
-            try:
-                tags = list(get_tags_from_match_result(match_result))
-                if not tags:
-                    current_app.logger.debug("Tags not founds, id:{}".format(pair_id))
-            except requests.exceptions.ConnectionError as e:
-                current_app.logger.debug(str(e) + "url:{}".format(match_result.link))
-        return self.render("iqdb_tagger/match_single.html", entry=entry)
+
+class JobView(BaseView):
+    """Background job view."""
+
+    def is_visible(self) -> bool:
+        """Hide view from menu."""
+        return False
+
+    @expose("/")
+    def index(self) -> Any:
+        """Index page."""
+        return redirect(url_for("admin.index"))
+
+    @expose("/<job_id>")
+    def job_status(self, job_id: str) -> Any:
+        """Show job status, redirect to the match when the job is done."""
+        job = get_job_queue().get(job_id)
+        if job is None:
+            abort(404)
+        if job.status == jobs.Job.STATUS_DONE and job.result["checksum"] is not None:
+            return redirect(url_for("matchview.match_sha256", checksum=job.result["checksum"]))
+        return self.render("iqdb_tagger/job.html", job=job)
 
 
 class MatchViewList(Resource):
     """Resource api for MatchViewList."""
 
     def post(self) -> Any:  # pylint: disable=R0201
-        """Post method for MatchViewList."""
-        f = request.files["file"]
-        resize = True
-        place = "iqdb"
-        with NamedTemporaryFile(delete=False) as temp, NamedTemporaryFile(delete=False) as thumb_temp:
-            f.save(temp.name)
-            posted_img = get_posted_image(img_path=temp.name, resize=resize, thumb_path=thumb_temp.name)
-            url, im_place = iqdb_url_dict[place]
-            query = posted_img.imagematchrelationship_set.select().join(models.ImageMatch).where(models.ImageMatch.search_place == im_place)
-            if not query.exists():
-                try:
-                    posted_img_path = temp.name if not resize else thumb_temp.name
-                    result_page = get_page_result(image=posted_img_path, url=url)
-                except requests.exceptions.ConnectionError as e:
-                    current_app.logger.error(str(e))
-                    abort(400, "Connection error.")
-                list(parse.get_or_create_image_match_from_page(page=result_page, image=posted_img, place=im_place))  # NOQA
-        raise NotImplementedError
+        """Post method for MatchViewList.
+
+        Images are given as uploaded files (`file`), urls (`url`) or checksums (`checksum`) of images searched before,
+        each field can be repeated. A single file or url is searched as background job,
+        its status is available from the returned status url.
+
+        Multiple images, checksums or `Accept: application/x-ndjson` header make a batch request.
+        Batch results are streamed as json lines in order of completion, each line has the item key
+        (`file`, `url` or `checksum`), its `index` (checksums first, then urls and files) and `status`.
+        Checksum without previous search result has `not_found` status, the image have to be uploaded.
+        Uploaded file which checksum has previous search result is answered without being written to disk.
+        Set `tags` to 0 to skip tags of the matches.
+        """
+        resize = request.form.get("resize", "1") != "0"
+        place = request.form.get("place", "iqdb")
+        if place not in iqdb_url_dict:
+            abort(400, "Unknown place.")
+        with_tags = request.form.get("tags", "1") != "0"
+        files = [x for x in request.files.getlist("file") if x.filename]
+        urls = [x for x in request.form.getlist("url") if x]
+        checksums = [x for x in request.form.getlist("checksum") if x]
+        n_items = len(files) + len(urls) + len(checksums)
+        if not n_items:
+            abort(400, "No file, url or checksum.")
+        if not all(is_public_url(x) for x in urls):
+            # the url is downloaded when iqdb can't fetch it
+            abort(400, "Only http or https url with public host can be searched.")
+        search_image_url = current_app.extensions["iqdb_tagger_search_image_url"]
+        is_batch = checksums or n_items > 1 or request.accept_mimetypes.best == "application/x-ndjson"
+        if not is_batch:
+            if urls:
+                job = get_job_queue().submit(search_url, search_image_url, urls[0], resize, place, with_tags)
+            else:
+                spooled, checksum = spool_stream(files[0].stream)
+                cached = search_checksum(checksum, resize, place, with_tags)
+                if cached is not None:
+                    spooled.close()
+                    return {"id": None, "status": jobs.Job.STATUS_DONE, "result": cached, "error": None}
+                job = get_job_queue().submit(search_file, *write_temp_files(spooled), resize, place, with_tags, get_thumb_folder())
+            return {"id": job.id, "status": job.status, "status_url": url_for("jobresource", job_id=job.id)}, 202
+
+        items: List[Tuple[Dict[str, Any], Callable[..., Optional[Dict[str, Any]]], Tuple[Any, ...]]] = []
+        temp_paths: List[str] = []
+        for checksum in checksums:
+            items.append(({"checksum": checksum}, search_checksum, (checksum, resize, place, with_tags)))
+        for image_url in urls:
+            items.append(({"url": image_url}, search_url, (search_image_url, image_url, resize, place, with_tags)))
+        for file_storage in files:
+            spooled, checksum = spool_stream(file_storage.stream)
+            key = {"file": file_storage.filename}
+            if models.get_cached_image_matches(checksum, iqdb_url_dict[place][1], resize=resize) is not None:
+                # searched before, answer from database without writing the file
+                spooled.close()
+                items.append((key, search_checksum, (checksum, resize, place, with_tags)))
+                continue
+            image_path, thumb_path = write_temp_files(spooled)
+            temp_paths.extend([image_path, thumb_path])
+            items.append((key, search_file, (image_path, thumb_path, resize, place, with_tags, get_thumb_folder())))
+        for idx, item in enumerate(items):
+            item[0]["index"] = idx
+        gen = iter_batch_results(items, get_job_queue(), temp_paths)
+        return Response(stream_with_context(gen), mimetype="application/x-ndjson")
+
+
+class JobResource(Resource):
+    """Resource api for background job status and result."""
+
+    def get(self, job_id: str) -> Any:  # pylint: disable=R0201
+        """Get job status and result."""
+        job = get_job_queue().get(job_id)
+        if job is None:
+            abort(404, "Job not found.")
+        return job.to_dict()
@@ -0,0 +1,129 @@
+"""work queue module."""
+import datetime
+import os
+import socket
+from typing import Dict, Iterable, Optional
+
+import structlog
+from peewee import fn
+
+from .models import WorkItem
+
+DEFAULT_QUEUE = "default"
+DEFAULT_LEASE = 600.0
+DEFAULT_MAX_ATTEMPTS = 3
+# number of candidate items read when claiming
+CLAIM_BATCH = 8
+log = structlog.getLogger()
+
+
+def get_worker_name() -> str:
+    """Get worker name unique across hosts."""
+    return "{}-{}".format(socket.gethostname(), os.getpid())
+
+
+class WorkQueue:
+    """Work queue stored in the database.
+
+    Workers on any host using the same database claim items with a lease.
+    Item which lease expired, e.g. its worker crashed, is claimed again until it reach maximum attempts.
+    """
+
+    def __init__(
+        self,
+        name: str = DEFAULT_QUEUE,
+        lease: float = DEFAULT_LEASE,
+        max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+    ) -> None:
+        """Init method.
+
+        Args:
+            name: queue name
+            lease: seconds an item is leased to its worker
+            max_attempts: maximum number of times an item is processed
+        """
+        self.name = name
+        self.lease = lease
+        self.max_attempts = max_attempts
+
+    def submit(self, kind: str, values: Iterable[str], retry: bool = False) -> int:
+        """Add items to the queue, items already in the queue are skipped.
+
+        Args:
+            kind: item kind, e.g. `WorkItem.KIND_PATH`
+            values: item values
+            retry: queue failed items again
+
+        Returns:
+            number of queued items
+        """
+        n_queued = 0
+        for value in dict.fromkeys(values):
+            item, created = WorkItem.get_or_create(queue=self.name, kind=kind, value=value)
+            if created:
+                n_queued += 1
+            elif retry and item.status == WorkItem.STATUS_FAILED:
+                n_queued += self.update(item, status=WorkItem.STATUS_QUEUED, attempts=0, error=None)
+        return n_queued
+
+    def update(self, item: WorkItem, **fields: object) -> bool:
+        """Update item if nobody changed it since it was read.
+
+        Returns:
+            True if the item is updated
+        """
+        fields["version"] = item.version + 1
+        query = WorkItem.update(**fields).where(WorkItem.id == item.id, WorkItem.version == item.version)
+        if not query.execute():
+            return False
+        for key, value in fields.items():
+            setattr(item, key, value)
+        return True
+
+    def claim(self, owner: str) -> Optional[WorkItem]:
+        """Lease the oldest available item.
+
+        Args:
+            owner: worker name
+
+        Returns:
+            leased item, None if there is no available item
+        """
+        while True:
+            now = datetime.datetime.now()
+            is_expired = (WorkItem.status == WorkItem.STATUS_LEASED) & (WorkItem.lease_expires < now)
+            candidates = list(
+                WorkItem.select()
+                .where(WorkItem.queue == self.name, (WorkItem.status == WorkItem.STATUS_QUEUED) | is_expired)
+                .order_by(WorkItem.id)
+                .limit(CLAIM_BATCH)
+            )
+            if not candidates:
+                return None
+            for item in candidates:
+                if item.attempts >= self.max_attempts:
+                    error = item.error or "lease expired"
+                    if self.update(item, status=WorkItem.STATUS_FAILED, owner=None, lease_expires=None, error=error):
+                        log.debug("work item failed", value=item.value, attempts=item.attempts)
+                    continue
+                lease_expires = now + datetime.timedelta(seconds=self.lease)
+                if self.update(item, status=WorkItem.STATUS_LEASED, owner=owner, lease_expires=lease_expires, attempts=item.attempts + 1):
+                    return item
+
+    def complete(self, item: WorkItem, checksum: Optional[str] = None) -> bool:
+        """Mark leased item as done, return False if the lease was lost."""
+        return self.update(item, status=WorkItem.STATUS_DONE, lease_expires=None, checksum=checksum, error=None)
+
+    def fail(self, item: WorkItem, error: str) -> bool:
+        """Release leased item after error, it is queued again until maximum attempts.
+
+        Returns:
+            False if the lease was lost
+        """
+        status = WorkItem.STATUS_FAILED if item.attempts >= self.max_attempts else WorkItem.STATUS_QUEUED
+        return self.update(item, status=status, owner=None, lease_expires=None, error=error)
+
+    def counts(self) -> Dict[str, int]:
+        """Get number of items for each status."""
+        query = WorkItem.select(WorkItem.status, fn.COUNT(WorkItem.id)).where(WorkItem.queue == self.name).group_by(WorkItem.status)
+        return dict(query.tuples())
@@ -46,7 +46,6 @@ setup(
         "cfscrape>=2.1.1",
         "click>=7.1.2",
         "Flask-Admin>=1.5.8",
-        "flask-paginate>=0.8.1",
         "Flask-RESTful>=0.3.8",
         "Flask-WTF>=0.14.3",
         "Flask>=1.1.2",
@@ -60,6 +59,9 @@ setup(
         "wtf-peewee>=3.0.2",
     ],
     extras_require={
+        "mysql": ["PyMySQL>=1.0.2"],
+        "postgres": ["psycopg2-binary>=2.8.6"],
+        "parquet": ["pyarrow>=7.0.0"],
         "doc": [
             "sphinx-autobuild>=0.7.1",
             "sphinx-rtd-theme>=0.2.4",
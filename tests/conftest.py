@@ -1,9 +1,27 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 """config for pytest."""
+import pytest
+
+from iqdb_tagger import __main__ as main
 
 
 def pytest_configure(config):
     """Configure pytest."""
     plugin = config.pluginmanager.getplugin("mypy")
     plugin.mypy_argv.append("--ignore-missing-imports")
+
+
+@pytest.fixture
+def app(tmpdir, monkeypatch):
+    """Flask app with database and data folders in temporary directory."""
+    data_dir = tmpdir.mkdir("data")
+    monkeypatch.setenv("IQDB_TAGGER_DB_PATH", data_dir.join("iqdb.db").strpath)
+    monkeypatch.setattr(main, "user_data_dir", data_dir.strpath)
+    monkeypatch.setattr(main, "thumb_folder", data_dir.join("thumbs").strpath)
+    monkeypatch.setattr(main, "resize_cache_folder", data_dir.join("resized").strpath)
+    flask_app = main.create_app()
+    flask_app.config["TESTING"] = True
+    yield flask_app
+    flask_app.extensions["iqdb_tagger_jobs"].shutdown()
+    flask_app.extensions["iqdb_tagger_tag_prefetcher"].shutdown()
@@ -0,0 +1,62 @@
+"""test archive module."""
+import mechanicalsoup
+import pytest
+import requests
+
+from iqdb_tagger import archive, db_version, models
+
+RESULT_PAGE = """<div class="pages">
+<div><table><tr><th>Your image</th></tr></table></div>
+<div><table>
+<tr><th>Best match</th></tr>
+<tr><td><a href="//danbooru.donmai.us/posts/1">
+<img src="/danbooru/1.jpg" alt="Rating: s Tags: 1girl" title="Rating: s Tags: 1girl"></a></td></tr>
+<tr><td>Danbooru</td></tr>
+<tr><td>500×600 [Safe]</td></tr>
+<tr><td>95% similarity</td></tr>
+</table></div>
+</div>"""
+TAG_PAGE = b'<html><ul><li class="category-0">? 1girl 123</li><li class="category-4">? hestia 45</li></ul></html>'
+
+
+def test_response_archive(tmpdir):
+    """Test method."""
+    response_archive = archive.ResponseArchive(tmpdir.strpath)
+    response_archive.add_result_page("abcdef", models.ImageMatch.SP_DANBOORU, RESULT_PAGE)
+    assert response_archive.get_result_page("abcdef", models.ImageMatch.SP_DANBOORU).decode() == RESULT_PAGE
+    assert response_archive.get_result_page("abcdef", models.ImageMatch.SP_IQDB) is None
+    assert list(response_archive.iter_result_pages()) == [("abcdef", models.ImageMatch.SP_DANBOORU)]
+
+    session = requests.Session()
+    response_archive.mount_offline(session)
+    with pytest.raises(requests.exceptions.ConnectionError):
+        session.get("https://danbooru.donmai.us/posts/1")
+    response_archive.add_url_page("https://danbooru.donmai.us/posts/1", TAG_PAGE)
+    assert session.get("https://danbooru.donmai.us/posts/1").content == TAG_PAGE
+
+
+def test_reparse(tmpdir):
+    """Test method."""
+    models.init_db(tmpdir.join("iqdb.db").strpath, db_version)
+    response_archive = archive.ResponseArchive(tmpdir.join("archive").strpath)
+    image = models.ImageModel.create(checksum="abcdef", width=100, height=100)
+    response_archive.add_result_page(image.checksum, models.ImageMatch.SP_IQDB, RESULT_PAGE)
+    assert archive.reparse_result_page(response_archive, image.checksum, models.ImageMatch.SP_IQDB) == 1
+    # reparse don't create duplicate
+    assert archive.reparse_result_page(response_archive, image.checksum, models.ImageMatch.SP_IQDB) == 1
+    assert models.ImageMatch.select().count() == 1
+    # stale match result is updated and force gray is kept
+    models.Match.update(thumb="/old.jpg", rating=models.Match.RATING_UNKNOWN, width=None, height=None).execute()
+    models.ImageMatch.update(force_gray=True).execute()
+    assert archive.reparse_result_page(response_archive, image.checksum, models.ImageMatch.SP_IQDB) == 1
+    match_result = models.Match.get()
+    assert (match_result.thumb, match_result.width, match_result.height) == ("/danbooru/1.jpg", 500, 600)
+    assert int(match_result.rating) == models.Match.RATING_SAFE
+    assert models.ImageMatch.get().force_gray
+
+    match_result = models.Match.get()
+    response_archive.add_url_page(match_result.link, TAG_PAGE)
+    browser = mechanicalsoup.StatefulBrowser(soup_config={"features": "lxml"})
+    response_archive.mount_offline(browser.session)
+    assert archive.reparse_tag_page(response_archive, match_result, browser, None) == 2
+    assert sorted(x.tag.full_name for x in match_result.matchtagrelationship_set) == ["1girl", "character:hestia"]
@@ -0,0 +1,84 @@
+"""test export module."""
+import csv
+import datetime
+import io
+import json
+import sys
+from unittest import mock
+
+import pytest
+
+from iqdb_tagger import db_version, export, models
+
+
+@pytest.fixture
+def export_db(tmpdir):
+    """Database with three image matches."""
+    models.init_db(tmpdir.join("iqdb.db").strpath, db_version)
+    image = models.ImageModel.create(checksum="a" * 64, width=150, height=120, path="/a.jpg")
+    tag = models.Tag.create(name="1girl", namespace="general")
+    searches = [(95, models.ImageMatch.SP_IQDB), (60, models.ImageMatch.SP_IQDB), (90, models.ImageMatch.SP_DANBOORU)]
+    for idx, (similarity, place) in enumerate(searches):
+        match_result = models.Match.create(href="danbooru.donmai.us/posts/{}".format(idx), thumb="/thumb.jpg", rating="s")
+        imr = models.ImageMatchRelationship.create(image=image, match_result=match_result)
+        status = models.ImageMatch.STATUS_BEST_MATCH if idx == 0 else models.ImageMatch.STATUS_POSSIBLE_MATCH
+        models.ImageMatch.create(
+            match=imr, similarity=similarity, status=status, search_place=place, created_date=datetime.datetime(2021, 1, idx + 1)
+        )
+        if idx != 1:
+            models.MatchTagRelationship.create(match=match_result, tag=tag)
+    return image
+
+
+def test_iter_rows(export_db):  # pylint: disable=redefined-outer-name,unused-argument
+    """Test method."""
+    rows = list(export.iter_rows(page_size=2))
+    assert [(x["href"], x["tags"]) for x in rows] == [
+        ("danbooru.donmai.us/posts/0", ["general:1girl"]),
+        ("danbooru.donmai.us/posts/1", []),
+        ("danbooru.donmai.us/posts/2", ["general:1girl"]),
+    ]
+    assert rows[0]["place"] == "iqdb"
+    assert rows[0]["status"] == "Best match"
+    assert [x["similarity"] for x in export.iter_rows(place=models.ImageMatch.SP_IQDB, min_similarity=90)] == [95]
+    assert [x["similarity"] for x in export.iter_rows(best_match=True)] == [95]
+    assert [x["tags"] for x in export.iter_rows(place=models.ImageMatch.SP_DANBOORU)] == [["general:1girl"]]
+    rows = export.iter_rows(since=datetime.datetime(2021, 1, 2), until=datetime.datetime(2021, 1, 3))
+    assert [x["href"] for x in rows] == ["danbooru.donmai.us/posts/1"]
+
+
+def test_export_rows(export_db):  # pylint: disable=redefined-outer-name,unused-argument
+    """Test method."""
+    f = io.BytesIO()
+    assert export.export_rows(export.iter_rows(), f, "jsonl") == 3
+    rows = [json.loads(x) for x in f.getvalue().decode().splitlines()]
+    assert rows[0]["created_date"] == "2021-01-01T00:00:00"
+    assert rows[2]["tags"] == ["general:1girl"]
+    f = io.BytesIO()
+    assert export.export_rows(export.iter_rows(), f, "csv") == 3
+    rows = list(csv.DictReader(io.StringIO(f.getvalue().decode())))
+    assert list(rows[0]) == export.COLUMNS
+    assert json.loads(rows[0]["tags"]) == ["general:1girl"]
+
+
+def test_export_parquet(export_db):  # pylint: disable=redefined-outer-name,unused-argument
+    """Test method."""
+    parquet = pytest.importorskip("pyarrow.parquet")
+    f = io.BytesIO()
+    assert export.export_rows(export.iter_rows(), f, "parquet") == 3
+    f.seek(0)
+    table = parquet.read_table(f)
+    assert table.column("tags").to_pylist() == [["general:1girl"], [], ["general:1girl"]]
+
+
+def test_write_parquet_row_groups(monkeypatch):
+    """Test method."""
+    pyarrow = mock.MagicMock()
+    monkeypatch.setitem(sys.modules, "pyarrow", pyarrow)
+    monkeypatch.setitem(sys.modules, "pyarrow.parquet", pyarrow.parquet)
+    rows = [{"checksum": str(x)} for x in range(5)]
+    assert export.write_parquet(iter(rows), io.BytesIO(), row_group_size=2) == 5
+    batches = [x.args[0] for x in pyarrow.Table.from_pylist.call_args_list]
+    assert batches == [rows[:2], rows[2:4], rows[4:]]
+    writer = pyarrow.parquet.ParquetWriter.return_value.__enter__.return_value
+    assert writer.write_table.call_count == 3
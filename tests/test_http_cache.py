@@ -0,0 +1,96 @@
+"""test http cache module."""
+import threading
+
+import requests
+from requests.adapters import BaseAdapter
+
+from iqdb_tagger.http_cache import CachedResponse, ResponseCache, cache_db
+
+
+class FakeAdapter(BaseAdapter):
+    """Adapter which count sent requests."""
+
+    def __init__(self, status_code=200, content=b"<html></html>", headers=None):
+        """Init method."""
+        super().__init__()
+        self.requests = []
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {"Content-Type": "text/html; charset=utf-8", "ETag": '"abc"'}
+
+    def send(self, request, **kwargs):  # pylint: disable=arguments-differ
+        """Send method."""
+        self.requests.append(request)
+        resp = requests.Response()
+        resp.status_code = self.status_code
+        resp.headers.update(self.headers)
+        resp._content = self.content  # pylint: disable=protected-access
+        resp.url = request.url
+        resp.request = request
+        return resp
+
+    def close(self):
+        """Close method."""
+
+
+def get_session(cache, adapter):
+    """Get session with cached fake adapter."""
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    cache.mount(session)
+    return session
+
+
+def test_response_cache(tmpdir):
+    """Test method."""
+    cache = ResponseCache(tmpdir.join("http_cache.db").strpath)
+    adapter = FakeAdapter()
+    session = get_session(cache, adapter)
+    resp1 = session.get("https://example.com/post/1")
+    resp2 = session.get("https://example.com/post/1")
+    assert len(adapter.requests) == 1
+    assert resp1.text == resp2.text == "<html></html>"
+    assert resp2.headers["Content-Type"] == "text/html; charset=utf-8"
+
+
+def test_response_cache_revalidate(tmpdir):
+    """Test method."""
+    cache = ResponseCache(tmpdir.join("http_cache.db").strpath, ttl=0)
+    adapter = FakeAdapter()
+    session = get_session(cache, adapter)
+    session.get("https://example.com/post/1")
+    adapter.status_code, adapter.content = 304, b""
+    resp = session.get("https://example.com/post/1")
+    assert adapter.requests[-1].headers["If-None-Match"] == '"abc"'
+    assert resp.status_code == 200
+    assert resp.text == "<html></html>"
+
+
+def test_response_cache_evict(tmpdir):
+    """Test method."""
+    cache = ResponseCache(tmpdir.join("http_cache.db").strpath, max_size=400)
+    adapter = FakeAdapter(content=bytes(range(256)))
+    session = get_session(cache, adapter)
+    session.get("https://example.com/post/1")
+    session.get("https://example.com/post/2")
+    assert [x.url for x in CachedResponse.select()] == ["https://example.com/post/2"]
+
+
+def test_response_cache_threads(tmpdir):
+    """Test method."""
+    cache = ResponseCache(tmpdir.join("http_cache.db").strpath)
+    assert cache_db.execute_sql("PRAGMA journal_mode").fetchone()[0] == "wal"
+    adapter = FakeAdapter()
+    texts = []
+
+    def get():
+        # every thread has its own session and database connection
+        texts.append(get_session(cache, adapter).get("https://example.com/post/1").text)
+
+    for _ in range(2):
+        thread = threading.Thread(target=get)
+        thread.start()
+        thread.join()
+    assert texts == ["<html></html>"] * 2
+    assert len(adapter.requests) == 1
@@ -0,0 +1,83 @@
+"""test hydrus writer module."""
+import time
+
+from iqdb_tagger.hydrus_writer import HydrusWriter, get_tag_delta, group_tags
+
+
+class FakeClient:
+    """Fake hydrus client which record requests."""
+
+    def __init__(self):
+        """Init method."""
+        self.requests = []
+
+    def add_tags(self, hashes, service_to_tags):
+        """Add tags."""
+        self.requests.append(("add_tags", hashes, service_to_tags))
+
+    def add_url(self, url):
+        """Add url."""
+        self.requests.append(("add_url", url))
+
+
+def test_group_tags():
+    """Test method."""
+    # files with identical tags
+    assert sorted(group_tags({"a": {"t1", "t2"}, "b": {"t1", "t2"}, "c": {"t3"}})) == [(["a", "b"], ["t1", "t2"]), (["c"], ["t3"])]
+    # files with few distinct tags
+    assert sorted(group_tags({"a": {"t1"}, "b": {"t2"}, "c": {"t1", "t2"}})) == [(["a", "c"], ["t1"]), (["b", "c"], ["t2"])]
+
+
+def test_hydrus_writer():
+    """Test method."""
+    client = FakeClient()
+    flushed = []
+    with HydrusWriter(client, batch_size=2, on_flush=flushed.extend) as writer:
+        writer.add_tags("a", {"local tags": ["t1"]})
+        assert not client.requests
+        writer.add_tags("b", {"local tags": ["t1"]})
+        assert client.requests == [("add_tags", ["a", "b"], {"local tags": ["t1"]})]
+        writer.add_tags("c", {"local tags": ["t2"]})
+        assert writer.add_url("https://example.com/1")
+        assert not writer.add_url("https://example.com/1")
+    assert client.requests[1:] == [("add_url", "https://example.com/1"), ("add_tags", ["c"], {"local tags": ["t2"]})]
+    assert flushed == ["a", "b", "c"]
+
+
+def test_hydrus_writer_interval():
+    """Test method."""
+    client = FakeClient()
+    writer = HydrusWriter(client, flush_interval=0)
+    writer.add_tags("a", {"local tags": ["t1"]})
+    assert len(client.requests) == 1
+    writer.close()
+
+
+def test_hydrus_writer_timer():
+    """Test method."""
+    client = FakeClient()
+    flushed = []
+    with HydrusWriter(client, flush_interval=0.1, on_flush=flushed.extend) as writer:
+        writer.add_tags("a", {"local tags": ["t1"]})
+        assert not client.requests
+        # no more file is added, the timer send the tags
+        for _ in range(50):
+            if client.requests:
+                break
+            time.sleep(0.05)
+        assert client.requests == [("add_tags", ["a"], {"local tags": ["t1"]})]
+        assert flushed == ["a"]
+        writer.add_tags("b", {"local tags": ["t1"]})
+    assert client.requests[-1] == ("add_tags", ["b"], {"local tags": ["t1"]})
+    assert not writer.timer.is_alive()
+
+
+def test_get_tag_delta():
+    """Test method."""
+    service_to_tags = {"local tags": {"t1", "T2", "t3"}, "my tags": {"t1"}}
+    metadata = {"service_names_to_statuses_to_tags": {"local tags": {"0": ["t1"], "1": ["t2"], "2": ["t3"]}}}
+    assert get_tag_delta(metadata, service_to_tags) == {"local tags": {"t3"}, "my tags": {"t1"}}
+    metadata = {"tags": {"key1": {"name": "local tags", "storage_tags": {"0": ["t1", "t2", "t3"]}}}}
+    assert get_tag_delta(metadata, service_to_tags) == {"my tags": {"t1"}}
+    # identifiers only
+    assert get_tag_delta({"hash": "a"}, service_to_tags) == service_to_tags
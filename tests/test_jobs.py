@@ -0,0 +1,64 @@
+"""test jobs module."""
+import threading
+
+from iqdb_tagger import db_version, models
+from iqdb_tagger.jobs import DatabaseJobQueue, Job, JobQueue
+
+
+def test_job_queue():
+    """Test method."""
+    job_queue = JobQueue(max_workers=2)
+    event = threading.Event()
+
+    def func(value):
+        event.wait(5)
+        if value is None:
+            raise ValueError("no value")
+        return value * 2
+
+    job = job_queue.submit(func, 2)
+    failed_job = job_queue.submit(func, None)
+    assert job_queue.get(job.id).status in (Job.STATUS_QUEUED, Job.STATUS_RUNNING)
+    event.set()
+    job_queue.shutdown()
+    assert job.to_dict() == {"id": job.id, "status": Job.STATUS_DONE, "result": 4, "error": None}
+    assert failed_job.status == Job.STATUS_FAILED
+    assert failed_job.error == "no value"
+    assert job_queue.get("unknown") is None
+
+
+def test_job_queue_prune():
+    """Test method."""
+    job_queue = JobQueue(max_workers=1, max_finished=2)
+    submitted = [job_queue.submit(lambda: None) for _ in range(3)]
+    job_queue.shutdown()
+    job_queue.prune()
+    assert [x.id for x in job_queue.jobs.values()] == [x.id for x in submitted[1:]]
+
+
+def test_database_job_queue(tmpdir):
+    """Test method."""
+    models.init_db(tmpdir.join("iqdb.db").strpath, db_version)
+
+    def func(value):
+        if value is None:
+            raise ValueError("no value")
+        return {"value": value}
+
+    job_queue = DatabaseJobQueue(max_workers=1, max_finished=2)
+    submitted = [job_queue.submit(func, 1), job_queue.submit(func, None), job_queue.submit(func, 3)]
+    job_queue.shutdown()
+    # other process sharing the database
+    other_queue = DatabaseJobQueue(max_finished=2)
+    assert other_queue.get(submitted[0].id).to_dict() == {
+        "id": submitted[0].id,
+        "status": Job.STATUS_DONE,
+        "result": {"value": 1},
+        "error": None,
+    }
+    assert other_queue.get(submitted[1].id).to_dict()["error"] == "no value"
+    assert other_queue.get("unknown") is None
+    other_queue.prune()
+    assert other_queue.get(submitted[0].id) is None
+    assert other_queue.get(submitted[2].id).status == Job.STATUS_DONE
+    other_queue.shutdown()
@@ -0,0 +1,30 @@
+"""test journal module."""
+from iqdb_tagger.journal import STAGE_DONE, STAGE_SEARCHED, Journal
+
+
+def test_journal(tmpdir):
+    """Test method."""
+    path = tmpdir.join("job.jsonl").strpath
+    with Journal(path) as job_journal:
+        job_journal.record("a.jpg", STAGE_SEARCHED, checksum="abc")
+        job_journal.record("a.jpg", STAGE_DONE)
+        job_journal.record("b.jpg", STAGE_SEARCHED, checksum="def")
+    with Journal(path, resume=True) as job_journal:
+        assert job_journal.get_stage("a.jpg") == STAGE_DONE
+        assert job_journal.get("a.jpg")["checksum"] == "abc"
+        assert job_journal.get_stage("b.jpg") == STAGE_SEARCHED
+        assert job_journal.get_stage("c.jpg") is None
+    with Journal(path) as job_journal:
+        assert job_journal.get_stage("a.jpg") is None
+
+
+def test_journal_cut_line(tmpdir):
+    """Test method."""
+    path = tmpdir.join("job.jsonl")
+    path.write('{"key": "a.jpg", "stage": "done"}\n{"key": "b.jpg", "st')
+    with Journal(path.strpath, resume=True) as job_journal:
+        assert job_journal.get_stage("a.jpg") == STAGE_DONE
+        assert job_journal.get("b.jpg") is None
+        job_journal.record("b.jpg", STAGE_DONE)
+    with Journal(path.strpath, resume=True) as job_journal:
+        assert job_journal.get_stage("b.jpg") == STAGE_DONE
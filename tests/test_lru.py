@@ -0,0 +1,16 @@
+"""test lru module."""
+from iqdb_tagger.lru import LRUCache
+
+
+def test_lru_cache():
+    """Test method."""
+    cache = LRUCache(2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert (cache.get("a"), cache.get("c"), len(cache)) == (1, 3, 2)
+    disabled_cache = LRUCache(0)
+    disabled_cache.set("a", 1)
+    assert disabled_cache.get("a") is None
@@ -1,18 +1,21 @@
 """test module."""
 # pylint:disable=redefined-outer-name
+import io
 import json
 import logging
 import os
+import tempfile
 from pathlib import Path
 
 import pytest
+import requests
 import vcr
 from bs4 import BeautifulSoup
 from click.testing import CliRunner
 from PIL import Image
 
 import iqdb_tagger
-from iqdb_tagger import __main__ as main, parse
+from iqdb_tagger import __main__ as main, models, parse
 from iqdb_tagger.__main__ import cli_run, init_program
 from iqdb_tagger.models import ImageModel, ThumbnailRelationship, get_posted_image
 
@@ -126,3 +129,302 @@ def test_parse_iqdb_result_page():
     json_res = temp_list
     res = list(parse.parse_result(soup))
     assert res == json_res
+
+
+NO_MATCH_PAGE = '<div class="pages"><table><tr><th>Your image</th></tr></table><table><tr><th>No relevant matches</th></tr></table></div>'
+
+
+def test_search_posted_image_no_match(tmpdir, tmp_img, monkeypatch):
+    """Test negative result when iqdb have no relevant matches."""
+    init_program(db_path=tmpdir.join("temp_db.db").strpath)
+    post_img = get_posted_image(tmp_img.strpath, output_thumb_folder=tmpdir.mkdir("thumb").strpath)
+    calls = []
+
+    def get_page_result(**kwargs):
+        calls.append(kwargs)
+        return NO_MATCH_PAGE
+
+    monkeypatch.setattr(main.models, "get_page_result", get_page_result)
+    assert main.search_posted_image(post_img, tmp_img.strpath, "iqdb") == []
+    assert main.search_posted_image(post_img, tmp_img.strpath, "iqdb") == []
+    assert len(calls) == 1
+    assert main.search_posted_image(post_img, tmp_img.strpath, "iqdb", use_negative_cache=False) == []
+    assert len(calls) == 2
+
+
+@pytest.mark.parametrize(
+    "error, category",
+    [
+        (None, models.NegativeResult.CATEGORY_SEARCH_ERROR),
+        (requests.exceptions.HTTPError("503 Server Error"), models.NegativeResult.CATEGORY_CONNECTION_ERROR),
+        (requests.exceptions.ReadTimeout("read timeout"), models.NegativeResult.CATEGORY_CONNECTION_ERROR),
+    ],
+)
+def test_search_posted_image_error(tmpdir, tmp_img, monkeypatch, error, category):
+    """Test that error page, error status and timeout are not recorded as no match."""
+    init_program(db_path=tmpdir.join("temp_db.db").strpath)
+    post_img = get_posted_image(tmp_img.strpath, output_thumb_folder=tmpdir.mkdir("thumb").strpath)
+
+    def get_page_result(**_):
+        if error is not None:
+            raise error
+        return "<html><body>Too many requests, try again later.</body></html>"
+
+    monkeypatch.setattr(main.models, "get_page_result", get_page_result)
+    with pytest.raises((ValueError, requests.exceptions.RequestException)):
+        main.search_posted_image(post_img, tmp_img.strpath, "iqdb")
+    negative_result = models.NegativeResult.get_unexpired(models.NegativeResult.get_key(post_img.checksum, models.ImageMatch.SP_IQDB))
+    assert negative_result.category == category
+
+
+class FakeResponse:
+    """Fake streamed response."""
+
+    def __init__(self, content):
+        """Init method."""
+        self.content = content
+
+    def iter_content(self, chunk_size):
+        """Iterate content."""
+        yield self.content
+
+
+class FakeHydrusClient:
+    """Fake hydrus client which serve thumbnail only."""
+
+    def __init__(self, thumbnail_path):
+        """Init method."""
+        self.thumbnail_path = thumbnail_path
+        self.calls = []
+
+    def search_files(self, tags):
+        """Search files."""
+        return [1]
+
+    def file_metadata(self, file_ids, only_identifiers):
+        """Get file metadata."""
+        self.calls.append(("file_metadata", only_identifiers))
+        return [{"file_id": 1, "hash": "a" * 64, "width": 1600, "height": 1200}]
+
+    def get_thumbnail(self, hash_=None, file_id=None):
+        """Get thumbnail."""
+        self.calls.append(("get_thumbnail", file_id or hash_))
+        return FakeResponse(Path(self.thumbnail_path).read_bytes())
+
+    def get_file(self, hash_=None, file_id=None):
+        """Get file."""
+        raise AssertionError("file should not be downloaded")
+
+    def add_tags(self, hashes, service_to_tags):
+        """Add tags."""
+        self.calls.append(("add_tags", hashes, service_to_tags))
+
+
+def test_get_hydrus_set_thumbnail(tmpdir, monkeypatch):
+    """Test hydrus thumbnail upload and skipping file which already searched."""
+    init_program(db_path=tmpdir.join("temp_db.db").strpath)
+    thumbnail_path = tmpdir.join("thumbnail.jpg").strpath
+    Image.new("RGB", (150, 112), (0, 0, 255)).save(thumbnail_path)
+    client = FakeHydrusClient(thumbnail_path)
+    monkeypatch.setattr(main.models, "get_page_result", lambda **kwargs: NO_MATCH_PAGE)
+    res = list(main.get_hydrus_set(["tag"], client, hydrus_thumbnail=True))
+    assert len(res) == 1
+    assert res[0]["iqdb_result"]["match result tag pairs"] == []
+    assert ("file_metadata", False) in client.calls
+    assert ("get_thumbnail", 1) in client.calls
+    client.calls = []
+    assert len(list(main.get_hydrus_set(["tag"], client, hydrus_thumbnail=True))) == 1
+    assert ("get_thumbnail", 1) not in client.calls
+
+
+def test_process_work_item_hydrus(tmpdir, monkeypatch):
+    """Test hydrus work item use cached result before downloading thumbnail and batch its tags."""
+    init_program(db_path=tmpdir.join("temp_db.db").strpath)
+    thumbnail_path = tmpdir.join("thumbnail.jpg").strpath
+    Image.new("RGB", (150, 112), (0, 0, 255)).save(thumbnail_path)
+    client = FakeHydrusClient(thumbnail_path)
+    monkeypatch.setattr(main.models, "get_page_result", lambda **kwargs: NO_MATCH_PAGE)
+    item = models.WorkItem.create(queue="default", kind=models.WorkItem.KIND_HYDRUS, value="a" * 64)
+    checksum = main.process_work_item(item, client, hydrus_thumbnail=True, resize=True)
+    assert checksum is not None
+    assert client.calls == [("get_thumbnail", "a" * 64)]
+    # no match result is used without downloading the thumbnail again
+    client.calls = []
+    assert main.process_work_item(item, client, hydrus_thumbnail=True, resize=True) == checksum
+    assert client.calls == []
+    tag = models.Tag(namespace="character", name="kirisame marisa")
+    result = {"error": [], "match result tag pairs": [(None, [tag])], "checksum": checksum}
+    monkeypatch.setattr(main, "run_program_for_single_img", lambda image, **kwargs: result)
+    with main.hydrus_writer.HydrusWriter(client) as writer:
+        for value in ("b" * 64, "c" * 64):
+            item = models.WorkItem.create(queue="default", kind=models.WorkItem.KIND_HYDRUS, value=value)
+            main.process_work_item(item, client, writer=writer, hydrus_thumbnail=True, resize=True)
+        assert not any(x[0] == "add_tags" for x in client.calls)
+    assert client.calls[-1] == ("add_tags", ["b" * 64, "c" * 64], {"local tags": ["character:kirisame marisa"]})
+
+
+class FakeClient:
+    """Fake hydrus client which record sent urls."""
+
+    def __init__(self):
+        """Init method."""
+        self.urls = []
+
+    def add_url(self, url):
+        """Add url."""
+        self.urls.append(url)
+
+
+class FakeHydrusFiles:
+    """Fake hydrus client which serve files, download of the second file fails."""
+
+    def __init__(self, n_files):
+        """Init method."""
+        self.n_files = n_files
+
+    def search_files(self, tags):
+        """Search files."""
+        return list(range(self.n_files))
+
+    def file_metadata(self, file_ids, only_identifiers):
+        """Get file metadata."""
+        return [{"file_id": x, "hash": "{:064x}".format(x)} for x in file_ids]
+
+    def get_file(self, file_id):
+        """Get file."""
+        f = io.BytesIO()
+        Image.new("RGB", (200, 200), (file_id, 0, 0)).save(f, "JPEG")
+        if file_id == 1:
+            return FailedResponse(f.getvalue())
+        return FakeResponse(f.getvalue())
+
+
+class FailedResponse(FakeResponse):
+    """Fake streamed response which fails after the first chunk."""
+
+    def iter_content(self, chunk_size):
+        """Iterate content."""
+        yield self.content[:10]
+        raise requests.exceptions.ConnectionError("connection reset")
+
+
+def test_get_hydrus_set_temp_files(tmpdir, monkeypatch):
+    """Test downloaded files are removed when download fails or the result is not consumed."""
+    init_program(db_path=tmpdir.join("temp_db.db").strpath)
+    temp_dir = tmpdir.mkdir("temp")
+    monkeypatch.setattr(tempfile, "tempdir", temp_dir.strpath)
+    monkeypatch.setattr(main.models, "get_page_result", lambda **kwargs: NO_MATCH_PAGE)
+    res = list(main.get_hydrus_set(["tag"], FakeHydrusFiles(4), init_browser=lambda: (None, None)))
+    assert sorted(x["metadata"]["file_id"] for x in res) == [0, 2, 3]
+    assert temp_dir.listdir() == []
+    hydrus_set = main.get_hydrus_set(["tag"], FakeHydrusFiles(40), init_browser=lambda: (None, None), queue_size=2)
+    next(hydrus_set)
+    hydrus_set.close()
+    assert temp_dir.listdir() == []
+
+
+def test_search_hydrus_and_send_url(tmpdir, monkeypatch):
+    """Test file with tag fetch error is not recorded as done."""
+    journal_path = tmpdir.join("journal.jsonl").strpath
+    match_result = models.Match(href="//danbooru.donmai.us/posts/1")
+    results = [
+        {"metadata": {"hash": "a"}, "iqdb_result": {"error": [], "match result tag pairs": [(match_result, [])]}},
+        {"metadata": {"hash": "b"}, "iqdb_result": {"error": [ValueError("error")], "match result tag pairs": []}},
+    ]
+    client = FakeClient()
+    monkeypatch.setattr(main, "Client", lambda *args, **kwargs: client)
+    monkeypatch.setattr(main, "init_program", lambda *args, **kwargs: None)
+    monkeypatch.setattr(main, "get_hydrus_set", lambda *args, **kwargs: iter(results))
+    args = ["search-hydrus-and-send-url", "tag", "--access_key", "key", "--journal", journal_path]
+    result = CliRunner().invoke(main.cli, args)
+    assert result.exit_code == 0, result.output
+    assert client.urls == ["https://danbooru.donmai.us/posts/1"]
+    with main.journal.Journal(journal_path, resume=True) as job_journal:
+        assert job_journal.get_stage("a") == main.journal.STAGE_DONE
+        assert job_journal.get_stage("b") is None
+
+
+def test_search_image_url(tmpdir, monkeypatch):
+    """Test searching image url and fallback to upload when iqdb can't fetch it."""
+    init_program(db_path=tmpdir.join("temp_db.db").strpath)
+    thumb_path = tmpdir.join("thumb.jpg")
+    Image.new("RGB", (150, 100), (255, 0, 0)).save(thumb_path.strpath)
+    image_path = tmpdir.join("image.jpg")
+    Image.new("RGB", (150, 100), (0, 255, 0)).save(image_path.strpath)
+    contents = {"http://iqdb.org/thu/thu_1.jpg": thumb_path.read_binary(), "https://example.com/2.jpg": image_path.read_binary()}
+    page = """<div class="pages">
+<div><table><tr><th>Your image</th></tr><tr><td><img src="/thu/thu_1.jpg"></td></tr></table></div>
+<div><table>
+<tr><th>Best match</th></tr>
+<tr><td><a href="//danbooru.donmai.us/posts/1"><img src="/danbooru/1.jpg" alt="[IMG]"></a></td></tr>
+<tr><td>Danbooru</td></tr>
+<tr><td>500×600 [Safe]</td></tr>
+<tr><td>95% similarity</td></tr>
+</table></div>
+</div>"""
+    calls = []
+    upload_pages = [NO_MATCH_PAGE]
+
+    def get_page_result(**kwargs):
+        calls.append(kwargs)
+        if kwargs.get("image_url") in ("https://example.com/1.jpg", "https://example.com/3.jpg"):
+            return page
+        if kwargs.get("image_url") is not None:
+            # iqdb can't fetch the url
+            return '<div class="err">error</div>'
+        return upload_pages[-1]
+
+    class FakeResponse:
+        headers = {}
+        is_redirect = False
+
+        def __init__(self, content):
+            """Init method."""
+            self.content = content
+
+        def __enter__(self):
+            """Enter context."""
+            return self
+
+        def __exit__(self, *args):
+            """Exit context."""
+
+        def raise_for_status(self):
+            """Raise for status."""
+
+        def iter_content(self, chunk_size):
+            """Iterate content."""
+            yield self.content
+
+    gets = []
+    monkeypatch.setattr(main.models, "get_page_result", get_page_result)
+    monkeypatch.setattr(main.requests, "get", lambda url, **kwargs: gets.append(url) or FakeResponse(contents[url]))
+    result, checksum = main.search_image("https://example.com/1.jpg")
+    assert [x.match.match_result.link for x in result] == ["https://danbooru.donmai.us/posts/1"]
+    assert gets == ["http://iqdb.org/thu/thu_1.jpg"]
+    assert ImageModel.get(ImageModel.checksum == checksum).path == "https://example.com/1.jpg"
+    # cached by url
+    assert main.search_image("https://example.com/1.jpg")[1] == checksum
+    assert len(calls) == 1
+    # other url with the same thumbnail doesn't replace the path
+    assert main.search_image("https://example.com/3.jpg")[1] == checksum
+    assert ImageModel.get(ImageModel.checksum == checksum).path == "https://example.com/1.jpg"
+    # iqdb can't fetch the url
+    result, checksum = main.search_image("https://example.com/2.jpg")
+    assert gets[-1] == "https://example.com/2.jpg"
+    assert calls[-1]["image"] is not None
+    assert ImageModel.get(ImageModel.checksum == checksum).path == "https://example.com/2.jpg"
+    assert result == []
+    # downloaded url without match is found in negative cache without search and download
+    n_calls, n_gets = len(calls), len(gets)
+    assert main.search_image("https://example.com/2.jpg") == ([], None)
+    assert (len(calls), len(gets)) == (n_calls, n_gets)
+    # downloaded url with match is found by posted image path
+    upload_pages.append(page)
+    Image.new("RGB", (150, 100), (0, 0, 255)).save(image_path.strpath)
+    contents["https://example.com/4.jpg"] = image_path.read_binary()
+    result, checksum = main.search_image("https://example.com/4.jpg")
+    assert [x.match.match_result.link for x in result] == ["https://danbooru.donmai.us/posts/1"]
+    n_calls, n_gets = len(calls), len(gets)
+    assert main.search_image("https://example.com/4.jpg") == (result, checksum)
+    assert (len(calls), len(gets)) == (n_calls, n_gets)
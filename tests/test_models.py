@@ -1,4 +1,12 @@
 """test models."""
+import datetime
+import io
+import os
+import threading
+
+import pytest
+import requests
+from peewee import IntegrityError
 from PIL import Image
 
 from iqdb_tagger import db_version, models
@@ -54,3 +62,329 @@ def test_tags_from_img_alt():
         "hestia_(dungeon)",
     ]
     assert set(m1.tags_from_img_alt) == set(exp_result)
+
+
+def test_get_tags_from_img_alt(tmpdir):
+    """Test method."""
+    models.init_db(tmpdir.mkdir("db").join("iqdb.db").strpath, db_version)
+    models.Tag.create(name="hestia_(dungeon)", namespace="character")
+    img_alt = "Rating: e Score: 5 Tags: dungeon_ni_deai_wo_motomeru_no_wa_machigatteiru_darou_ka hestia_(dungeon)"
+    assert models.get_tags_from_img_alt(img_alt) == [
+        ("", "dungeon_ni_deai_wo_motomeru_no_wa_machigatteiru_darou_ka"),
+        ("character", "hestia_(dungeon)"),
+    ]
+    assert models.get_tags_from_img_alt("Rating: s") == []
+    assert models.get_tags_from_img_alt(None) == []
+
+
+def test_get_tags_from_match_result_use_img_alt(tmpdir):
+    """Test method."""
+    models.init_db(tmpdir.mkdir("db").join("iqdb.db").strpath, db_version)
+    match_result = models.Match.create(
+        href="//danbooru.donmai.us/posts/1",
+        thumb="/danbooru/1.jpg",
+        rating=models.Match.RATING_SAFE,
+        img_alt="Rating: s Score: 1 Tags: 1girl",
+    )
+    tags = models.get_tags_from_match_result(match_result, use_img_alt=True)
+    assert [x.full_name for x in tags] == ["1girl"]
+    assert models.MatchTagRelationship.get().from_img_alt
+
+
+def test_negative_result(tmpdir):
+    """Test method."""
+    models.init_db(tmpdir.mkdir("db").join("iqdb.db").strpath, db_version)
+    key = models.NegativeResult.get_key("checksum", models.ImageMatch.SP_IQDB)
+    assert models.NegativeResult.get_unexpired(key) is None
+    models.NegativeResult.add(key, models.NegativeResult.CATEGORY_NO_MATCH)
+    assert models.NegativeResult.get_unexpired(key).category == models.NegativeResult.CATEGORY_NO_MATCH
+    # expired entry
+    models.NegativeResult.update(created_date=datetime.datetime(2000, 1, 1)).execute()
+    assert models.NegativeResult.get_unexpired(key) is None
+    models.NegativeResult.add(key, models.NegativeResult.CATEGORY_NO_MATCH)
+    assert models.NegativeResult.select().count() == 1
+    models.NegativeResult.remove(key)
+    assert models.NegativeResult.get_unexpired(key) is None
+
+
+@pytest.mark.parametrize(
+    "status_code, error, category",
+    [
+        (200, requests.exceptions.ReadTimeout("read timeout"), models.NegativeResult.CATEGORY_CONNECTION_ERROR),
+        (503, None, models.NegativeResult.CATEGORY_CONNECTION_ERROR),
+        (404, None, models.NegativeResult.CATEGORY_NOT_FOUND),
+    ],
+)
+def test_fetch_tags_error(tmpdir, status_code, error, category):
+    """Test method."""
+    models.init_db(tmpdir.mkdir("db").join("iqdb.db").strpath, db_version)
+    match_result = models.Match.create(href="//danbooru.donmai.us/posts/1", thumb="/thumb.jpg", rating="s")
+
+    class Browser:
+        """Fake browser."""
+
+        def open(self, url, **kwargs):
+            """Open url."""
+            if error is not None:
+                raise error
+            resp = requests.models.Response()
+            resp.status_code, resp.url = status_code, url
+            return resp
+
+    assert models.fetch_tags_from_match_result(match_result, browser=Browser()) == []
+    assert models.NegativeResult.get_unexpired(match_result.link).category == category
+
+
+def test_download_url(monkeypatch):
+    """Test method."""
+
+    class Response:
+        """Fake streamed response."""
+
+        is_redirect = False
+
+        def __init__(self, headers):
+            """Init method."""
+            self.headers = headers
+
+        def __enter__(self):
+            """Enter context."""
+            return self
+
+        def __exit__(self, *args):
+            """Exit context."""
+
+        def raise_for_status(self):
+            """Raise for status."""
+
+        def iter_content(self, chunk_size):
+            """Iterate content."""
+            yield b"a" * 6
+            yield b"a" * 6
+
+    headers = {}
+    monkeypatch.setattr(models.requests, "get", lambda url, **kwargs: Response(headers))
+    f = io.BytesIO()
+    assert models.download_url("http://example.com/1.jpg", f, max_size=12) == 12
+    assert f.getvalue() == b"a" * 12
+    with pytest.raises(ValueError):
+        models.download_url("http://example.com/1.jpg", io.BytesIO(), max_size=10)
+    headers["Content-Length"] = "100"
+    with pytest.raises(ValueError):
+        models.download_url("http://example.com/1.jpg", io.BytesIO(), max_size=12)
+    with pytest.raises(ValueError):
+        models.download_url("file:///etc/passwd", io.BytesIO())
+
+
+def test_download_url_redirect(monkeypatch):
+    """Test method."""
+
+    class Response:
+        """Fake streamed response which redirect to location."""
+
+        def __init__(self, location):
+            """Init method."""
+            self.headers = {"Location": location} if location else {}
+            self.is_redirect = bool(location)
+
+        def __enter__(self):
+            """Enter context."""
+            return self
+
+        def __exit__(self, *args):
+            """Exit context."""
+
+        def close(self):
+            """Close response."""
+
+        def raise_for_status(self):
+            """Raise for status."""
+
+        def iter_content(self, chunk_size):
+            """Iterate content."""
+            yield b"a"
+
+    locations = {
+        "http://example.com/1.jpg": "/2.jpg",
+        "http://example.com/2.jpg": None,
+        "http://example.com/3.jpg": "http://127.0.0.1/1.jpg",
+    }
+    gets = []
+
+    def get(url, **kwargs):
+        assert not kwargs["allow_redirects"]
+        gets.append(url)
+        return Response(locations.get(url, url))
+
+    monkeypatch.setattr(models.requests, "get", get)
+
+    def check_url(url):
+        return "127.0.0.1" not in url
+
+    assert models.download_url("http://example.com/1.jpg", io.BytesIO(), check_url=check_url) == 1
+    assert gets == ["http://example.com/1.jpg", "http://example.com/2.jpg"]
+    # redirect to internal address
+    with pytest.raises(ValueError):
+        models.download_url("http://example.com/3.jpg", io.BytesIO(), check_url=check_url)
+    assert gets[-1] == "http://example.com/3.jpg"
+    # redirect loop
+    with pytest.raises(requests.exceptions.TooManyRedirects):
+        models.download_url("http://example.com/4.jpg", io.BytesIO())
+
+
+def test_get_cached_image_matches(tmpdir):
+    """Test method."""
+    img_path = tmpdir.join("test.png").strpath
+    Image.new("RGB", (300, 200), (255, 0, 0)).save(img_path)
+    models.init_db(tmpdir.mkdir("db").join("iqdb.db").strpath, db_version)
+    place = models.ImageMatch.SP_IQDB
+    assert models.get_cached_image_matches("checksum", place) is None
+    thumb = models.get_posted_image(img_path, resize=True, output_thumb_folder=tmpdir.strpath)
+    img = models.ImageModel.get(models.ImageModel.path == img_path)
+    assert thumb != img
+    assert models.get_cached_image_matches(img.checksum, place, resize=True) is None
+    models.NegativeResult.add(models.NegativeResult.get_key(thumb.checksum, place), models.NegativeResult.CATEGORY_NO_MATCH)
+    assert models.get_cached_image_matches(img.checksum, place, resize=True) == ([], thumb.checksum)
+    assert models.get_cached_image_matches(img.checksum, place, resize=True, use_negative_cache=False) is None
+    assert models.get_cached_image_matches(img.checksum, place) is None
+    # thumbnail bigger than the resized image size, e.g. hydrus thumbnail
+    big_thumb = models.ImageModel.create(checksum="b" * 64, width=300, height=200)
+    models.add_posted_thumbnail("c" * 64, None, None, big_thumb.checksum)
+    models.add_posted_thumbnail("c" * 64, 1200, 800, big_thumb.checksum)
+    assert models.ImageModel.get(models.ImageModel.checksum == "c" * 64).size == "1200x800"
+    models.NegativeResult.add(models.NegativeResult.get_key(big_thumb.checksum, place), models.NegativeResult.CATEGORY_NO_MATCH)
+    assert models.get_cached_image_matches("c" * 64, place, resize=True) == ([], big_thumb.checksum)
+
+
+def test_get_images_with_match_page(tmpdir):
+    """Test method."""
+    models.init_db(tmpdir.mkdir("db").join("iqdb.db").strpath, db_version)
+    images = [models.ImageModel.create(checksum=str(idx), width=1, height=1, path=str(idx)) for idx in range(5)]
+    assert models.count_images_with_match() == 0
+    for idx, image in enumerate(images[:4]):
+        match_result = models.Match.create(href="example.com/{}".format(idx), thumb="thumb", rating="s")
+        imr = models.ImageMatchRelationship.create(image=image, match_result=match_result)
+        models.ImageMatch.create(match=imr, similarity=90, status=models.ImageMatch.STATUS_BEST_MATCH, search_place=0)
+        models.Counter.add(models.Counter.IMAGES_WITH_MATCH)
+    assert models.count_images_with_match() == 4
+
+    entries, has_newer, has_older = models.get_images_with_match_page(limit=3)
+    assert [x.checksum for x in entries] == ["3", "2", "1"]
+    assert (has_newer, has_older) == (False, True)
+    queries = []
+    original_execute_sql = models.db.obj.execute_sql
+    models.db.obj.execute_sql = lambda sql, *args, **kwargs: queries.append(sql) or original_execute_sql(sql, *args, **kwargs)
+    try:
+        entries, has_newer, has_older = models.get_images_with_match_page(before=entries[-1].id, limit=3)
+        imr_list = [x.imagematchrelationship_set[0] for x in entries]
+        assert [(x.match_result.href, x.imagematch_set[0].similarity) for x in imr_list] == [("example.com/0", 90)]
+    finally:
+        models.db.obj.execute_sql = original_execute_sql
+    assert len(queries) == 4
+    assert (has_newer, has_older) == (True, False)
+    entries, has_newer, has_older = models.get_images_with_match_page(after=entries[0].id, limit=3)
+    assert [x.checksum for x in entries] == ["3", "2", "1"]
+    assert (has_newer, has_older) == (False, True)
+
+
+def test_get_image_with_matches(tmpdir):
+    """Test method."""
+    models.init_db(tmpdir.mkdir("db").join("iqdb.db").strpath, db_version)
+    image = models.ImageModel.create(checksum="image", width=500, height=500, path="image")
+    thumb = models.ImageModel.create(checksum="thumb", width=150, height=150, path="thumb")
+    models.ThumbnailRelationship.create(original=image, thumbnail=thumb)
+    tag = models.Tag.create(name="1girl")
+    for idx in range(3):
+        match_result = models.Match.create(href="example.com/{}".format(idx), thumb="thumb", rating="s")
+        models.MatchTagRelationship.create(match=match_result, tag=tag)
+        imr = models.ImageMatchRelationship.create(image=thumb, match_result=match_result)
+        models.ImageMatch.create(match=imr, similarity=90 - idx, status=models.ImageMatch.STATUS_BEST_MATCH, search_place=0)
+    assert models.get_image_with_matches("unknown") is None
+    queries = []
+    original_execute_sql = models.db.obj.execute_sql
+    models.db.obj.execute_sql = lambda sql, *args, **kwargs: queries.append(sql) or original_execute_sql(sql, *args, **kwargs)
+    try:
+        entry = models.get_image_with_matches("thumb")
+        assert entry.thumbnailrelationship_set[0].original.size == "500x500"
+        assert [x.imagematch_set[0].similarity for x in entry.imagematchrelationship_set] == [90, 89, 88]
+        assert [[y.tag.name for y in x.match_result.matchtagrelationship_set] for x in entry.imagematchrelationship_set] == [["1girl"]] * 3
+    finally:
+        models.db.obj.execute_sql = original_execute_sql
+    assert len(queries) == 7
+    last_modified, n_match = models.get_image_match_version("thumb")
+    assert last_modified is not None and n_match == 3
+
+
+def test_init_db_url_and_pool(tmpdir):
+    """Test method."""
+    db_path = tmpdir.join("iqdb.db").strpath
+    models.init_db(db_url="sqlite:///{}".format(db_path))
+    assert models.db.obj.database == db_path
+    assert models.Program.select().count() == 1
+    models.db.close()
+    models.init_db(db_path, pool=True)
+    assert models.db.is_closed()
+    assert models.Program.select().count() == 1
+    assert models.db.obj.execute_sql("PRAGMA journal_mode").fetchone()[0] == "wal"
+    models.db.close()
+
+    @models.db_connection
+    def count_program():
+        return models.Program.select().count()
+
+    assert count_program() == 1
+    assert models.db.is_closed()
+
+
+def test_migrate_unique_index(tmpdir):
+    """Test method."""
+    db_path = tmpdir.join("iqdb.db").strpath
+    models.init_db(db_path)
+    for index in ("tag_name_namespace", "tag_name_null_namespace", "matchtagrelationship_match_id_tag_id"):
+        models.db.execute_sql("DROP INDEX {}".format(index))
+    models.Program.update(version=2).execute()
+    match_result = models.Match.create(href="example.com/1", thumb="thumb", rating="s")
+    tags = [models.Tag.create(name="1girl") for _ in range(2)]
+    for tag in tags:
+        models.MatchTagRelationship.create(match=match_result, tag=tag)
+    models.db.close()
+    models.init_db(db_path)
+    assert [x.tag.id for x in models.MatchTagRelationship.select()] == [tags[0].id]
+    assert models.Tag.select().count() == 1
+    assert models.Program.select().order_by(models.Program.version.desc()).first().version == db_version
+    with pytest.raises(IntegrityError):
+        models.Tag.create(name="1girl")
+
+
+def test_get_or_create_race(tmpdir):
+    """Test method."""
+    models.init_db(tmpdir.join("iqdb.db").strpath)
+    barrier = threading.Barrier(8)
+    results = []
+
+    def create_tag():
+        barrier.wait()
+        results.append(models.Tag.get_or_create(name="1girl", namespace="general")[0].id)
+        models.db.close()
+
+    threads = [threading.Thread(target=create_tag) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(set(results)) == 1
+    assert models.Tag.select().count() == 1
+
+
+@pytest.mark.skipif(not os.getenv("IQDB_TAGGER_TEST_DB_URL"), reason="IQDB_TAGGER_TEST_DB_URL is not set")
+def test_init_db_url_server():
+    """Test method, run against database server, e.g. IQDB_TAGGER_TEST_DB_URL=postgresql://localhost/iqdb_tagger_test."""
+    models.init_db(db_url=os.environ["IQDB_TAGGER_TEST_DB_URL"])
+    with models.db.atomic() as txn:
+        match_result = models.Match.get_or_create(href="example.com/1", defaults={"thumb": "thumb", "rating": "s"})[0]
+        tag = models.Tag.get_or_create(name="1girl", namespace=None)[0]
+        assert models.Tag.get_or_create(name="1girl", namespace=None) == (tag, False)
+        models.MatchTagRelationship.get_or_create(match=match_result, tag=tag)
+        assert [x.tag.name for x in match_result.matchtagrelationship_set] == ["1girl"]
+        txn.rollback()
+    models.db.close()
@@ -0,0 +1,110 @@
+"""test pipeline module."""
+import itertools
+import threading
+
+import pytest
+
+from iqdb_tagger.pipeline import Pipeline, Stage, read_ahead
+
+
+def test_pipeline():
+    """Test method."""
+
+    def double(item):
+        return item * 2
+
+    def drop_odd(item):
+        if item == 6:
+            raise ValueError("error")
+        return item if item % 4 == 0 else None
+
+    stages = [Stage("double", double, 2), Stage("drop", drop_odd, 3)]
+    assert sorted(Pipeline(stages, queue_size=2).run(range(10))) == [0, 4, 8, 12, 16]
+
+
+def test_pipeline_input_error():
+    """Test method."""
+
+    def items():
+        yield from range(3)
+        raise ValueError("input error")
+
+    results = []
+    with pytest.raises(ValueError, match="input error"):
+        for item in Pipeline([Stage("same", lambda x: x, 2)]).run(items()):
+            results.append(item)
+    assert sorted(results) == [0, 1, 2]
+    with pytest.raises(ValueError, match="input error"):
+        list(read_ahead(items()))
+
+
+def test_pipeline_on_error():
+    """Test method."""
+    failed = []
+
+    def check(item):
+        if item == 3:
+            raise ValueError("error")
+        return item
+
+    stages = [Stage("check", check, 2, on_error=lambda item, err: failed.append((item, str(err))))]
+    assert sorted(Pipeline(stages).run(range(5))) == [0, 1, 2, 4]
+    assert failed == [(3, "error")]
+
+
+def test_pipeline_discard():
+    """Test method."""
+    created, discarded = [], []
+    lock = threading.Lock()
+
+    def create(item):
+        with lock:
+            created.append(item)
+        return item
+
+    def discard(item):
+        with lock:
+            discarded.append(item)
+
+    stages = [Stage("create", create, 2, discard=discard), Stage("same", lambda x: x, 2, discard=discard)]
+    results = Pipeline(stages, queue_size=2).run(range(100))
+    consumed = [next(results) for _ in range(5)]
+    results.close()
+    # every created item is consumed or discarded once
+    assert sorted(consumed + discarded) == sorted(created)
+    assert len(created) < 100
+
+
+def test_pipeline_bounded():
+    """Test method."""
+    consumed = []
+    lock = threading.Lock()
+
+    def items():
+        for item in itertools.count():
+            with lock:
+                consumed.append(item)
+            yield item
+
+    results = Pipeline([Stage("same", lambda x: x)], queue_size=2).run(items())
+    for item in results:
+        if item == 5:
+            break
+    results.close()
+    # input is only read ahead by the queue sizes, not consumed entirely
+    assert len(consumed) < 20
+
+
+def test_read_ahead():
+    """Test method."""
+    read = []
+
+    def items():
+        for item in range(5):
+            read.append(item)
+            yield item
+
+    results = read_ahead(items(), 2)
+    assert next(results) == 0
+    assert list(results) == [1, 2, 3, 4]
+    assert read == [0, 1, 2, 3, 4]
@@ -0,0 +1,17 @@
+"""test sha256 module."""
+import hashlib
+import io
+
+from iqdb_tagger.sha256 import sha256_checksum, spool_stream
+
+
+def test_spool_stream(tmpdir):
+    """Test method."""
+    data = b"x" * 100000
+    spooled, checksum = spool_stream(io.BytesIO(data), max_size=10, block_size=4096)
+    with spooled:
+        assert spooled.read() == data
+    assert checksum == hashlib.sha256(data).hexdigest()
+    path = tmpdir.join("data")
+    path.write_binary(data)
+    assert sha256_checksum(path.strpath) == checksum
@@ -0,0 +1,53 @@
+"""test singleflight module."""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from iqdb_tagger.singleflight import SingleFlight
+
+
+def test_single_flight():
+    """Test method."""
+    flight = SingleFlight()
+    calls = []
+    started = threading.Event()
+
+    def func(value):
+        calls.append(value)
+        started.set()
+        time.sleep(0.2)
+        return value * 2
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        first = executor.submit(flight.do, "key", func, 1)
+        started.wait()
+        others = [executor.submit(flight.do, "key", func, 1) for _ in range(3)]
+        other_key = executor.submit(flight.do, "other key", func, 2)
+        results = [x.result() for x in [first] + others]
+    assert results == [2, 2, 2, 2]
+    assert other_key.result() == 4
+    assert sorted(calls) == [1, 2]
+    assert not flight.calls
+    # key is released after the call
+    assert flight.do("key", func, 3) == 6
+
+
+def test_single_flight_error():
+    """Test method."""
+    flight = SingleFlight()
+    started = threading.Event()
+
+    def func():
+        started.set()
+        time.sleep(0.2)
+        raise ValueError("error")
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        first = executor.submit(flight.do, "key", func)
+        started.wait()
+        other = executor.submit(flight.do, "key", func)
+        for future in (first, other):
+            with pytest.raises(ValueError):
+                future.result()
@@ -0,0 +1,69 @@
+"""test snapshot module."""
+import datetime
+import io
+
+from iqdb_tagger import db_version, models, snapshot
+
+
+def create_search_result(checksum, href, tag_names, from_img_alt=False):
+    """Create resized posted image with one match result."""
+    image = models.ImageModel.create(checksum=checksum, width=1000, height=800)
+    thumb = models.ImageModel.create(checksum=checksum + "-thumb", width=150, height=120)
+    models.ThumbnailRelationship.create(original=image, thumbnail=thumb)
+    match_result = models.Match.get_or_create(href=href, defaults={"thumb": "/thumb.jpg", "rating": "s"})[0]
+    imr = models.ImageMatchRelationship.create(image=thumb, match_result=match_result)
+    models.ImageMatch.create(match=imr, similarity=95, status=models.ImageMatch.STATUS_BEST_MATCH, search_place=models.ImageMatch.SP_IQDB)
+    for namespace, name in tag_names:
+        tag = models.Tag.get_or_create(name=name, namespace=namespace)[0]
+        models.MatchTagRelationship.create(match=match_result, tag=tag, from_img_alt=from_img_alt)
+    return match_result
+
+
+def get_tags(href):
+    """Get tag full names of match result."""
+    query = models.MatchTagRelationship.select().join(models.Match).where(models.Match.href == href)
+    return sorted((x.tag.full_name, x.from_img_alt) for x in query)
+
+
+def test_export_and_import_snapshot(tmpdir):
+    """Test method."""
+    src_path, dst_path = tmpdir.join("src.db").strpath, tmpdir.join("dst.db").strpath
+    models.init_db(src_path, db_version)
+    create_search_result("a" * 64, "danbooru.donmai.us/posts/1", [("general", "1girl"), (None, "solo")])
+    create_search_result("b" * 64, "danbooru.donmai.us/posts/2", [("general", "1girl")], from_img_alt=True)
+    f = io.BytesIO()
+    assert snapshot.export_snapshot(f) == {"image": 4, "match": 2}
+
+    models.init_db(dst_path, db_version)
+    # local tags from image alt text are replaced by the tag page tags from snapshot
+    create_search_result("c" * 64, "danbooru.donmai.us/posts/1", [("general", "1girl"), ("general", "long_hair")], from_img_alt=True)
+    f.seek(0)
+    counts = snapshot.import_snapshot(f, batch_size=2)
+    assert counts == {"image": 4, "match": 2, "image_match": 2, "tag": 3}
+    cached = models.get_cached_image_matches("a" * 64, models.ImageMatch.SP_IQDB, resize=True)
+    assert [x.match.match_result.href for x in cached[0]] == ["danbooru.donmai.us/posts/1"]
+    assert cached[1] == "a" * 64 + "-thumb"
+    assert get_tags("danbooru.donmai.us/posts/1") == [("general:1girl", False), ("solo", False)]
+    assert get_tags("danbooru.donmai.us/posts/2") == [("general:1girl", True)]
+    assert models.Tag.select().count() == 3
+    f.seek(0)
+    assert snapshot.import_snapshot(f) == {"image": 4, "match": 2, "image_match": 0, "tag": 0}
+    assert models.ImageModel.select().count() == 6
+
+
+def test_export_snapshot_since(tmpdir):
+    """Test method."""
+    models.init_db(tmpdir.join("src.db").strpath, db_version)
+    match_result = create_search_result("a" * 64, "danbooru.donmai.us/posts/1", [("general", "1girl")])
+    since = datetime.datetime.now()
+    f = io.BytesIO()
+    assert snapshot.export_snapshot(f, since) == {"image": 0, "match": 0}
+    tag = models.Tag.create(name="solo")
+    models.MatchTagRelationship.create(match=match_result, tag=tag)
+    create_search_result("b" * 64, "danbooru.donmai.us/posts/2", [])
+    f = io.BytesIO()
+    assert snapshot.export_snapshot(f, since) == {"image": 2, "match": 2}
+    f.seek(0)
+    records = list(snapshot.read_snapshot(f))
+    assert [x["type"] for x in records] == ["image", "match", "image", "match"]
+    assert records[-1]["tags"] == [["general", "1girl"], [None, "solo"]]
@@ -0,0 +1,30 @@
+"""test tag prefetch module."""
+import threading
+
+from iqdb_tagger import db_version, models, tag_prefetch
+
+
+def test_tag_prefetcher(tmpdir, monkeypatch):
+    """Test method."""
+    models.init_db(tmpdir.mkdir("db").join("iqdb.db").strpath, db_version)
+    tagged, untagged, negative = [models.Match.create(href="example.com/{}".format(idx), thumb="thumb", rating="s") for idx in range(3)]
+    filtered = models.Match.create(href="//anime-pictures.net/pictures/1", thumb="thumb", rating="s")
+    models.MatchTagRelationship.create(match=tagged, tag=models.Tag.create(name="1girl"))
+    models.NegativeResult.add(negative.link, models.NegativeResult.CATEGORY_NO_TAGS)
+    event = threading.Event()
+    fetched = []
+
+    def get_tags(match_result):
+        event.wait(5)
+        fetched.append(match_result.id)
+        return []
+
+    monkeypatch.setattr(tag_prefetch, "get_tags_from_match_result", get_tags)
+    prefetcher = tag_prefetch.TagPrefetcher()
+    assert prefetcher.submit([tagged.id, untagged.id, negative.id, filtered.id]) == [untagged.id]
+    assert prefetcher.is_pending(untagged.id)
+    assert prefetcher.submit([untagged.id]) == []
+    event.set()
+    prefetcher.shutdown()
+    assert fetched == [untagged.id]
+    assert not prefetcher.is_pending(untagged.id)
@@ -0,0 +1,44 @@
+"""test thumbnail module."""
+import os
+
+from PIL import Image
+
+from iqdb_tagger import db_version, models, thumbnail
+
+
+def test_resize_cache(tmpdir):
+    """Test method."""
+    models.init_db(tmpdir.mkdir("db").join("iqdb.db").strpath, db_version)
+    img_path = tmpdir.join("test.png").strpath
+    Image.new("RGBA", (400, 200), (255, 0, 0, 255)).save(img_path)
+    image = models.ImageModel.get_or_create_from_path(img_path)[0]
+    cache = thumbnail.ResizeCache(tmpdir.join("resized").strpath, max_files=2)
+    path = cache.get(image, (100, 100))
+    assert os.path.basename(path) == "{}-100-100.jpg".format(image.checksum)
+    assert Image.open(path).size == (100, 50)
+    assert cache.get(image, (100, 100)) == path
+    os.utime(path, (0, 0))
+    cache.get(image, (50, 50))
+    cache.get(image, (20, 20))
+    assert not os.path.isfile(path)
+    assert len(os.listdir(cache.folder)) == 2
+    os.remove(img_path)
+    assert cache.get(image, (30, 30)) is None
+
+
+def test_resized_thumb_route(app, tmpdir):
+    """Test method."""
+    img_path = tmpdir.join("test.png").strpath
+    Image.new("RGB", (400, 200), (255, 0, 0)).save(img_path)
+    image = models.ImageModel.get_or_create_from_path(img_path)[0]
+    # e.g. hydrus original or image from snapshot, without file
+    pathless = models.ImageModel.create(checksum="b" * 64, width=400, height=200)
+    client = app.test_client()
+    resp = client.get("/resized/{}/100x100.jpg".format(image.checksum))
+    assert resp.status_code == 200
+    assert resp.headers["Cache-Control"] == thumbnail.CACHE_CONTROL
+    assert client.get("/resized/{}/100x100.jpg".format(pathless.checksum)).status_code == 404
+    assert client.get("/resized/{}/100x100.jpg".format("c" * 64)).status_code == 404
+    thumb = models.ImageModel.create(checksum="d" * 64, width=100, height=50)
+    models.ThumbnailRelationship.create(original=pathless, thumbnail=thumb)
+    assert client.get("/resized/{}/50x50.jpg".format(pathless.checksum)).status_code == 404
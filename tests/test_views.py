@@ -0,0 +1,177 @@
+"""test views module."""
+import hashlib
+import io
+import json
+import os
+import time
+
+from PIL import Image
+
+from iqdb_tagger import __main__ as main
+from iqdb_tagger import models, views
+
+RESULT_PAGE = """<div class="pages">
+<div><table><tr><th>Your image</th></tr></table></div>
+<div><table>
+<tr><th>Best match</th></tr>
+<tr><td><a href="//danbooru.donmai.us/posts/1">
+<img src="/danbooru/1.jpg" alt="Rating: s Tags: 1girl" title="Rating: s Tags: 1girl"></a></td></tr>
+<tr><td>Danbooru</td></tr>
+<tr><td>500×600 [Safe]</td></tr>
+<tr><td>95% similarity</td></tr>
+</table></div>
+</div>"""
+
+
+def get_image_file(size, color):
+    """Get jpeg image file object."""
+    f = io.BytesIO()
+    Image.new("RGB", size, color).save(f, "JPEG")
+    f.seek(0)
+    return f
+
+
+def wait_job(client, status_url):
+    """Poll job status until it is finished."""
+    for _ in range(100):
+        job = client.get(status_url).get_json()
+        if job["status"] in ("done", "failed"):
+            return job
+        time.sleep(0.05)
+    raise AssertionError("job not finished")
+
+
+def test_is_public_url():
+    """Test method."""
+    assert views.is_public_url("http://93.184.216.34/1.jpg")
+    assert not views.is_public_url("http://127.0.0.1/1.jpg")
+    assert not views.is_public_url("https://10.0.0.1:8080/1.jpg")
+    assert not views.is_public_url("http://[::1]/1.jpg")
+    assert not views.is_public_url("file:///etc/passwd")
+
+
+def test_search_url(app):
+    """Test method."""
+    image = models.ImageModel.create(checksum="a" * 64, width=150, height=100, path="http://93.184.216.34/1.jpg")
+    calls = []
+
+    def search_image_url(image_url, **kwargs):
+        calls.append((image_url, kwargs))
+        return [], image.checksum if image_url == image.path else None
+
+    app.extensions["iqdb_tagger_search_image_url"] = search_image_url
+    client = app.test_client()
+    resp = client.post("/api/matchview", data={"url": image.path, "resize": "0"})
+    assert resp.status_code == 202
+    job = wait_job(client, resp.get_json()["status_url"])
+    assert job["result"] == {"checksum": image.checksum, "matches": []}
+    assert calls == [(image.path, {"resize": False, "place": "iqdb", "check_url": views.is_public_url})]
+    # recently without match
+    resp = client.post("/api/matchview", data={"url": "http://93.184.216.34/2.jpg"})
+    job = wait_job(client, resp.get_json()["status_url"])
+    assert job["result"] == {"checksum": None, "matches": []}
+    assert b"No match found" in client.get("/job/{}".format(job["id"])).data
+    # url which can't be downloaded by the server
+    assert client.post("/api/matchview", data={"url": "http://127.0.0.1/1.jpg"}).status_code == 400
+    assert client.post("/api/matchview", data={"url": "file:///etc/passwd"}).status_code == 400
+    assert len(calls) == 2
+
+
+def test_search_file(app, monkeypatch):
+    """Test method."""
+    uploaded = []
+
+    def get_page_result(image, **kwargs):
+        uploaded.append(image)
+        return RESULT_PAGE
+
+    monkeypatch.setattr(views, "get_page_result", get_page_result)
+    client = app.test_client()
+    resp = client.post("/api/matchview", data={"file": (get_image_file((400, 300), (255, 0, 0)), "1.jpg"), "tags": "0"})
+    assert resp.status_code == 202
+    job = wait_job(client, resp.get_json()["status_url"])
+    assert job["status"] == "done", job
+    assert [x["href"] for x in job["result"]["matches"]] == ["https://danbooru.donmai.us/posts/1"]
+    assert not any(os.path.exists(x) for x in uploaded)
+    # uploaded file is removed, its resized image is kept as thumbnail
+    posted_img = models.ImageModel.get(models.ImageModel.checksum == job["result"]["checksum"])
+    assert os.path.dirname(posted_img.path) == app.config["IQDB_TAGGER_THUMB_FOLDER"]
+    assert os.path.isfile(posted_img.path)
+    assert models.ImageModel.get(models.ImageModel.width == 400).path is None
+    assert client.get("/matchview/sha256-{}".format(posted_img.checksum)).status_code == 200
+    assert client.get("/job/{}".format(job["id"])).status_code == 302
+    # searched before, answered without job
+    resp = client.post("/api/matchview", data={"file": (get_image_file((400, 300), (255, 0, 0)), "1.jpg")})
+    assert resp.status_code == 200
+    assert resp.get_json()["result"]["checksum"] == posted_img.checksum
+    assert len(uploaded) == 1
+
+
+def test_job_not_found(app):
+    """Test method."""
+    client = app.test_client()
+    assert client.get("/api/job/unknown").status_code == 404
+    assert client.get("/job/unknown").status_code == 404
+    assert client.post("/api/matchview", data={}).status_code == 400
+    assert client.post("/api/matchview", data={"url": "http://93.184.216.34/1.jpg", "place": "unknown"}).status_code == 400
+
+
+def test_batch_search(app, monkeypatch):
+    """Test method."""
+
+    def search_image_url(image_url, **kwargs):
+        raise ValueError("Unexpected iqdb result page")
+
+    app.extensions["iqdb_tagger_search_image_url"] = search_image_url
+    monkeypatch.setattr(views, "get_page_result", lambda **kwargs: RESULT_PAGE)
+    submitted = []
+    job_queue = app.extensions["iqdb_tagger_jobs"]
+    submit_task = job_queue.submit_task
+    monkeypatch.setattr(job_queue, "submit_task", lambda func, *args: submitted.append(func) or submit_task(func, *args))
+    client = app.test_client()
+    image_file = get_image_file((400, 300), (0, 0, 255))
+    checksum = hashlib.sha256(image_file.getvalue()).hexdigest()
+    data = {"checksum": "c" * 64, "url": "http://93.184.216.34/1.jpg", "file": (image_file, "1.jpg"), "tags": "0"}
+    resp = client.post("/api/matchview", data=data)
+    assert resp.mimetype == "application/x-ndjson"
+    lines = sorted((json.loads(x) for x in resp.get_data(as_text=True).splitlines()), key=lambda x: x["index"])
+    assert [(x["index"], x["status"]) for x in lines] == [(0, "not_found"), (1, "failed"), (2, "done")]
+    assert lines[0]["checksum"] == "c" * 64
+    assert lines[1]["error"] == "Unexpected iqdb result page"
+    assert lines[2]["file"] == "1.jpg"
+    assert [x["href"] for x in lines[2]["matches"]] == ["https://danbooru.donmai.us/posts/1"]
+    assert len(submitted) == 3
+    posted_checksum = lines[2]["checksum"]
+    # uploaded file searched before
+    resp = client.post("/api/matchview", data={"checksum": checksum, "tags": "0"}, headers={"Accept": "application/x-ndjson"})
+    lines = [json.loads(x) for x in resp.get_data(as_text=True).splitlines()]
+    assert [(x["status"], x["checksum"], len(x["matches"])) for x in lines] == [("done", posted_checksum, 1)]
+
+
+def test_prefetch_tags(app, monkeypatch):
+    """Test method."""
+    monkeypatch.setattr(views, "get_page_result", lambda **kwargs: RESULT_PAGE)
+    submitted = []
+    tag_prefetcher = app.extensions["iqdb_tagger_tag_prefetcher"]
+    monkeypatch.setattr(tag_prefetcher, "submit", lambda match_ids: submitted.append(list(match_ids)) or [])
+    client = app.test_client()
+    # api client which doesn't ask for tags
+    resp = client.post("/api/matchview", data={"file": (get_image_file((400, 300), (0, 255, 0)), "1.jpg"), "tags": "0"})
+    wait_job(client, resp.get_json()["status_url"])
+    assert submitted == []
+    data = {"file": (get_image_file((400, 300), (0, 0, 255)), "2.jpg"), "resize": "y", "place": str(models.ImageMatch.SP_IQDB)}
+    resp = client.post("/", data=data)
+    assert resp.status_code == 302
+    wait_job(client, "/api/job/{}".format(resp.headers["Location"].rstrip("/").rsplit("/", 1)[1]))
+    assert submitted == [[models.Match.get().id]]
+    assert client.get("/matchview/d/{}".format(models.ImageMatchRelationship.select().first().id)).status_code == 200
+    assert submitted[-1] == [models.Match.get().id]
+
+
+def test_tag_prefetcher_workers(app, monkeypatch):  # pylint: disable=unused-argument
+    """Test method."""
+    monkeypatch.setenv("IQDB_TAGGER_TAG_WORKERS", "3")
+    other_app = main.create_app()
+    assert other_app.extensions["iqdb_tagger_tag_prefetcher"].max_workers == 3
+    other_app.extensions["iqdb_tagger_tag_prefetcher"].shutdown()
+    other_app.extensions["iqdb_tagger_jobs"].shutdown()
@@ -0,0 +1,102 @@
+"""test work queue and rate limit module."""
+import datetime
+
+from click.testing import CliRunner
+from peewee import DoubleField
+
+from iqdb_tagger import __main__ as main
+from iqdb_tagger import models
+from iqdb_tagger.__init__ import db_version
+from iqdb_tagger.models import WorkItem
+from iqdb_tagger.ratelimit import RateLimiter
+from iqdb_tagger.workqueue import WorkQueue
+
+
+def test_work_queue(tmpdir):
+    """Test method."""
+    models.init_db(tmpdir.join("db.sqlite").strpath, db_version)
+    queue = WorkQueue(max_attempts=2)
+    assert queue.submit(WorkItem.KIND_PATH, ["/a.jpg", "/b.jpg", "/a.jpg"]) == 2
+    assert queue.submit(WorkItem.KIND_PATH, ["/a.jpg"]) == 0
+    item = queue.claim("w1")
+    assert (item.value, item.status, item.owner, item.attempts) == ("/a.jpg", WorkItem.STATUS_LEASED, "w1", 1)
+    assert queue.claim("w2").value == "/b.jpg"
+    assert queue.claim("w2") is None
+    assert queue.complete(item, "checksum")
+    assert WorkItem.get_by_id(item.id).checksum == "checksum"
+    # crashed worker, lease expired
+    WorkItem.update(lease_expires=datetime.datetime.now() - datetime.timedelta(seconds=1)).where(WorkItem.value == "/b.jpg").execute()
+    stale = WorkItem.get(WorkItem.value == "/b.jpg")
+    item = queue.claim("w3")
+    assert (item.value, item.owner, item.attempts) == ("/b.jpg", "w3", 2)
+    # stale worker can't finish item leased by other worker
+    assert not queue.complete(stale)
+    assert queue.fail(item, "error")
+    assert WorkItem.get_by_id(item.id).status == WorkItem.STATUS_FAILED
+    assert queue.counts() == {WorkItem.STATUS_DONE: 1, WorkItem.STATUS_FAILED: 1}
+    assert queue.submit(WorkItem.KIND_PATH, ["/b.jpg"], retry=True) == 1
+    item = queue.claim("w1")
+    assert (item.attempts, item.error) == (1, None)
+    assert queue.fail(item, "error")
+    assert WorkItem.get_by_id(item.id).status == WorkItem.STATUS_QUEUED
+    assert WorkQueue("other").claim("w1") is None
+
+
+def test_rate_limiter(tmpdir):
+    """Test method."""
+    models.init_db(tmpdir.join("db.sqlite").strpath, db_version)
+    limiter = RateLimiter(10)
+    assert limiter.reserve("iqdb.org") == 0
+    assert 9 < limiter.reserve("iqdb.org") <= 10
+    assert 19 < limiter.reserve("iqdb.org") <= 20
+    assert limiter.reserve("danbooru.donmai.us") == 0
+    # epoch seconds need double precision
+    assert isinstance(models.RateLimit.next_time, DoubleField)
+
+
+def test_get_page_result_rate_limiter(monkeypatch):
+    """Test method."""
+    hosts = []
+
+    class Limiter:
+        """Rate limiter."""
+
+        def wait(self, key):
+            """Record waited key."""
+            hosts.append(key)
+
+    response = type("Response", (), {"text": "page", "raise_for_status": lambda self: None})()
+    monkeypatch.setattr(models.requests, "post", lambda *args, **kwargs: response)
+    image_url = "http://example.com/1.jpg"
+    assert models.get_page_result(None, "http://iqdb.org", use_requests=True, image_url=image_url, rate_limiter=Limiter()) == "page"
+    assert models.get_page_result(None, "http://iqdb.org", use_requests=True, image_url=image_url) == "page"
+    assert hosts == ["iqdb.org"]
+
+
+def test_submit_and_worker(tmpdir, monkeypatch):
+    """Test method."""
+    db_path = tmpdir.join("db.sqlite").strpath
+    folder = tmpdir.mkdir("images")
+    for name in ("1.jpg", "2.jpg"):
+        folder.join(name).write("")
+    processed = []
+
+    def run_program_for_single_img(image, **kwargs):
+        assert isinstance(kwargs["rate_limiter"], RateLimiter)
+        processed.append(image)
+        if image.endswith("2.jpg"):
+            return {"error": [ValueError("error")], "match result tag pairs": [], "checksum": None}
+        return {"error": [], "match result tag pairs": [], "checksum": "checksum"}
+
+    monkeypatch.setattr(main, "run_program_for_single_img", run_program_for_single_img)
+    monkeypatch.setenv("IQDB_TAGGER_DB_PATH", db_path)
+    runner = CliRunner()
+    result = runner.invoke(main.cli, ["submit", "--db-path", db_path, folder.strpath, "http://example.com/3.jpg"])
+    assert result.exit_code == 0, result.output
+    assert "3 item(s) queued" in result.output
+    args = ["worker", "--db-path", db_path, "--max-attempts", "2", "--rate-limit", "0", "--exit-when-empty"]
+    result = runner.invoke(main.cli, args)
+    assert result.exit_code == 0, result.output
+    assert "2 item(s) done, 2 failed" in result.output
+    assert processed.count(folder.join("2.jpg").strpath) == 2
+    assert WorkQueue().counts() == {WorkItem.STATUS_DONE: 2, WorkItem.STATUS_FAILED: 1}